@@ -1,16 +1,23 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, make_response
 from flask_cors import CORS
 import os
+import re
 from datetime import datetime
 from functools import wraps
 from database import (
     TicketService, CustomerService, AgentService, UserService,
     get_stats, init_supabase_tables
 )
-from email_service import EmailService, email_monitor
+from email_service import EmailService, email_monitor, email_queue
+from dashboard_counters import dashboard_counters
+from ticket_events import ticket_events, event_stream, publish_messages, publish_message_deleted
+from table_versions import table_versions
+from http_encoding import init_app as init_http_encoding, json_array_response
 
 app = Flask(__name__)
 CORS(app)
+# Provider JSON (orjson opzionale) e compressione gzip/brotli delle risposte
+init_http_encoding(app)
 
 def init_db():
     """Inizializza la connessione a Supabase"""
@@ -24,13 +31,23 @@ def init_db():
         print(f"Errore connessione Supabase: {e}")
         return False
 
+# Endpoint SSE: EventSource non può inviare header, il token arriva come parametro
+STREAM_ENDPOINTS = {'ticket_events_stream', 'customer_ticket_events_stream'}
+
+def request_token():
+    """Token dall'header Authorization (o dal parametro token per gli endpoint SSE)"""
+    token = request.headers.get('Authorization')
+    if token and token.startswith('Bearer '):
+        token = token[7:]  # Rimuovi 'Bearer '
+    if not token and request.endpoint in STREAM_ENDPOINTS:
+        token = request.args.get('token')
+    return token
+
 def token_required(f):
     """Decorator per richiedere autenticazione"""
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if token and token.startswith('Bearer '):
-            token = token[7:]  # Rimuovi 'Bearer '
+        token = request_token()
         
         if not token:
             return jsonify({'error': 'Token mancante'}), 401
@@ -49,9 +66,7 @@ def customer_token_required(f):
     """Decorator per richiedere autenticazione cliente"""
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if token and token.startswith('Bearer '):
-            token = token[7:]  # Rimuovi 'Bearer '
+        token = request_token()
         
         if not token:
             return jsonify({'error': 'Token mancante'}), 401
@@ -66,6 +81,79 @@ def customer_token_required(f):
     
     return decorated
 
+def conditional_get(*tables):
+    """
+    Decorator per GET condizionali: ETag forte dalle versioni in memoria
+    delle tabelle da cui dipende la risposta (vedi table_versions). Se il
+    client ha già la versione corrente risponde 304 senza eseguire la vista
+    e quindi senza interrogare il database.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            
+            # Calcolato prima della vista: una scrittura concorrente produce al più un 200 in più
+            etag = table_versions.etag(tables, request.full_path)
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        
+        return decorated
+    return decorator
+
+# Parametri per liste paginate (keyset) di ticket e clienti
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+TICKET_FILTER_FIELDS = ['status', 'priority', 'assigned_to', 'software', 'group', 'type', 'customer_id']
+TICKET_SORT_FIELDS = ['created_at', 'updated_at', 'id', 'title', 'priority', 'status']
+CUSTOMER_FILTER_FIELDS = ['status', 'company']
+CUSTOMER_SORT_FIELDS = ['created_at', 'updated_at', 'id', 'name', 'email', 'company']
+
+def parse_list_query(filter_fields, sort_fields):
+    """Estrae filtri, ordinamento, proiezione e paginazione dai parametri della richiesta"""
+    args = request.args
+    
+    filters = {field: args[field] for field in filter_fields if args.get(field)}
+    
+    sort = args.get('sort', 'created_at')
+    if sort not in sort_fields:
+        return None, f'Ordinamento non supportato: {sort}'
+    
+    direction = args.get('order', 'desc').lower()
+    if direction not in ('asc', 'desc'):
+        return None, 'Direzione di ordinamento non valida (asc|desc)'
+    
+    select = '*'
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        if not fields or any(not re.match(r'^[a-z_]+$', field) for field in fields):
+            return None, 'Parametro fields non valido'
+        select = ', '.join(fields)
+    
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return None, 'Parametro limit non valido'
+    
+    return {
+        'filters': filters,
+        'sort': sort,
+        'direction': direction,
+        'select': select,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'cursor': args.get('cursor') or None,
+        # Paginazione solo su richiesta: senza limit/cursor la risposta resta una lista completa
+        'paginate': 'limit' in args or 'cursor' in args
+    }, None
+
 @app.route('/')
 def dashboard():
     return render_template('dashboard.html')
@@ -123,10 +211,30 @@ def favicon_svg():
 
 @app.route('/api/tickets', methods=['GET', 'POST'])
 @token_required
+@conditional_get('tickets')
 def api_tickets():
     if request.method == 'GET':
-        tickets = TicketService.get_all()
-        return jsonify(tickets)
+        query, error = parse_list_query(TICKET_FILTER_FIELDS, TICKET_SORT_FIELDS)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        if query['paginate']:
+            try:
+                tickets, next_cursor = TicketService.get_page(filters=query['filters'],
+                                                              sort=query['sort'],
+                                                              direction=query['direction'],
+                                                              limit=query['limit'],
+                                                              cursor=query['cursor'],
+                                                              select=query['select'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'items': tickets, 'next_cursor': next_cursor, 'limit': query['limit']})
+        
+        tickets = TicketService.get_all(filters=query['filters'],
+                                        order_by={query['sort']: query['direction'], 'id': query['direction']},
+                                        select=query['select'])
+        # Le liste molto lunghe vengono inviate in streaming
+        return json_array_response(tickets)
     
     elif request.method == 'POST':
         data = request.json
@@ -168,9 +276,9 @@ def api_tickets():
         
         new_ticket = TicketService.create(ticket_data)
         if new_ticket:
-            # Invia notifica email per nuovo ticket
+            # Accoda la notifica email per nuovo ticket
             try:
-                EmailService.send_new_ticket_notification(new_ticket)
+                email_queue.enqueue('new_ticket', new_ticket)
             except Exception as e:
                 print(f"Errore nell'invio notifica email: {e}")
             
@@ -234,18 +342,18 @@ def update_or_delete_ticket(ticket_id):
         update_data['numero_richiesta_teleassistenza'] = data['numero_richiesta_teleassistenza']
     
     if update_data:
-        # Recupera lo stato attuale prima dell'aggiornamento
-        tickets = TicketService.get_all()
-        current_ticket = next((t for t in tickets if t['id'] == ticket_id), None)
-        old_status = current_ticket['status'] if current_ticket else None
+        # Recupera lo stato attuale prima dell'aggiornamento (solo se lo stato cambia)
+        old_status = None
+        if 'status' in update_data:
+            current_ticket = TicketService.get_by_id(ticket_id, select='id, status')
+            old_status = current_ticket['status'] if current_ticket else None
         
         result = TicketService.update(ticket_id, update_data)
         if result:
             # Invia email SOLO quando ticket diventa RISOLTO
             try:
-                # Recupera i dati aggiornati del ticket
-                updated_tickets = TicketService.get_all()
-                updated_ticket = next((t for t in updated_tickets if t['id'] == ticket_id), None)
+                # L'update restituisce già la riga aggiornata: rileggi solo se non disponibile
+                updated_ticket = result if isinstance(result, dict) else TicketService.get_by_id(ticket_id)
                 
                 if updated_ticket:
                     new_status = updated_ticket['status']
@@ -253,7 +361,7 @@ def update_or_delete_ticket(ticket_id):
                     # Email SOLO se cambia da qualsiasi stato a "Resolved"
                     if 'status' in update_data and new_status == 'Resolved' and old_status != 'Resolved':
                         print(f"📧 Ticket #{ticket_id} risolto: {old_status} → {new_status}")
-                        EmailService.send_ticket_resolved_notification(updated_ticket)
+                        email_queue.enqueue('ticket_resolved', updated_ticket)
                     else:
                         print(f"🔇 Ticket #{ticket_id} aggiornato silenziosamente: {old_status} → {new_status}")
                         
@@ -266,6 +374,51 @@ def update_or_delete_ticket(ticket_id):
     
     return jsonify({'message': 'Nessun dato da aggiornare'})
 
+def parse_messages_delta():
+    """
+    Parametri since_id (ultimo id ricevuto) e since (timestamp ISO) delle
+    letture incrementali dei messaggi: (filtri aggiuntivi, ordinamento, since_id).
+    Solleva ValueError se since_id non è un intero o since non è una data valida.
+    """
+    since_id = request.args.get('since_id')
+    if since_id is not None:
+        since_id = int(since_id)
+    since = request.args.get('since')
+    filters = {}
+    if since_id is not None:
+        filters['id'] = ('gt', since_id)
+    if since:
+        datetime.fromisoformat(since.replace('Z', '+00:00'))
+        filters['created_at'] = ('gt', since)
+    # Con since_id l'ordine per id garantisce che il cursore non salti righe
+    order_by = {'id': 'asc'} if since_id is not None else {'created_at': 'asc'}
+    return filters, order_by, since_id
+
+def messages_version(ticket_id):
+    """Versione delle modifiche/eliminazioni dei messaggi di un ticket (vedi bump_messages_version)"""
+    return f"{table_versions.epoch}.{table_versions.version(f'ticket_messages:{ticket_id}')}"
+
+def bump_messages_version(ticket_id):
+    """Un messaggio del ticket è stato modificato o eliminato: cambiano ETag e X-Messages-Version"""
+    table_versions.bump(f'ticket_messages:{ticket_id}')
+
+def messages_response(ticket_id, messages, since_id=None):
+    """
+    Risposta JSON dei messaggi con ETag dall'id dell'ultimo messaggio e dalla
+    versione delle modifiche del ticket: se il client ha già quella versione della
+    conversazione risponde 304 senza corpo. X-Messages-Version cambia dopo una
+    modifica o un'eliminazione: il client che legge solo i nuovi (since_id) ricarica tutto.
+    """
+    messages = messages or []
+    last_id = max([message['id'] for message in messages] + [since_id or 0])
+    version = messages_version(ticket_id)
+    response = jsonify(messages)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Messages-Version'] = version
+    if last_id or since_id is not None:
+        response.set_etag(f'msg-{ticket_id}-{last_id}-{version}')
+    return response.make_conditional(request)
+
 # API per messaggi dei ticket (chat)
 @app.route('/api/tickets/<int:ticket_id>/messages', methods=['GET', 'POST'])
 @token_required
@@ -275,14 +428,19 @@ def ticket_messages(ticket_id):
         
         
         if request.method == 'GET':
-            # Recupera tutti i messaggi del ticket
+            # Recupera i messaggi del ticket (solo i nuovi con since_id/since)
             from task_helper import get_from_supabase
             
+            try:
+                filters, order_by, since_id = parse_messages_delta()
+            except ValueError:
+                return jsonify({'error': 'Parametro since o since_id non valido'}), 400
+            
             messages = get_from_supabase('ticket_messages', 
-                                       filters={'ticket_id': ticket_id},
+                                       filters={'ticket_id': ticket_id, **filters},
                                        select='*',
-                                       order_by={'created_at': 'asc'})
-            return jsonify(messages if messages else [])
+                                       order_by=order_by)
+            return messages_response(ticket_id, messages, since_id)
         
         elif request.method == 'POST':
             # Crea un nuovo messaggio
@@ -304,22 +462,15 @@ def ticket_messages(ticket_id):
             
             if result:
                 new_message = result[0] if isinstance(result, list) else result
+                publish_messages([new_message])
                 
                 # Invia email se non è un messaggio interno
                 if not message_data['is_internal']:
                     try:
-                        # Recupera dati ticket per l'email
-                        tickets = TicketService.get_all()
-                        ticket = next((t for t in tickets if t['id'] == ticket_id), None)
-                        
-                        if ticket:
-                            # Determina destinatario email
-                            if message_data['sender_type'] == 'agent':
-                                # Messaggio da agente a cliente
-                                EmailService.send_ticket_message_to_customer(ticket, new_message)
-                            elif message_data['sender_type'] == 'customer':
-                                # Messaggio da cliente ad agenti
-                                EmailService.send_ticket_message_to_agents(ticket, new_message)
+                        # Il job recupera il ticket e sceglie il destinatario
+                        # (agente -> cliente, cliente -> agenti)
+                        if message_data['sender_type'] in ('agent', 'customer'):
+                            email_queue.enqueue('ticket_message', ticket_id, new_message)
                     
                     except Exception as e:
                         print(f"Errore nell'invio email messaggio: {e}")
@@ -332,6 +483,22 @@ def ticket_messages(ticket_id):
         print(f"Errore messaggi ticket: {e}")
         return jsonify({'error': str(e)}), 500
 
+def sse_response(subscription, accept=None):
+    """Risposta text/event-stream di un'iscrizione (503 se gli iscritti sono al massimo)"""
+    if subscription is None:
+        return jsonify({'error': 'Troppe connessioni in tempo reale, usare il polling'}), 503, {'Retry-After': '60'}
+    return Response(event_stream(subscription, accept), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx non deve accumulare lo stream
+    })
+
+@app.route('/api/tickets/<int:ticket_id>/events', methods=['GET'])
+@token_required
+def ticket_events_stream(ticket_id):
+    """Stream SSE dei nuovi messaggi di un ticket (chat agenti)"""
+    subscription = ticket_events.subscribe(ticket_id, request.headers.get('Last-Event-ID'))
+    return sse_response(subscription)
+
 @app.route('/api/tickets/<int:ticket_id>/messages/<int:message_id>', methods=['PUT', 'DELETE'])
 @token_required
 def manage_ticket_message(ticket_id, message_id):
@@ -350,10 +517,15 @@ def manage_ticket_message(ticket_id, message_id):
                 update_data['is_internal'] = data['is_internal']
             
             if update_data:
-                from task_helper import update_in_supabase
+                from task_helper import update_in_supabase, get_from_supabase
                 
                 result = update_in_supabase('ticket_messages', update_data, {'id': message_id, 'ticket_id': ticket_id})
                 if result:
+                    bump_messages_version(ticket_id)
+                    # Le chat aperte ricevono la modifica via SSE (riga completa: serve is_internal)
+                    rows = result if isinstance(result, list) else get_from_supabase(
+                        'ticket_messages', filters={'id': message_id, 'ticket_id': ticket_id}, use_cache=False)
+                    publish_messages(rows, 'message_updated')
                     return jsonify({'message': 'Messaggio aggiornato con successo'})
             
             return jsonify({'error': 'Errore nell\'aggiornamento del messaggio'}), 500
@@ -364,6 +536,8 @@ def manage_ticket_message(ticket_id, message_id):
             
             result = delete_from_supabase('ticket_messages', {'id': message_id, 'ticket_id': ticket_id})
             if result:
+                bump_messages_version(ticket_id)
+                publish_message_deleted(ticket_id, message_id)
                 return jsonify({'message': 'Messaggio eliminato con successo'})
             return jsonify({'error': 'Errore nell\'eliminazione del messaggio'}), 500
     
@@ -373,6 +547,7 @@ def manage_ticket_message(ticket_id, message_id):
 
 @app.route('/api/agents', methods=['GET'])
 @token_required
+@conditional_get('users')
 def api_agents():
     agents = AgentService.get_all()
     return jsonify(agents)
@@ -429,12 +604,61 @@ def manage_agent(agent_id):
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+def changes_response(service):
+    """
+    Risposta del feed delle modifiche (?since=<token>&limit=n): 400 per un
+    token non valido, 410 se è scaduto e il client deve ricaricare la lista.
+    """
+    from change_feed import ExpiredToken
+    
+    limit = request.args.get('limit', type=int)
+    try:
+        changes = service.get_changes(request.args.get('since') or None, limit)
+    except ExpiredToken as e:
+        return jsonify({'error': str(e), 'reset': True}), 410
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if changes is None:
+        return jsonify({'error': 'Errore nel recupero delle modifiche'}), 500
+    return jsonify(changes)
+
+@app.route('/api/tickets/changes', methods=['GET'])
+@token_required
+def api_tickets_changes():
+    """Ticket creati, modificati o eliminati dopo il token since"""
+    return changes_response(TicketService)
+
+@app.route('/api/customers/changes', methods=['GET'])
+@token_required
+def api_customers_changes():
+    """Clienti creati, modificati o eliminati dopo il token since"""
+    return changes_response(CustomerService)
+
 @app.route('/api/customers', methods=['GET', 'POST'])
 @token_required
+@conditional_get('customers')
 def api_customers():
     if request.method == 'GET':
-        customers = CustomerService.get_all()
-        return jsonify(customers)
+        query, error = parse_list_query(CUSTOMER_FILTER_FIELDS, CUSTOMER_SORT_FIELDS)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        if query['paginate']:
+            try:
+                customers, next_cursor = CustomerService.get_page(filters=query['filters'],
+                                                                  sort=query['sort'],
+                                                                  direction=query['direction'],
+                                                                  limit=query['limit'],
+                                                                  cursor=query['cursor'],
+                                                                  select=query['select'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'items': customers, 'next_cursor': next_cursor, 'limit': query['limit']})
+        
+        customers = CustomerService.get_all(filters=query['filters'],
+                                            order_by={query['sort']: query['direction'], 'id': query['direction']},
+                                            select=query['select'])
+        return json_array_response(customers)
     
     elif request.method == 'POST':
         data = request.json
@@ -484,10 +708,101 @@ def manage_customer(customer_id):
 
 @app.route('/api/stats')
 @token_required
+@conditional_get('tickets', 'customers', 'users')
 def api_stats():
     stats = get_stats()
     return jsonify(stats)
 
+@app.route('/api/system/cache', methods=['GET', 'DELETE'])
+@token_required
+def system_cache():
+    """Statistiche e svuotamento della cache delle query (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    from task_helper import get_query_cache_stats, clear_query_cache
+    
+    if request.method == 'DELETE':
+        # Dopo modifiche fatte fuori dall'applicazione: anche gli ETag delle risposte vanno rinnovati
+        clear_query_cache(request.args.get('table') or None)
+        table_versions.bump(request.args.get('table') or None)
+        return jsonify({'message': 'Cache svuotata'})
+    
+    return jsonify(get_query_cache_stats())
+
+@app.route('/api/email/queue', methods=['GET'])
+@token_required
+def email_queue_status():
+    """Stato della coda email e job recenti (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    stats = email_queue.stats()
+    stats['recent'] = email_queue.list_jobs(request.args.get('status'), limit)
+    
+    from smtp_pool import smtp_pool
+    stats['smtp_pool'] = smtp_pool.stats()
+    return jsonify(stats)
+
+@app.route('/api/email/queue/<int:job_id>', methods=['GET'])
+@token_required
+def email_queue_job(job_id):
+    """Stato di un singolo job email (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    job = email_queue.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    return jsonify(job)
+
+@app.route('/api/email/queue/<int:job_id>/retry', methods=['POST'])
+@token_required
+def email_queue_retry(job_id):
+    """Rimette in coda un job email fallito (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    if not email_queue.retry_job(job_id):
+        return jsonify({'error': 'Job non trovato o non in stato failed'}), 404
+    return jsonify({'message': 'Job rimesso in coda'})
+
+@app.route('/api/system/supabase-pool', methods=['GET'])
+@token_required
+def system_supabase_pool():
+    """Utilizzo del pool di connessioni HTTP verso Supabase (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    from storage_backends import get_storage_backend
+    from supabase_pool import get_pool_stats
+    
+    stats = get_pool_stats()
+    stats['storage_backend'] = get_storage_backend().name
+    return jsonify(stats)
+
+@app.route('/api/system/ticket-events', methods=['GET'])
+@token_required
+def system_ticket_events():
+    """Connessioni SSE aperte ed eventi pubblicati (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    return jsonify(ticket_events.stats())
+
+@app.route('/api/system/stats-counters', methods=['GET', 'POST'])
+@token_required
+def system_stats_counters():
+    """Stato dei contatori dashboard; POST forza la verifica col database (solo per admin)"""
+    if request.current_user['role'] not in ['admin', 'technical']:
+        return jsonify({'error': 'Accesso negato'}), 403
+    
+    if request.method == 'POST':
+        dashboard_counters.verify()
+    
+    return jsonify(dashboard_counters.info())
+
 # API di Autenticazione
 @app.route('/api/auth/register', methods=['POST'])
 def auth_register():
@@ -577,7 +892,7 @@ def approve_user(user_id):
     if user:
         # Invia email di attivazione
         try:
-            EmailService.send_user_activation_email(user)
+            email_queue.enqueue('user_activation', user)
         except Exception as e:
             print(f"Errore nell'invio email di attivazione: {e}")
         
@@ -644,8 +959,23 @@ def reports():
     return render_template('reports.html')
 
 # API Endpoints per configurazioni
+def save_config_options(table, options):
+    """
+    Sostituisce le opzioni attive di un menu a tendina: upsert su value ed
+    eliminazione delle opzioni rimosse, senza lasciare la tabella vuota.
+    """
+    from task_helper import replace_all
+    
+    rows = [{
+        'value': option['value'],
+        'label': option['label'],
+        'is_active': True
+    } for option in options]
+    return replace_all(table, rows, key='value', filters={'is_active': True})
+
 @app.route('/api/config/software', methods=['GET', 'POST'])
 @token_required
+@conditional_get('ticket_software_options')
 def config_software():
     """Gestisce le opzioni software"""
     try:
@@ -661,19 +991,9 @@ def config_software():
             return jsonify(options if options else [])
         
         elif request.method == 'POST':
-            # Salva nuove opzioni software
-            from task_helper import delete_from_supabase, save_to_supabase
-            
-            data = request.json
-            # Prima cancella tutte le opzioni esistenti
-            delete_from_supabase('ticket_software_options', {'is_active': True})
-            # Inserisci le nuove opzioni
-            for option in data:
-                save_to_supabase('ticket_software_options', {
-                    'value': option['value'],
-                    'label': option['label'],
-                    'is_active': True
-                })
+            # Salva nuove opzioni software (sostituzione in blocco)
+            if save_config_options('ticket_software_options', request.json) is None:
+                return jsonify({'error': 'Errore nel salvataggio della configurazione'}), 500
             return jsonify({'message': 'Configurazione software salvata'})
     
     except Exception as e:
@@ -690,6 +1010,7 @@ def config_software():
 
 @app.route('/api/config/groups', methods=['GET', 'POST'])
 @token_required
+@conditional_get('ticket_group_options')
 def config_groups():
     """Gestisce le opzioni gruppi"""
     try:
@@ -704,16 +1025,8 @@ def config_groups():
             return jsonify(options if options else [])
         
         elif request.method == 'POST':
-            from task_helper import delete_from_supabase, save_to_supabase
-            
-            data = request.json
-            delete_from_supabase('ticket_group_options', {'is_active': True})
-            for option in data:
-                save_to_supabase('ticket_group_options', {
-                    'value': option['value'],
-                    'label': option['label'],
-                    'is_active': True
-                })
+            if save_config_options('ticket_group_options', request.json) is None:
+                return jsonify({'error': 'Errore nel salvataggio della configurazione'}), 500
             return jsonify({'message': 'Configurazione gruppi salvata'})
     
     except Exception as e:
@@ -729,6 +1042,7 @@ def config_groups():
 
 @app.route('/api/config/types', methods=['GET', 'POST'])
 @token_required
+@conditional_get('ticket_type_options')
 def config_types():
     """Gestisce le opzioni tipi"""
     try:
@@ -743,16 +1057,8 @@ def config_types():
             return jsonify(options if options else [])
         
         elif request.method == 'POST':
-            from task_helper import delete_from_supabase, save_to_supabase
-            
-            data = request.json
-            delete_from_supabase('ticket_type_options', {'is_active': True})
-            for option in data:
-                save_to_supabase('ticket_type_options', {
-                    'value': option['value'],
-                    'label': option['label'],
-                    'is_active': True
-                })
+            if save_config_options('ticket_type_options', request.json) is None:
+                return jsonify({'error': 'Errore nel salvataggio della configurazione'}), 500
             return jsonify({'message': 'Configurazione tipi salvata'})
     
     except Exception as e:
@@ -770,6 +1076,7 @@ def config_types():
 
 @app.route('/api/config/system', methods=['GET', 'POST'])
 @token_required
+@conditional_get('system_settings')
 def config_system():
     """Gestisce le impostazioni di sistema"""
     try:
@@ -783,14 +1090,13 @@ def config_system():
             return jsonify(settings)
         
         elif request.method == 'POST':
-            from task_helper import save_to_supabase
+            from task_helper import save_many
             
+            # Tutte le impostazioni in un unico upsert
             data = request.json
-            for key, value in data.items():
-                save_to_supabase('system_settings', {
-                    'key': key,
-                    'value': str(value)
-                }, on_conflict='key')
+            rows = [{'key': key, 'value': str(value)} for key, value in data.items()]
+            if save_many('system_settings', rows, on_conflict='key') is None:
+                return jsonify({'error': 'Errore nel salvataggio delle impostazioni'}), 500
             return jsonify({'message': 'Impostazioni sistema salvate'})
     
     except Exception as e:
@@ -841,9 +1147,9 @@ def email_imap_config():
         data = request.json
         success = EmailService.save_imap_config(data)
         if success:
-            # Riavvia il monitor email se il controllo automatico è abilitato
+            # Avvia il monitor email se il controllo automatico è abilitato
+            # (se è già attivo si riconnette da solo quando la configurazione cambia)
             if data.get('auto_check', 0) > 0:
-                email_monitor.stop()
                 email_monitor.start()
             else:
                 email_monitor.stop()
@@ -877,35 +1183,11 @@ def email_status():
     """Restituisce lo status delle configurazioni email"""
     print("🚨 EMAIL STATUS ENDPOINT CALLED!")
     try:
-        import json
-        
-        
         print(f"🔍 Status check - getting email configurations...")
         
-        # Recupera direttamente dal database Supabase via MCP
-        from task_helper import get_from_supabase
-        
-        smtp_result = get_from_supabase('email_settings', {'type': 'smtp'})
-        imap_result = get_from_supabase('email_settings', {'type': 'imap'})
-        
-        print(f"📧 SMTP result: {len(smtp_result) if smtp_result else 0} records")
-        print(f"📬 IMAP result: {len(imap_result) if imap_result else 0} records")
-        
-        # Parse SMTP config
-        smtp_config = None
-        if smtp_result and len(smtp_result) > 0:
-            config_data = smtp_result[0]
-            if config_data.get('config'):
-                smtp_config = json.loads(config_data['config'])
-                print(f"📧 SMTP config parsed: {bool(smtp_config)}")
-        
-        # Parse IMAP config  
-        imap_config = None
-        if imap_result and len(imap_result) > 0:
-            config_data = imap_result[0]
-            if config_data.get('config'):
-                imap_config = json.loads(config_data['config'])
-                print(f"📬 IMAP config parsed: {bool(imap_config)}")
+        # Configurazioni dalla copia in memoria di EmailService (nessuna query se aggiornate)
+        smtp_config = EmailService.get_smtp_config()
+        imap_config = EmailService.get_imap_config()
         
         # Verifica se le configurazioni sono complete
         smtp_configured = bool(smtp_config and 
@@ -955,6 +1237,7 @@ def email_status():
 
 @app.route('/api/email/templates', methods=['GET', 'POST'])
 @token_required
+@conditional_get('email_templates')
 def email_templates():
     """Gestisce i template email"""
     if request.method == 'GET':
@@ -1028,7 +1311,7 @@ def check_emails_now():
 @token_required
 def email_monitor_status():
     """Stato del monitor email"""
-    return jsonify({'running': email_monitor.running})
+    return jsonify({'running': email_monitor.running, 'mode': email_monitor.mode})
 
 @app.route('/api/email/monitor/start', methods=['POST'])
 @token_required
@@ -1070,17 +1353,15 @@ def reports_kpi():
         start_date = end_date - timedelta(days=period)
         
         # Usa MCP per le statistiche
-        from task_helper import count_in_supabase, get_from_supabase
+        from task_helper import count_in_supabase, gather
         
-        # Ticket totali nel periodo (approssimativo via get + filter)
-        all_tickets = get_from_supabase('tickets', select='id, created_at') or []
-        total_tickets_count = len([t for t in all_tickets if t.get('created_at', '') >= start_date.isoformat()])
-        
-        # Ticket risolti nel periodo
-        resolved_tickets_count = len([t for t in all_tickets if t.get('created_at', '') >= start_date.isoformat() and 'Closed' in str(t)])
-        
-        # Clienti attivi 
-        active_customers_count = count_in_supabase('customers', {'status': 'Active'})
+        # Ticket totali e risolti nel periodo, clienti attivi (count in parallelo)
+        period_filter = {'created_at': ('gte', start_date.isoformat())}
+        total_tickets_count, resolved_tickets_count, active_customers_count = gather(
+            (count_in_supabase, 'tickets', period_filter),
+            (count_in_supabase, 'tickets', {**period_filter, 'status': ('in', ['Resolved', 'Closed'])}),
+            (count_in_supabase, 'customers', {'status': 'Active'})
+        )
         
         # Calcola metriche
         total_count = total_tickets_count
@@ -1289,9 +1570,9 @@ def customer_tickets():
             
             new_ticket = TicketService.create(ticket_data)
             if new_ticket:
-                # Invia notifica email per nuovo ticket
+                # Accoda la notifica email per nuovo ticket
                 try:
-                    EmailService.send_new_ticket_notification(new_ticket)
+                    email_queue.enqueue('new_ticket', new_ticket)
                 except Exception as e:
                     print(f"Errore nell'invio notifica email: {e}")
                 
@@ -1311,22 +1592,18 @@ def customer_ticket_detail(ticket_id):
         customer_id = request.current_customer['customer_id']
         
         # Verifica che il ticket appartenga al cliente
-        from task_helper import get_from_supabase
+        # (ticket e messaggi letti in parallelo; i messaggi si scartano se il ticket non è suo)
+        from task_helper import get_from_supabase, gather
         
-        tickets = get_from_supabase('tickets', 
-                                  filters={'id': ticket_id, 'customer_id': customer_id})
+        tickets, messages = gather(
+            (get_from_supabase, 'tickets', {'id': ticket_id, 'customer_id': customer_id}),
+            (get_from_supabase, 'ticket_messages', {'ticket_id': ticket_id}, '*', {'created_at': 'asc'})
+        )
         
         if not tickets:
             return jsonify({'error': 'Ticket non trovato'}), 404
         
         ticket = tickets[0]
-        
-        # Recupera anche i messaggi del ticket
-        messages = get_from_supabase('ticket_messages', 
-                                   filters={'ticket_id': ticket_id},
-                                   select='*',
-                                   order_by={'created_at': 'asc'})
-        
         ticket['messages'] = messages if messages else []
         
         return jsonify(ticket)
@@ -1343,7 +1620,23 @@ def customer_ticket_messages(ticket_id):
         customer_id = request.current_customer['customer_id']
         
         # Verifica che il ticket appartenga al cliente
-        from task_helper import get_from_supabase, save_to_supabase
+        from task_helper import get_from_supabase, save_to_supabase, gather
+        
+        if request.method == 'GET':
+            # Recupera SOLO i messaggi (i nuovi con since_id/since) - API veloce per refresh;
+            # ticket e messaggi letti in parallelo, i messaggi si scartano se il ticket non è suo
+            try:
+                filters, order_by, since_id = parse_messages_delta()
+            except ValueError:
+                return jsonify({'error': 'Parametro since o since_id non valido'}), 400
+            
+            tickets, messages = gather(
+                (get_from_supabase, 'tickets', {'id': ticket_id, 'customer_id': customer_id}, 'id'),
+                (get_from_supabase, 'ticket_messages', {'ticket_id': ticket_id, **filters}, '*', order_by)
+            )
+            if not tickets:
+                return jsonify({'error': 'Ticket non trovato'}), 404
+            return messages_response(ticket_id, messages, since_id)
         
         tickets = get_from_supabase('tickets', 
                                   filters={'id': ticket_id, 'customer_id': customer_id})
@@ -1351,15 +1644,7 @@ def customer_ticket_messages(ticket_id):
         if not tickets:
             return jsonify({'error': 'Ticket non trovato'}), 404
         
-        if request.method == 'GET':
-            # Recupera SOLO i messaggi - API veloce per refresh
-            messages = get_from_supabase('ticket_messages', 
-                                       filters={'ticket_id': ticket_id},
-                                       select='*',
-                                       order_by={'created_at': 'asc'})
-            return jsonify(messages if messages else [])
-        
-        elif request.method == 'POST':
+        if request.method == 'POST':
             # Aggiunge nuovo messaggio
             data = request.json
             message_data = {
@@ -1374,10 +1659,13 @@ def customer_ticket_messages(ticket_id):
             result = save_to_supabase('ticket_messages', message_data)
             
             if result:
+                new_message = result[0] if isinstance(result, list) else result
+                publish_messages([new_message])
+                
                 # Invia notifica agli agenti
                 ticket = tickets[0]
                 try:
-                    EmailService.send_ticket_message_to_agents(ticket, result[0] if isinstance(result, list) else result)
+                    email_queue.enqueue('message_to_agents', ticket, new_message)
                 except Exception as e:
                     print(f"Errore nell'invio notifica agenti: {e}")
                 
@@ -1389,6 +1677,37 @@ def customer_ticket_messages(ticket_id):
         print(f"Errore gestione messaggi cliente: {e}")
         return jsonify({'error': 'Errore nell\'operazione'}), 500
 
+def customer_event(event, data):
+    """Filtro degli eventi per il cliente: niente messaggi interni"""
+    if not data.get('is_internal'):
+        return True
+    if event == 'message_updated':
+        # Un messaggio diventato interno sparisce dalla chat del cliente
+        return 'message_deleted', {'id': data.get('id'), 'ticket_id': data.get('ticket_id')}
+    return False
+
+@app.route('/api/customer/tickets/<int:ticket_id>/events', methods=['GET'])
+@customer_token_required
+def customer_ticket_events_stream(ticket_id):
+    """Stream SSE dei nuovi messaggi di un ticket del cliente (senza messaggi interni)"""
+    try:
+        customer_id = request.current_customer['customer_id']
+        
+        # La proprietà del ticket si verifica una sola volta, all'apertura dello stream
+        from task_helper import get_from_supabase
+        
+        tickets = get_from_supabase('tickets', 
+                                  filters={'id': ticket_id, 'customer_id': customer_id},
+                                  select='id')
+        if not tickets:
+            return jsonify({'error': 'Ticket non trovato'}), 404
+    except Exception as e:
+        print(f"Errore apertura stream cliente: {e}")
+        return jsonify({'error': 'Errore nell\'operazione'}), 500
+    
+    subscription = ticket_events.subscribe(ticket_id, request.headers.get('Last-Event-ID'))
+    return sse_response(subscription, accept=customer_event)
+
 # Health check endpoint
 @app.route('/health')
 def health_check():
@@ -1411,6 +1730,9 @@ if __name__ == '__main__':
     init_db()
     # Crea l'admin predefinito se non esiste
     UserService.create_admin_if_not_exists()
-    # Avvia il monitor email
+    # Avvia il monitor email e la coda delle notifiche
     email_monitor.start()
+    email_queue.start()
+    # Costruisce i contatori della dashboard in background
+    dashboard_counters.start()
     app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
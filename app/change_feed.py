@@ -0,0 +1,141 @@
+"""
+Feed delle modifiche di una tabella (ticket, clienti) per tenere aggiornata
+una copia locale senza ricaricare la lista completa.
+
+Il token restituito al client contiene due cursori keyset:
+- (updated_at, id) delle righe create o modificate, letti con l'indice su
+  (updated_at, id);
+- (deleted_at, id) del registro delle eliminazioni (deleted_records,
+  scritto da un trigger del database).
+
+Il token avanza solo in avanti. Per non perdere le scritture il cui
+updated_at precede il commit (transazioni concorrenti), o che cadono nello
+stesso istante, a fine feed il token non supera "adesso meno
+CHANGES_SETTLE_SECONDS": le righe più recenti vengono rimandate alla
+richiesta successiva (il client le applica per id, quindi i doppioni non
+fanno danni). Un token più vecchio di CHANGES_RETENTION_DAYS non è più
+utilizzabile perché il registro delle eliminazioni viene ripulito: il
+client deve ricaricare la lista.
+"""
+import base64
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from task_helper import get_page_from_supabase, encode_cursor, decode_cursor, gather
+
+# Margine (secondi) entro cui una modifica viene rimandata anche alla richiesta successiva
+CHANGES_SETTLE_SECONDS = int(os.getenv('CHANGES_SETTLE_SECONDS', '5'))
+# Giorni di conservazione del registro delle eliminazioni
+CHANGES_RETENTION_DAYS = int(os.getenv('CHANGES_RETENTION_DAYS', '30'))
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_PAGE_SIZE = 2000
+
+DELETED_TABLE = 'deleted_records'
+
+
+class ExpiredToken(ValueError):
+    """Token oltre il periodo di conservazione: serve un ricaricamento completo"""
+
+
+def _parse_timestamp(value):
+    """Timestamp del database (ISO Postgres o 'YYYY-MM-DD HH:MM:SS' SQLite) in UTC"""
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _format_timestamp(moment):
+    """Timestamp UTC confrontabile sia da Postgres sia come testo in SQLite"""
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def encode_token(rows_cursor, deleted_cursor):
+    """Token opaco con le posizioni dei due cursori keyset"""
+    raw = json.dumps([*decode_cursor(rows_cursor, 'updated_at', 'asc'),
+                      *decode_cursor(deleted_cursor, 'deleted_at', 'asc')], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """(cursore righe, cursore eliminazioni); ValueError se il token non è valido"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        rows_value, rows_id, deleted_value, deleted_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        oldest = _parse_timestamp(rows_value)
+        _parse_timestamp(deleted_value)
+        rows_cursor = encode_cursor('updated_at', 'asc', rows_value, int(rows_id))
+        deleted_cursor = encode_cursor('deleted_at', 'asc', deleted_value, int(deleted_id))
+    except Exception:
+        raise ValueError("Token non valido")
+    if oldest < datetime.now(timezone.utc) - timedelta(days=CHANGES_RETENTION_DAYS):
+        raise ExpiredToken("Token scaduto: ricaricare la lista completa")
+    return rows_cursor, deleted_cursor
+
+
+def initial_token():
+    """Token da cui partire (da chiedere prima di caricare la lista completa)"""
+    settled = _format_timestamp(datetime.now(timezone.utc) - timedelta(seconds=CHANGES_SETTLE_SECONDS))
+    return encode_token(encode_cursor('updated_at', 'asc', settled, 0),
+                        encode_cursor('deleted_at', 'asc', settled, 0))
+
+
+def _advance(table, filters, select, sort, cursor, limit):
+    """
+    Una pagina dopo il cursore: (righe, cursore successivo, altre pagine).
+    None se la lettura non riesce.
+    """
+    rows, next_cursor = get_page_from_supabase(table, filters=filters, select=select, sort=sort,
+                                               direction='asc', limit=limit, cursor=cursor)
+    if rows is None:
+        return None
+    if next_cursor:
+        return rows, next_cursor, True
+    if not rows:
+        return rows, cursor, False
+
+    # Ultima pagina: il cursore non va oltre il margine di assestamento
+    last = rows[-1]
+    settled_at = datetime.now(timezone.utc) - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    if _parse_timestamp(last[sort]) <= settled_at:
+        return rows, encode_cursor(sort, 'asc', last[sort], last['id']), False
+    current_value, _ = decode_cursor(cursor, sort, 'asc')
+    if _parse_timestamp(current_value) >= settled_at:
+        return rows, cursor, False
+    return rows, encode_cursor(sort, 'asc', _format_timestamp(settled_at), 0), False
+
+
+def get_changes(table, token=None, limit=CHANGES_PAGE_SIZE, select='*'):
+    """
+    Modifiche di table dopo il token:
+    {'changed': righe create o modificate, 'deleted': id eliminati,
+     'token': token successivo, 'has_more': True se conviene richiedere subito}.
+    Senza token restituisce solo il token iniziale. Solleva ValueError
+    (ExpiredToken) se il token non è valido; None se il database non risponde.
+    """
+    if not token:
+        return {'changed': [], 'deleted': [], 'token': initial_token(), 'has_more': False}
+
+    rows_cursor, deleted_cursor = decode_token(token)
+    limit = max(1, min(int(limit), CHANGES_MAX_PAGE_SIZE))
+
+    # Righe modificate ed eliminazioni lette in parallelo
+    changed, deleted = gather(
+        # Le righe senza updated_at non sono mai state modificate dopo il caricamento
+        (_advance, table, {'updated_at': ('not_is', None)}, select, 'updated_at', rows_cursor, limit),
+        (_advance, DELETED_TABLE, {'table_name': table}, 'id, record_id, deleted_at',
+         'deleted_at', deleted_cursor, limit)
+    )
+    if changed is None or deleted is None:
+        return None
+
+    rows, rows_cursor, more_rows = changed
+    tombstones, deleted_cursor, more_deleted = deleted
+    deleted_ids = list(dict.fromkeys(row['record_id'] for row in tombstones))
+    # Una riga eliminata dopo la modifica non va restituita come modificata
+    gone = set(deleted_ids)
+    return {
+        'changed': [row for row in rows if row.get('id') not in gone],
+        'deleted': deleted_ids,
+        'token': encode_token(rows_cursor, deleted_cursor),
+        'has_more': more_rows or more_deleted
+    }
@@ -0,0 +1,211 @@
+"""
+Indice dei clienti per email normalizzata (minuscole, senza spazi).
+
+La mappa email -> cliente è tenuta in memoria e aggiornata dalle scritture
+sulla tabella customers fatte tramite task_helper; viene ricostruita quando
+una scrittura è ambigua o dopo CUSTOMER_INDEX_TTL secondi. Le email che non
+sono in memoria vengono sempre confermate sul database (colonna indicizzata
+email_normalized), così i clienti creati da altri processi non vengono
+duplicati.
+"""
+import os
+import threading
+import time
+from email.utils import parseaddr
+
+from task_helper import get_from_supabase, register_write_listener, IDS_CHUNK_SIZE
+
+# Secondi dopo i quali l'indice viene ricostruito dal database
+CUSTOMER_INDEX_TTL = int(os.getenv('CUSTOMER_INDEX_TTL', '600'))
+
+# Righe lette per pagina durante la ricostruzione
+INDEX_PAGE_SIZE = 1000
+INDEX_COLUMNS = ('id', 'name', 'email', 'status')
+
+
+def normalize_email(value):
+    """Email in forma canonica per il confronto ('Mario <A@B.it> ' -> 'a@b.it')"""
+    if not value:
+        return ''
+    value = str(value)
+    address = parseaddr(value)[1] or value
+    return address.strip().lower()
+
+
+def _entry(row):
+    return {column: row.get(column) for column in INDEX_COLUMNS}
+
+
+class CustomerEmailIndex:
+    """Mappa email normalizzata -> cliente (id, nome, email, stato)"""
+
+    def __init__(self, ttl=CUSTOMER_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._by_email = {}
+        self._email_by_id = {}
+        self._ready = False
+        self._stale = False
+        self._building = False
+        self._loaded_at = None
+
+    def _add_locked(self, row):
+        record_id = row.get('id')
+        self._remove_locked(record_id)
+        key = normalize_email(row.get('email'))
+        if not key:
+            return
+        self._email_by_id[record_id] = key
+        current = self._by_email.get(key)
+        # Con email duplicate prevale il cliente più recente, come nella vecchia ricerca
+        if current is None or current['id'] is None or (record_id is not None and record_id >= current['id']):
+            self._by_email[key] = _entry(row)
+
+    def _remove_locked(self, record_id):
+        key = self._email_by_id.pop(record_id, None)
+        if key is not None and self._by_email.get(key, {}).get('id') == record_id:
+            # Un eventuale duplicato verrà ritrovato dalla conferma sul database
+            del self._by_email[key]
+
+    def on_write(self, operation, table, rows, filters=None):
+        """Aggiorna la mappa dopo una scrittura sui clienti (listener di task_helper)"""
+        if table != 'customers':
+            return
+        with self._lock:
+            if self._building:
+                self._stale = True
+            if not self._ready:
+                return
+            if not rows:
+                self._stale = True
+                return
+            for row in rows:
+                record_id = row.get('id')
+                if record_id is None:
+                    self._stale = True
+                elif operation == 'delete':
+                    self._remove_locked(record_id)
+                elif 'email' in row:
+                    self._add_locked(row)
+                else:
+                    # Aggiornamento parziale: si conservano l'email e i campi non restituiti
+                    key = self._email_by_id.get(record_id)
+                    current = self._by_email.get(key) if key else None
+                    if current and current['id'] == record_id:
+                        current.update({k: row[k] for k in INDEX_COLUMNS if k in row})
+                    else:
+                        self._stale = True
+
+    def rebuild(self):
+        """Ricostruisce la mappa leggendo i clienti a pagine (keyset su id)"""
+        with self._lock:
+            self._building = True
+            self._stale = False
+        try:
+            by_email, email_by_id = {}, {}
+            last_id = None
+            while True:
+                filters = {'id': ('gt', last_id)} if last_id is not None else None
+                rows = get_from_supabase('customers', filters, select=', '.join(INDEX_COLUMNS),
+                                         order_by='id', limit=INDEX_PAGE_SIZE, use_cache=False)
+                if rows is None:
+                    return False
+                for row in rows:
+                    key = normalize_email(row.get('email'))
+                    if key:
+                        # Ordine per id crescente: l'ultimo duplicato è il più recente
+                        by_email[key] = _entry(row)
+                        email_by_id[row['id']] = key
+                if len(rows) < INDEX_PAGE_SIZE:
+                    break
+                last_id = rows[-1]['id']
+
+            with self._lock:
+                self._by_email = by_email
+                self._email_by_id = email_by_id
+                self._ready = True
+                self._loaded_at = time.monotonic()
+            print(f"Indice email clienti costruito ({len(by_email)} email)")
+            return True
+        except Exception as e:
+            print(f"Errore costruzione indice email clienti: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._building = False
+
+    def _ensure_fresh(self):
+        with self._lock:
+            fresh = (self._ready and not self._stale
+                     and time.monotonic() - self._loaded_at < self.ttl)
+        if fresh:
+            return
+        # Un solo thread ricostruisce; gli altri usano la mappa attuale o il database
+        if self._build_lock.acquire(blocking=False):
+            try:
+                self.rebuild()
+            finally:
+                self._build_lock.release()
+
+    def _query(self, keys):
+        """Clienti con le email indicate, direttamente dal database"""
+        select = ', '.join(INDEX_COLUMNS)
+        rows = []
+        for start in range(0, len(keys), IDS_CHUNK_SIZE):
+            chunk = keys[start:start + IDS_CHUNK_SIZE]
+            found = get_from_supabase('customers', {'email_normalized': ('in', chunk)},
+                                      select=select, order_by='id', use_cache=False)
+            if found is None:
+                # Colonna email_normalized non ancora migrata: confronto esatto
+                found = get_from_supabase('customers', {'email': ('in', chunk)},
+                                          select=select, order_by='id', use_cache=False)
+            if found is None:
+                return None
+            rows.extend(found)
+        return rows
+
+    def lookup_many(self, emails):
+        """
+        {email normalizzata: cliente} per le email indicate che corrispondono a
+        un cliente. None se il database non risponde.
+        """
+        keys = {normalize_email(value) for value in emails or []}
+        keys.discard('')
+        if not keys:
+            return {}
+
+        self._ensure_fresh()
+        with self._lock:
+            found = {key: dict(self._by_email[key]) for key in keys if key in self._by_email}
+
+        missing = sorted(keys - set(found))
+        if missing:
+            rows = self._query(missing)
+            if rows is None:
+                return None
+            with self._lock:
+                for row in rows:
+                    if self._ready:
+                        self._add_locked(row)
+                    found[normalize_email(row.get('email'))] = _entry(row)
+        return found
+
+    def lookup(self, email):
+        found = self.lookup_many([email])
+        return found.get(normalize_email(email)) if found else None
+
+    def info(self):
+        """Stato dell'indice (per diagnostica)"""
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'stale': self._stale,
+                'emails': len(self._by_email),
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None
+            }
+
+
+# Istanza globale dell'indice
+customer_email_index = CustomerEmailIndex()
+register_write_listener(customer_email_index.on_write)
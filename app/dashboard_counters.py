@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+from collections import Counter
+from functools import partial
+
+from task_helper import get_from_supabase, count_in_supabase, register_write_listener, gather
+from table_versions import table_versions
+
+# Tabelle i cui contatori per stato alimentano la dashboard
+TRACKED_TABLES = ('tickets', 'customers', 'users')
+
+# Intervallo (secondi) della verifica periodica contro il database
+STATS_RESYNC_INTERVAL = int(os.getenv("STATS_RESYNC_INTERVAL", "300"))
+
+# Righe lette per pagina durante la ricostruzione completa
+REBUILD_PAGE_SIZE = 1000
+REBUILD_TIMEOUT = 300
+
+
+def count_stats(use_cache=True):
+    """Statistiche dalle count sul database, eseguite in parallelo"""
+    count = partial(count_in_supabase, use_cache=use_cache)
+    (total_tickets, open_tickets, closed_tickets,
+     total_agents, total_customers, active_customers) = gather(
+        (count, 'tickets'),
+        (count, 'tickets', {'status': 'Open'}),
+        (count, 'tickets', {'status': 'Closed'}),
+        (count, 'users', {'status': 'approved'}),
+        (count, 'customers'),
+        (count, 'customers', {'status': 'Active'})
+    )
+    return {
+        'total_tickets': total_tickets,
+        'open_tickets': open_tickets,
+        'closed_tickets': closed_tickets,
+        'total_agents': total_agents,
+        'total_customers': total_customers,
+        'active_customers': active_customers
+    }
+
+
+class DashboardCounters:
+    """
+    Contatori della dashboard mantenuti in memoria.
+
+    Per ogni tabella tracciata conserva la mappa id -> stato e i totali per stato:
+    le scritture fatte tramite task_helper aggiornano i totali per differenza,
+    così get_stats non interroga il database. Un thread verifica periodicamente
+    i totali con le count e ricostruisce le mappe se divergono (scritture esterne).
+    """
+
+    def __init__(self, resync_interval=STATS_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._lock = threading.Lock()
+        self._status_by_id = {table: {} for table in TRACKED_TABLES}
+        self._counts = {table: Counter() for table in TRACKED_TABLES}
+        self._ready = False
+        self._stale = False
+        self._building = False
+        self._last_sync = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Avvia la costruzione iniziale e il thread di verifica"""
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._resync_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ferma il thread di verifica"""
+        self.running = False
+
+    def on_write(self, operation, table, rows, filters=None):
+        """Applica le differenze di una scrittura (listener di task_helper)"""
+        if table not in self._status_by_id:
+            return
+        with self._lock:
+            if self._building:
+                # La ricostruzione in corso potrebbe non vedere questa scrittura
+                self._stale = True
+            if not self._ready:
+                return
+            if not rows:
+                # Nessuna riga restituita: non sappiamo cosa sia cambiato
+                self._stale = True
+                return
+            statuses = self._status_by_id[table]
+            counts = self._counts[table]
+            for row in rows:
+                record_id = row.get('id')
+                if record_id is None:
+                    self._stale = True
+                    continue
+                if record_id in statuses:
+                    counts[statuses[record_id]] -= 1
+                    if operation == 'delete':
+                        del statuses[record_id]
+                        continue
+                elif operation == 'delete':
+                    continue
+                status = row.get('status', statuses.get(record_id))
+                statuses[record_id] = status
+                counts[status] += 1
+
+    def get_stats(self):
+        """
+        Statistiche dalla memoria; None se i contatori non sono ancora pronti
+        (in tal caso avvia la costruzione in background).
+        """
+        with self._lock:
+            ready = self._ready
+            if ready:
+                stats = self._stats_locked()
+        if not ready:
+            self.start()
+            return None
+        return stats
+
+    def _stats_locked(self):
+        tickets = self._counts['tickets']
+        customers = self._counts['customers']
+        return {
+            'total_tickets': len(self._status_by_id['tickets']),
+            'open_tickets': tickets['Open'],
+            'closed_tickets': tickets['Closed'],
+            'total_agents': self._counts['users']['approved'],
+            'total_customers': len(self._status_by_id['customers']),
+            'active_customers': customers['Active']
+        }
+
+    def rebuild(self):
+        """Ricostruisce le mappe leggendo id e stato a pagine (keyset su id)"""
+        with self._lock:
+            if self._building:
+                return False
+            self._building = True
+        try:
+            loaded = gather(*[(self._load_statuses, table) for table in TRACKED_TABLES],
+                            timeout=REBUILD_TIMEOUT)
+            if any(statuses is None for statuses in loaded):
+                return False
+            maps = dict(zip(TRACKED_TABLES, loaded))
+
+            with self._lock:
+                self._status_by_id = maps
+                self._counts = {table: Counter(maps[table].values()) for table in TRACKED_TABLES}
+                self._ready = True
+                self._last_sync = time.time()
+            # Una ricostruzione segue scritture non viste dai listener: cambiano gli ETag
+            for table in TRACKED_TABLES:
+                table_versions.bump(table)
+            print("Contatori dashboard ricostruiti")
+            return True
+        except Exception as e:
+            print(f"Errore ricostruzione contatori dashboard: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._building = False
+
+    def _load_statuses(self, table):
+        statuses = {}
+        last_id = None
+        while True:
+            filters = {'id': ('gt', last_id)} if last_id is not None else None
+            rows = get_from_supabase(table, filters, select='id, status', order_by='id',
+                                     limit=REBUILD_PAGE_SIZE, use_cache=False)
+            if rows is None:
+                return None
+            for row in rows:
+                statuses[row['id']] = row.get('status')
+            if len(rows) < REBUILD_PAGE_SIZE:
+                return statuses
+            last_id = rows[-1]['id']
+
+    def verify(self):
+        """
+        Confronta i totali in memoria con le count del database
+        e ricostruisce le mappe se divergono.
+        """
+        with self._lock:
+            self._stale = False
+            needs_rebuild = not self._ready
+            if not needs_rebuild:
+                expected = self._stats_locked()
+
+        if not needs_rebuild:
+            actual = count_stats(use_cache=False)
+            if actual == expected:
+                with self._lock:
+                    self._last_sync = time.time()
+                return True
+            print("Contatori dashboard non allineati, ricostruzione")
+
+        return self.rebuild()
+
+    def _resync_loop(self):
+        """Costruzione iniziale e verifica periodica"""
+        while self.running:
+            try:
+                self.verify()
+            except Exception as e:
+                print(f"Errore verifica contatori dashboard: {e}")
+            # Attesa frazionata: una scrittura ambigua anticipa la verifica
+            waited = 0
+            while self.running and waited < self.resync_interval:
+                time.sleep(1)
+                waited += 1
+                with self._lock:
+                    if self._ready and self._stale:
+                        break
+
+    def info(self):
+        """Stato dei contatori (per diagnostica)"""
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'stale': self._stale,
+                'last_sync': self._last_sync,
+                'tracked_rows': {table: len(m) for table, m in self._status_by_id.items()}
+            }
+
+
+# Istanza globale dei contatori
+dashboard_counters = DashboardCounters()
+register_write_listener(dashboard_counters.on_write)
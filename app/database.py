@@ -15,8 +15,9 @@ SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 # Chiave segreta per JWT
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-here-change-in-production")
 
-# Crea il client Supabase
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Crea il client Supabase (solo se è il backend di storage in uso, vedi storage_backends)
+from storage_backends import STORAGE_BACKEND
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY) if STORAGE_BACKEND == 'supabase' else None
 
 async def init_supabase_tables():
     """Inizializza le tabelle in Supabase se non esistono"""
@@ -37,19 +38,64 @@ async def init_supabase_tables():
 # Funzioni CRUD per Tickets
 class TicketService:
     @staticmethod
-    def get_all():
-        """Recupera tutti i ticket"""
+    def get_all(filters=None, order_by=None, select='*'):
+        """Recupera tutti i ticket (opzionalmente filtrati e ordinati lato database)"""
         try:
             from task_helper import get_from_supabase
             
             tickets = get_from_supabase('tickets', 
-                                      select='*',
-                                      order_by={'created_at': 'desc'})
+                                      filters=filters,
+                                      select=select,
+                                      order_by=order_by or {'created_at': 'desc'})
             return tickets if tickets else []
         except Exception as e:
             print(f"Errore nel recupero ticket: {e}")
             return []
     
+    @staticmethod
+    def get_page(filters=None, sort='created_at', direction='desc', limit=50, cursor=None, select='*'):
+        """Recupera una pagina di ticket con paginazione keyset su (sort, id)"""
+        try:
+            from task_helper import get_page_from_supabase
+            
+            tickets, next_cursor = get_page_from_supabase('tickets',
+                                                          filters=filters,
+                                                          select=select,
+                                                          sort=sort,
+                                                          direction=direction,
+                                                          limit=limit,
+                                                          cursor=cursor)
+            return tickets if tickets else [], next_cursor
+        except ValueError:
+            # Cursore non valido: lo gestisce il chiamante (400)
+            raise
+        except Exception as e:
+            print(f"Errore nel recupero pagina ticket: {e}")
+            return [], None
+    
+    @staticmethod
+    def get_by_id(ticket_id, select='*'):
+        """Recupera un singolo ticket per ID"""
+        try:
+            from task_helper import get_by_id_from_supabase
+            
+            return get_by_id_from_supabase('tickets', ticket_id, select=select)
+        except Exception as e:
+            print(f"Errore nel recupero ticket {ticket_id}: {e}")
+            return None
+    
+    @staticmethod
+    def get_many_by_ids(ticket_ids, select='*'):
+        """Recupera più ticket per ID con un'unica query"""
+        try:
+            from task_helper import get_many_by_ids_from_supabase
+            
+            tickets = get_many_by_ids_from_supabase('tickets', ticket_ids, select=select)
+            return tickets if tickets else []
+        except Exception as e:
+            print(f"Errore nel recupero ticket multipli: {e}")
+            return []
+    
     @staticmethod
     def create(ticket_data):
         """Crea un nuovo ticket"""
@@ -80,9 +126,26 @@ class TicketService:
             print(f"Errore nell'aggiornamento ticket: {e}")
             return None
     
+    @staticmethod
+    def get_changes(token=None, limit=None, select='*'):
+        """
+        Ticket creati, modificati o eliminati dopo il token (vedi change_feed).
+        Solleva ValueError se il token non è valido; None in caso di errore.
+        """
+        try:
+            from change_feed import get_changes, CHANGES_PAGE_SIZE
+            
+            return get_changes('tickets', token, limit or CHANGES_PAGE_SIZE, select)
+        except ValueError:
+            # Token non valido o scaduto: lo gestisce il chiamante
+            raise
+        except Exception as e:
+            print(f"Errore nel recupero modifiche ticket: {e}")
+            return None
+    
     @staticmethod
     def delete(ticket_id):
-        """Elimina un ticket"""
+        """Elimina un ticket (il trigger del database lo registra in deleted_records)"""
         try:
             from task_helper import delete_from_supabase
             
@@ -95,19 +158,41 @@ class TicketService:
 # Funzioni CRUD per Customers
 class CustomerService:
     @staticmethod
-    def get_all():
-        """Recupera tutti i clienti"""
+    def get_all(filters=None, order_by=None, select='*'):
+        """Recupera tutti i clienti (opzionalmente filtrati e ordinati lato database)"""
         try:
             from task_helper import get_from_supabase
             
             customers = get_from_supabase('customers', 
-                                        select='*',
-                                        order_by={'created_at': 'desc'})
+                                        filters=filters,
+                                        select=select,
+                                        order_by=order_by or {'created_at': 'desc'})
             return customers if customers else []
         except Exception as e:
             print(f"Errore nel recupero clienti: {e}")
             return []
     
+    @staticmethod
+    def get_page(filters=None, sort='created_at', direction='desc', limit=50, cursor=None, select='*'):
+        """Recupera una pagina di clienti con paginazione keyset su (sort, id)"""
+        try:
+            from task_helper import get_page_from_supabase
+            
+            customers, next_cursor = get_page_from_supabase('customers',
+                                                            filters=filters,
+                                                            select=select,
+                                                            sort=sort,
+                                                            direction=direction,
+                                                            limit=limit,
+                                                            cursor=cursor)
+            return customers if customers else [], next_cursor
+        except ValueError:
+            # Cursore non valido: lo gestisce il chiamante (400)
+            raise
+        except Exception as e:
+            print(f"Errore nel recupero pagina clienti: {e}")
+            return [], None
+    
     @staticmethod
     def create(customer_data):
         """Crea un nuovo cliente"""
@@ -138,9 +223,28 @@ class CustomerService:
             print(f"Errore nell'aggiornamento cliente: {e}")
             return None
     
+    @staticmethod
+    def get_changes(token=None, limit=None, select='*'):
+        """
+        Clienti creati, modificati o eliminati dopo il token (vedi change_feed).
+        Solleva ValueError se il token non è valido; None in caso di errore.
+        """
+        try:
+            from change_feed import get_changes, CHANGES_PAGE_SIZE
+            
+            return get_changes('customers', token, limit or CHANGES_PAGE_SIZE, select)
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f"Errore nel recupero modifiche clienti: {e}")
+            return None
+    
     @staticmethod
     def delete(customer_id):
-        """Elimina un cliente e i suoi ticket associati"""
+        """
+        Elimina un cliente e i suoi ticket associati (i trigger del database
+        registrano entrambi in deleted_records per il feed delle modifiche)
+        """
         try:
             from task_helper import delete_from_supabase
             
@@ -260,6 +364,68 @@ class CustomerService:
             print(f"Errore nel recupero cliente: {e}")
             return None
 
+    @staticmethod
+    def find_by_email(email):
+        """Cliente per email, senza distinzione tra maiuscole e minuscole (indice in memoria)"""
+        try:
+            from customer_index import customer_email_index
+            
+            return customer_email_index.lookup(email)
+        except Exception as e:
+            print(f"Errore nella ricerca cliente per email: {e}")
+            return None
+    
+    @staticmethod
+    def find_by_emails(emails):
+        """
+        Clienti per più email: {email normalizzata: cliente}.
+        None se la ricerca non è possibile.
+        """
+        try:
+            from customer_index import customer_email_index
+            
+            return customer_email_index.lookup_many(emails)
+        except Exception as e:
+            print(f"Errore nella ricerca clienti per email: {e}")
+            return None
+    
+    @staticmethod
+    def get_or_create_by_emails(senders):
+        """
+        Risolve i mittenti {email: nome} in clienti, creando con un solo
+        inserimento quelli sconosciuti. Restituisce {email normalizzata: cliente},
+        None in caso di errore.
+        """
+        try:
+            from customer_index import normalize_email
+            from task_helper import save_many
+            
+            found = CustomerService.find_by_emails(list(senders))
+            if found is None:
+                return None
+            
+            new_customers = {}
+            for sender_email, sender_name in senders.items():
+                key = normalize_email(sender_email)
+                if key and key not in found and key not in new_customers:
+                    new_customers[key] = {
+                        'name': sender_name or key.split('@')[0],
+                        'email': sender_email.strip(),
+                        'status': 'Active'
+                    }
+            
+            if new_customers:
+                created = save_many('customers', list(new_customers.values()))
+                if created is None:
+                    return None
+                for customer in created:
+                    found[normalize_email(customer.get('email'))] = customer
+            
+            return found
+        except Exception as e:
+            print(f"Errore nella creazione clienti da email: {e}")
+            return None
+
 # Funzioni CRUD per Agents
 class AgentService:
     @staticmethod
@@ -344,28 +510,15 @@ class AgentService:
 
 # Funzione per le statistiche
 def get_stats():
-    """Recupera le statistiche"""
+    """Recupera le statistiche (dai contatori in memoria quando disponibili)"""
     try:
-        from task_helper import count_in_supabase
-        
-        # Conta ticket per stato
-        total_tickets = count_in_supabase('tickets')
-        open_tickets = count_in_supabase('tickets', {'status': 'Open'})
-        closed_tickets = count_in_supabase('tickets', {'status': 'Closed'})
+        from dashboard_counters import dashboard_counters, count_stats
+        stats = dashboard_counters.get_stats()
+        if stats is not None:
+            return stats
         
-        # Conta agenti (utenti approvati) e clienti
-        total_agents = count_in_supabase('users', {'status': 'approved'})
-        total_customers = count_in_supabase('customers')
-        active_customers = count_in_supabase('customers', {'status': 'Active'})
-        
-        return {
-            'total_tickets': total_tickets,
-            'open_tickets': open_tickets,
-            'closed_tickets': closed_tickets,
-            'total_agents': total_agents,
-            'total_customers': total_customers,
-            'active_customers': active_customers
-        }
+        # Contatori non ancora costruiti: conteggio diretto sul database
+        return count_stats()
     except Exception as e:
         print(f"Errore nel recupero statistiche: {e}")
         return {
@@ -6,11 +6,22 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.header import decode_header
 from database import TicketService, CustomerService
+from smtp_pool import smtp_pool
+from imap_fetch import fetch_messages, EMAIL_FETCH_BATCH
+from customer_index import normalize_email
+from email_threading import new_message_id, record_message_ids, record_many, resolve_threads
+from email_templates import render, render_stored, template_cache, warm_up as warm_up_templates
+from reply_cleaner import clean_reply
+from ticket_events import publish_messages
+from task_helper import register_write_listener
 import json
 import re
 from datetime import datetime
 import time
 import threading
+import os
+import select
+import sqlite3
 
 def sanitize_config_for_logging(config):
     """Rimuove dati sensibili dalla configurazione per il logging sicuro"""
@@ -25,53 +36,189 @@ def sanitize_config_for_logging(config):
             sanitized[field] = '***HIDDEN***'
     return sanitized
 
+# Tentativi su un'email che genera errore prima di saltarla
+EMAIL_SYNC_MAX_ATTEMPTS = int(os.getenv('EMAIL_SYNC_MAX_ATTEMPTS', '3'))
+# Secondi massimi per preparare un blocco di email sui worker del pool
+EMAIL_PROCESS_TIMEOUT = float(os.getenv('EMAIL_PROCESS_TIMEOUT', '120'))
+
+def _imap_response_int(mail, code):
+    """Valore numerico di una risposta non taggata (es. UIDVALIDITY dopo SELECT)"""
+    typ, data = mail.response(code)
+    try:
+        return int(data[-1]) if data and data[-1] else None
+    except (TypeError, ValueError):
+        return None
+
+def _imap_uid_search(mail, *criteria):
+    """UID SEARCH: lista ordinata degli UID trovati"""
+    status, data = mail.uid('SEARCH', None, *criteria)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID SEARCH fallita: {data}")
+    return sorted(int(uid) for uid in (data[0] or b'').split())
+
+def _parse_uid_set(value):
+    """UID di un insieme in forma compatta (inverso di _imap_uid_set)"""
+    uids = set()
+    for part in (value or '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition(':')
+        uids.update(range(int(first), int(last or first) + 1))
+    return uids
+
+def _imap_uid_set(uids):
+    """Insieme di UID in forma compatta per i comandi IMAP (es. 3:5,9)"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+# Template predefinito della notifica di aggiornamento (personalizzabile in email_templates)
+UPDATE_TICKET_SUBJECT = "Aggiornamento Ticket #{ticket_id}"
+UPDATE_TICKET_BODY = """Gentile {customer_name},
+
+Il suo ticket #{ticket_id} "{ticket_title}" è stato aggiornato.
+
+Nuovo stato: {ticket_status}
+{update_message}
+
+Cordiali saluti,
+Il Team di Supporto"""
+
+# --- Configurazioni SMTP/IMAP in memoria --------------------------------------
+#
+# Le configurazioni vengono lette da email_settings e decodificate una volta,
+# poi servite dalla memoria fino alla scadenza di EMAIL_CONFIG_TTL secondi o a
+# un salvataggio. I componenti che tengono connessioni aperte (pool SMTP,
+# monitor IMAP) si registrano con on_change e vengono avvisati solo quando la
+# configurazione cambia davvero.
+
+EMAIL_CONFIG_TTL = float(os.getenv('EMAIL_CONFIG_TTL', '30'))
+
+_UNKNOWN = object()
+
+class EmailConfigCache:
+    """Configurazioni email decodificate per tipo ('smtp', 'imap')"""
+    
+    def __init__(self, ttl=EMAIL_CONFIG_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}      # tipo -> (config o None, impronta, caricata_alle)
+        self._known = {}        # tipo -> ultima impronta vista (anche dopo un'invalidazione)
+        self._listeners = {}    # tipo -> callback(config)
+        self._generation = 0
+    
+    @staticmethod
+    def _fingerprint(config):
+        return json.dumps(config, sort_keys=True, default=str)
+    
+    def on_change(self, config_type, callback):
+        """Registra una callback chiamata con la nuova configurazione quando cambia"""
+        self._listeners.setdefault(config_type, []).append(callback)
+    
+    def _load(self, config_type):
+        """Legge e decodifica la configurazione; _UNKNOWN se il database non risponde"""
+        from task_helper import get_from_supabase
+        
+        rows = get_from_supabase('email_settings', {'type': config_type}, use_cache=False)
+        if rows is None:
+            return _UNKNOWN
+        if rows and rows[0].get('config'):
+            config = rows[0]['config']
+            return json.loads(config) if isinstance(config, str) else dict(config)
+        return None
+    
+    def _store(self, config_type, config, generation=None):
+        """Memorizza la configurazione e avvisa i listener se è cambiata"""
+        fingerprint = self._fingerprint(config)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # Invalidata durante la lettura: la configurazione letta potrebbe essere vecchia
+                return
+            self._entries[config_type] = (config, fingerprint, time.monotonic())
+            previous = self._known.get(config_type, _UNKNOWN)
+            self._known[config_type] = fingerprint
+        
+        if previous is _UNKNOWN or previous == fingerprint:
+            return
+        print(f"🔄 Configurazione {config_type.upper()} cambiata: {sanitize_config_for_logging(config)}")
+        for callback in self._listeners.get(config_type, []):
+            try:
+                callback(dict(config) if config else config)
+            except Exception as e:
+                print(f"Errore nella notifica del cambio configurazione {config_type}: {e}")
+    
+    def get(self, config_type):
+        """Copia della configurazione (None se non configurata)"""
+        with self._lock:
+            entry = self._entries.get(config_type)
+            generation = self._generation
+        if entry is None or time.monotonic() - entry[2] >= self.ttl:
+            config = self._load(config_type)
+            if config is _UNKNOWN:
+                # Database non raggiungibile: resta valida l'ultima configurazione nota
+                if entry is None:
+                    return None
+                config = entry[0]
+            else:
+                self._store(config_type, config, generation)
+                if entry is None and config:
+                    print(f"📧 Configurazione {config_type.upper()} caricata: {sanitize_config_for_logging(config)}")
+        else:
+            config = entry[0]
+        return dict(config) if config else None
+    
+    def update(self, config_type, config):
+        """Aggiorna la configurazione dopo un salvataggio riuscito"""
+        self._store(config_type, dict(config) if config else None)
+    
+    def invalidate(self, config_type=None):
+        """Forza la rilettura dal database alla prossima richiesta"""
+        with self._lock:
+            self._generation += 1
+            if config_type is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(config_type, None)
+    
+    def on_write(self, operation, table, rows, filters=None):
+        """Invalida le configurazioni scritte da altri percorsi (listener di task_helper)"""
+        if table != 'email_settings':
+            return
+        types = {row.get('type') for row in rows or []}
+        if not types or None in types:
+            self.invalidate()
+        else:
+            for config_type in types:
+                self.invalidate(config_type)
+
+# Istanza globale delle configurazioni email
+email_config = EmailConfigCache()
+
 class EmailService:
     @staticmethod
     def get_smtp_config():
-        """Recupera la configurazione SMTP dal database usando MCP"""
+        """Configurazione SMTP (dalla copia in memoria, riletta dopo EMAIL_CONFIG_TTL secondi)"""
         try:
-            from task_helper import get_from_supabase
-            import json
-            
-            # Usa MCP helper per recuperare
-            result = get_from_supabase('email_settings', {'type': 'smtp'})
-            
-            if result and len(result) > 0:
-                config_data = result[0]
-                # Decodifica la configurazione JSON
-                if config_data.get('config'):
-                    config = json.loads(config_data['config'])
-                    print(f"📧 Configurazione SMTP recuperata via MCP: {sanitize_config_for_logging(config)}")
-                    return config
-                    
-            print("❌ Nessuna configurazione SMTP trovata")
-            return None
-                    
+            config = email_config.get('smtp')
+            if not config:
+                print("❌ Nessuna configurazione SMTP trovata")
+            return config
         except Exception as e:
             print(f"❌ Errore nel recupero configurazione SMTP: {e}")
             return None
     
     @staticmethod
     def get_imap_config():
-        """Recupera la configurazione IMAP dal database usando MCP"""
+        """Configurazione IMAP (dalla copia in memoria, riletta dopo EMAIL_CONFIG_TTL secondi)"""
         try:
-            from task_helper import get_from_supabase
-            import json
-            
-            # Usa MCP helper per recuperare
-            result = get_from_supabase('email_settings', {'type': 'imap'})
-            
-            if result and len(result) > 0:
-                config_data = result[0]
-                # Decodifica la configurazione JSON
-                if config_data.get('config'):
-                    config = json.loads(config_data['config'])
-                    print(f"📬 Configurazione IMAP recuperata via MCP: {sanitize_config_for_logging(config)}")
-                    return config
-                    
-            print("❌ Nessuna configurazione IMAP trovata")
-            return None
-                    
+            config = email_config.get('imap')
+            if not config:
+                print("❌ Nessuna configurazione IMAP trovata")
+            return config
         except Exception as e:
             print(f"❌ Errore nel recupero configurazione IMAP: {e}")
             return None
@@ -97,6 +244,8 @@ class EmailService:
             
             if result:
                 print(f"✅ Configurazione SMTP salvata via MCP: {sanitize_config_for_logging(result)}")
+                # Se la configurazione è cambiata il pool SMTP chiude le sessioni aperte
+                email_config.update('smtp', config)
                 return True
             else:
                 print("❌ Errore nel salvataggio via MCP")
@@ -127,6 +276,8 @@ class EmailService:
             
             if result:
                 print(f"✅ Configurazione IMAP salvata via MCP: {sanitize_config_for_logging(result)}")
+                # Se la configurazione è cambiata il monitor si riconnette
+                email_config.update('imap', config)
                 return True
             else:
                 print("❌ Errore nel salvataggio via MCP")
@@ -173,7 +324,7 @@ class EmailService:
     
     @staticmethod
     def save_email_template(template_type, subject, body):
-        """Salva un template email nel database"""
+        """Salva un template email nel database e invalida la versione compilata"""
         try:
             from task_helper import save_to_supabase
             
@@ -182,6 +333,7 @@ class EmailService:
                 'subject': subject,
                 'body': body
             }, on_conflict='type')
+            template_cache.invalidate(template_type)
             
             print(f"Template {template_type} salvato: {result}")
             return bool(result)
@@ -192,21 +344,20 @@ class EmailService:
     
     @staticmethod
     def get_email_template(template_type):
-        """Recupera un template email dal database"""
+        """Recupera un template email (dalla cache dei template compilati)"""
         try:
-            from task_helper import get_from_supabase
-            
-            templates = get_from_supabase('email_templates', {'type': template_type})
-            if templates:
-                return templates[0]
-            return None
+            template = template_cache.get(template_type)
+            return dict(template.row) if template else None
         except Exception as e:
             print(f"Errore nel recupero template {template_type}: {e}")
             return None
     
     @staticmethod
-    def send_email(to_email, subject, body, config=None):
-        """Invia un email utilizzando la configurazione SMTP"""
+    def send_email(to_email, subject, body, config=None, ticket_id=None):
+        """
+        Invia un email utilizzando la configurazione SMTP.
+        Con ticket_id il Message-ID viene registrato per collegare le risposte al ticket.
+        """
         if not config:
             config = EmailService.get_smtp_config()
         
@@ -219,29 +370,40 @@ class EmailService:
             msg['From'] = f"{config.get('from_name', 'CRM Pro')} <{config['from_email']}>"
             msg['To'] = to_email
             msg['Subject'] = subject
+            msg['Message-ID'] = new_message_id(config.get('from_email'))
             
             # Corpo del messaggio
             msg.attach(MIMEText(body, 'plain', 'utf-8'))
             
-            # Connessione al server SMTP
-            if config['security'] == 'SSL':
-                server = smtplib.SMTP_SSL(config['host'], int(config['port']))
-            else:
-                server = smtplib.SMTP(config['host'], int(config['port']))
-                if config['security'] == 'TLS':
-                    server.starttls()
-            
-            server.login(config['username'], config['password'])
-            server.send_message(msg)
-            server.quit()
+            # Invio su una sessione SMTP del pool
+            smtp_pool.send_message(config, msg)
+            EmailService.record_message(ticket_id, msg, 'out')
             
             return True, "Email inviata con successo"
         except Exception as e:
             return False, f"Errore nell'invio email: {str(e)}"
     
     @staticmethod
-    def send_html_email(to_email, subject, html_body, config=None):
-        """Invia un email HTML utilizzando la configurazione SMTP"""
+    def record_message(ticket_id, msg, direction):
+        """
+        Registra il Message-ID di un'email collegata a un ticket ('out' per le
+        notifiche inviate, 'in' per le email elaborate). Un errore non
+        interrompe l'invio o l'elaborazione.
+        """
+        if not ticket_id or not msg.get('Message-ID'):
+            return
+        try:
+            if not record_message_ids(ticket_id, [msg['Message-ID'].strip()], direction):
+                print(f"Message-ID non registrato per il ticket #{ticket_id}")
+        except Exception as e:
+            print(f"Errore nella registrazione del Message-ID: {e}")
+    
+    @staticmethod
+    def send_html_email(to_email, subject, html_body, config=None, ticket_id=None):
+        """
+        Invia un email HTML utilizzando la configurazione SMTP.
+        Con ticket_id il Message-ID viene registrato per collegare le risposte al ticket.
+        """
         if not config:
             config = EmailService.get_smtp_config()
         
@@ -254,57 +416,20 @@ class EmailService:
             msg['From'] = f"{config.get('from_name', 'CRM Pro')} <{config['from_email']}>"
             msg['To'] = to_email
             msg['Subject'] = subject
+            msg['Message-ID'] = new_message_id(config.get('from_email'))
             
             # Crea versione HTML
             html_part = MIMEText(html_body, 'html', 'utf-8')
             msg.attach(html_part)
             
-            # Connessione al server SMTP
-            if config['security'] == 'SSL':
-                server = smtplib.SMTP_SSL(config['host'], int(config['port']))
-            else:
-                server = smtplib.SMTP(config['host'], int(config['port']))
-                if config['security'] == 'TLS':
-                    server.starttls()
-            
-            server.login(config['username'], config['password'])
-            server.send_message(msg)
-            server.quit()
+            # Invio su una sessione SMTP del pool
+            smtp_pool.send_message(config, msg)
+            EmailService.record_message(ticket_id, msg, 'out')
             
             return True, "Email HTML inviata con successo"
         except Exception as e:
             return False, f"Errore nell'invio email HTML: {str(e)}"
     
-    @staticmethod
-    def get_email_template(template_type):
-        """Recupera un template email"""
-        try:
-            from task_helper import get_from_supabase
-            
-            templates = get_from_supabase('email_templates', {'type': template_type})
-            if templates:
-                return templates[0]
-            return None
-        except Exception as e:
-            print(f"Errore nel recupero template: {e}")
-            return None
-    
-    @staticmethod
-    def save_email_template(template_type, subject, body):
-        """Salva un template email"""
-        try:
-            from task_helper import save_to_supabase
-            
-            save_to_supabase('email_templates', {
-                'type': template_type,
-                'subject': subject,
-                'body': body
-            }, on_conflict='type')
-            return True
-        except Exception as e:
-            print(f"Errore nel salvataggio template: {e}")
-            return False
-    
     @staticmethod
     def send_new_ticket_notification(ticket_data):
         """Invia notifica per nuovo ticket con template HTML cyberpunk uniforme"""
@@ -312,74 +437,11 @@ class EmailService:
             # Template stile uniforme cyberpunk per apertura ticket
             subject = f"🎫 Nuovo Ticket #{ticket_data.get('id')} - {ticket_data.get('title', '')}"
             
-            # Determina colore priorità
-            priority_color = "#f44336" if ticket_data.get('priority') == 'Urgent' else "#ff9800" if ticket_data.get('priority') == 'High' else "#4caf50"
-            
-            body = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f5f5f5; margin: 0; padding: 20px; }}
-        .container {{ max-width: 700px; margin: 0 auto; background: white; border-radius: 12px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }}
-        .header {{ background: linear-gradient(135deg, #00ffff 0%, #0066cc 100%); color: white; padding: 30px 25px; text-align: center; }}
-        .header h1 {{ margin: 0; font-size: 24px; font-weight: 600; }}
-        .content {{ padding: 30px 25px; line-height: 1.6; color: #333; }}
-        .ticket-info {{ background: #e8f5ff; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #00ffff; }}
-        .status-new {{ color: #00ffff; font-weight: bold; font-size: 18px; }}
-        .priority-badge {{ color: {priority_color}; font-weight: bold; }}
-        .next-steps {{ background: #f0f8ff; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #0066cc; }}
-        .footer {{ background: #f8f9fa; padding: 20px 25px; text-align: center; color: #666; font-size: 14px; }}
-        .support-info {{ background: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>🎫 NUOVO TICKET CREATO</h1>
-        </div>
-        <div class="content">
-            <p>Gentile <strong>{ticket_data.get('customer_name', '')}</strong>,</p>
-            
-            <p>Il suo ticket è stato <span class="status-new">CREATO CON SUCCESSO</span> nel nostro sistema!</p>
-            
-            <div class="ticket-info">
-                <strong>Ticket #{ticket_data.get('id', '')}:</strong> {ticket_data.get('title', '')}<br>
-                <strong>Stato:</strong> <span class="status-new">📋 {ticket_data.get('status', 'Open').upper()}</span><br>
-                <strong>Priorità:</strong> <span class="priority-badge">{ticket_data.get('priority', 'Media')}</span><br>
-                <strong>Descrizione:</strong> {ticket_data.get('description', '')[:200]}{'...' if len(ticket_data.get('description', '')) > 200 else ''}
-            </div>
-            
-            <div class="next-steps">
-                <strong>🔄 Prossimi Passi:</strong><br>
-                • Il nostro team tecnico ha ricevuto la sua richiesta<br>
-                • Un agente la contatterà entro le prossime ore lavorative<br>
-                • Riceverà aggiornamenti via email ad ogni sviluppo<br>
-                • Può rispondere a questa email per aggiungere informazioni
-            </div>
-            
-            <div class="support-info">
-                <strong>💬 Comunicazione:</strong><br>
-                Per aggiungere informazioni al ticket, <strong>risponda direttamente a questa email</strong>.<br>
-                Il suo messaggio sarà automaticamente collegato al ticket #{ticket_data.get('id', '')}.
-            </div>
-            
-            <p style="margin-top: 25px;">
-                Grazie per aver scelto il nostro servizio di supporto!
-            </p>
-        </div>
-        <div class="footer">
-            <p>🤖 <strong>CRM Pro v2.7 - Cyberpunk Command Center</strong></p>
-            <p>Ticket creato automaticamente • Sistema di supporto clienti</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+            body = render('new_ticket.html', ticket=ticket_data)
             
             print(f"📧 Invio email creazione ticket #{ticket_data.get('id')} a {ticket_data.get('customer_email')}")
-            return EmailService.send_html_email(ticket_data['customer_email'], subject, body)
+            return EmailService.send_html_email(ticket_data['customer_email'], subject, body,
+                                                ticket_id=ticket_data.get('id'))
             
         except Exception as e:
             print(f"❌ Errore nell'invio email nuovo ticket: {e}")
@@ -388,33 +450,8 @@ class EmailService:
     @staticmethod
     def send_ticket_update_notification(ticket_data, update_message=""):
         """Invia notifica per aggiornamento ticket"""
-        template = EmailService.get_email_template('update_ticket')
-        if not template:
-            # Template predefinito
-            subject = "Aggiornamento Ticket #{ticket_id}"
-            body = """Gentile {customer_name},
-
-Il suo ticket #{ticket_id} "{ticket_title}" è stato aggiornato.
-
-Nuovo stato: {ticket_status}
-{update_message}
-
-Cordiali saluti,
-Il Team di Supporto"""
-        else:
-            subject = template['subject']
-            body = template['body']
-        
-        # Sostituisci i placeholder
-        subject = subject.format(
-            ticket_id=ticket_data.get('id', ''),
-            ticket_title=ticket_data.get('title', ''),
-            customer_name=ticket_data.get('customer_name', ''),
-            ticket_status=ticket_data.get('status', ''),
-            update_message=update_message
-        )
-        
-        body = body.format(
+        subject, body = render_stored(
+            'update_ticket', UPDATE_TICKET_SUBJECT, UPDATE_TICKET_BODY,
             ticket_id=ticket_data.get('id', ''),
             ticket_title=ticket_data.get('title', ''),
             customer_name=ticket_data.get('customer_name', ''),
@@ -422,7 +459,8 @@ Il Team di Supporto"""
             update_message=update_message
         )
         
-        return EmailService.send_email(ticket_data['customer_email'], subject, body)
+        return EmailService.send_email(ticket_data['customer_email'], subject, body,
+                                       ticket_id=ticket_data.get('id'))
     
     @staticmethod
     def send_ticket_resolved_notification(ticket_data):
@@ -438,134 +476,15 @@ Il Team di Supporto"""
             
             print(f"📧 Recuperati {len(messages) if messages else 0} messaggi per ticket #{ticket_data.get('id')}")
             
-            # Prepara HTML messaggi in ordine cronologico inverso (più recente in alto)
-            messages_html = ""
-            if messages:
-                for i, msg in enumerate(messages):
-                    # Salta messaggi interni (solo agenti)
-                    if msg.get('is_internal', False):
-                        continue
-                    
-                    # Determina stile in base al tipo mittente
-                    if msg.get('sender_type') == 'agent':
-                        msg_class = "agent-message"
-                        sender_icon = "🛠️"
-                        sender_label = "Supporto Tecnico"
-                    else:
-                        msg_class = "customer-message"  
-                        sender_icon = "👤"
-                        sender_label = "Cliente"
-                    
-                    # Formatta data
-                    created_at = msg.get('created_at', '')
-                    if created_at:
-                        from datetime import datetime
-                        try:
-                            dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                            formatted_date = dt.strftime('%d/%m/%Y alle %H:%M')
-                        except:
-                            formatted_date = created_at
-                    else:
-                        formatted_date = 'Data non disponibile'
-                    
-                    # Badge per ultimo messaggio
-                    is_latest = i == 0
-                    latest_badge = '<span class="latest-badge">💫 ULTIMO</span>' if is_latest else ''
-                    
-                    messages_html += f"""
-                    <div class="message-item {msg_class}">
-                        <div class="message-header">
-                            <span class="sender-info">
-                                {sender_icon} <strong>{sender_label}</strong> - {msg.get('sender_name', 'N/A')}
-                            </span>
-                            <span class="message-date">{formatted_date}</span>
-                            {latest_badge}
-                        </div>
-                        <div class="message-content">
-                            {msg.get('message_text', '').replace(chr(10), '<br>')}
-                        </div>
-                    </div>
-                    """
+            # Messaggi visibili al cliente, il più recente in alto (i messaggi interni sono esclusi)
+            visible = [msg for msg in messages or [] if not msg.get('is_internal', False)]
             
-            # Template stile apertura ticket ma per risoluzione
             subject = f"🎯 Ticket #{ticket_data.get('id')} - RISOLTO - Riepilogo Conversazione"
-            
-            body = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f5f5f5; margin: 0; padding: 20px; }}
-        .container {{ max-width: 700px; margin: 0 auto; background: white; border-radius: 12px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }}
-        .header {{ background: linear-gradient(135deg, #00ff41 0%, #00cc33 100%); color: white; padding: 30px 25px; text-align: center; }}
-        .header h1 {{ margin: 0; font-size: 24px; font-weight: 600; }}
-        .content {{ padding: 30px 25px; line-height: 1.6; color: #333; }}
-        .ticket-info {{ background: #e8f5e8; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #00ff41; }}
-        .status-resolved {{ color: #00ff41; font-weight: bold; font-size: 18px; }}
-        .conversation-section {{ margin: 30px 0; }}
-        .conversation-title {{ color: #333; font-size: 18px; font-weight: 600; margin-bottom: 20px; border-bottom: 2px solid #00ff41; padding-bottom: 10px; }}
-        .message-item {{ margin: 20px 0; padding: 20px; border-radius: 8px; border: 1px solid #e0e0e0; }}
-        .agent-message {{ background: #f0f8ff; border-left: 4px solid #0066cc; }}
-        .customer-message {{ background: #fff8f0; border-left: 4px solid #ff6b35; }}
-        .message-header {{ display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; }}
-        .sender-info {{ font-weight: 600; color: #333; }}
-        .message-date {{ font-size: 12px; color: #666; }}
-        .latest-badge {{ background: #ff6b35; color: white; padding: 3px 8px; border-radius: 12px; font-size: 10px; font-weight: 600; }}
-        .message-content {{ color: #444; line-height: 1.5; }}
-        .footer {{ background: #f8f9fa; padding: 20px 25px; text-align: center; color: #666; font-size: 14px; }}
-        .reopen-info {{ background: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>🎯 TICKET RISOLTO</h1>
-        </div>
-        <div class="content">
-            <p>Gentile <strong>{ticket_data.get('customer_name', '')}</strong>,</p>
-            
-            <p>Siamo lieti di informarla che il suo ticket è stato <span class="status-resolved">RISOLTO</span> con successo!</p>
-            
-            <div class="ticket-info">
-                <strong>Ticket #{ticket_data.get('id', '')}:</strong> {ticket_data.get('title', '')}<br>
-                <strong>Stato:</strong> <span class="status-resolved">✅ RISOLTO</span><br>
-                <strong>Priorità:</strong> {ticket_data.get('priority', 'Media')}<br>
-                <strong>Descrizione:</strong> {ticket_data.get('description', '')[:200]}{'...' if len(ticket_data.get('description', '')) > 200 else ''}
-            </div>
-            
-            <div class="conversation-section">
-                <div class="conversation-title">
-                    💬 Riepilogo Completo Conversazione
-                </div>
-                <p style="color: #666; font-size: 14px; margin-bottom: 20px;">
-                    Di seguito trova la cronologia completa degli scambi, con l'ultimo messaggio in evidenza:
-                </p>
-                
-                {messages_html if messages_html else '<div class="message-item"><em>Nessun messaggio nella conversazione</em></div>'}
-            </div>
-            
-            <div class="reopen-info">
-                <strong>🔄 Serve ancora supporto?</strong><br>
-                Se ha ancora problemi o domande, <strong>risponda direttamente a questa email</strong>.<br>
-                Il ticket sarà riaperto automaticamente e il nostro team riceverà immediatamente la notifica.
-            </div>
-            
-            <p style="margin-top: 25px;">
-                Grazie per aver utilizzato il nostro servizio di supporto!
-            </p>
-        </div>
-        <div class="footer">
-            <p>🤖 <strong>CRM Pro v2.7 - Cyberpunk Command Center</strong></p>
-            <p>Ticket risolto automaticamente • Sistema di supporto clienti</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+            body = render('ticket_resolved.html', ticket=ticket_data, messages=visible)
             
             print(f"📧 Invio email risoluzione con conversazione completa per ticket #{ticket_data.get('id')} a {ticket_data.get('customer_email')}")
-            return EmailService.send_html_email(ticket_data['customer_email'], subject, body)
+            return EmailService.send_html_email(ticket_data['customer_email'], subject, body,
+                                                ticket_id=ticket_data.get('id'))
             
         except Exception as e:
             print(f"❌ Errore nell'invio email risoluzione: {e}")
@@ -574,37 +493,21 @@ Il Team di Supporto"""
     @staticmethod
     def clean_reply_message(body):
         """Pulisce il messaggio email estraendo solo la parte nuova della risposta"""
-        if not body:
-            return ""
-        
-        # Pattern comuni per identificare l'inizio dell'email originale
-        dividers = [
-            r'-----Messaggio originale-----',
-            r'-----Original Message-----',
-            r'-------- Messaggio originale --------',
-            r'On .* wrote:',
-            r'Il .* ha scritto:',
-            r'From:.*\n.*To:.*\n.*Subject:',
-            r'Da:.*\n.*A:.*\n.*Oggetto:',
-            r'---\nQuesto è un messaggio automatico del sistema CRM\.',
-            r'---.*CRM.*Ticket.*ID.*#\d+',
-            r'---\nTicket ID: #\d+'
-        ]
-        
-        # Cerca il primo divider e taglia tutto quello che viene dopo
-        for pattern in dividers:
-            match = re.search(pattern, body, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-            if match:
-                body = body[:match.start()]
-                break
-        
-        # Rimuovi spazi vuoti e righe vuote alla fine
-        body = body.strip()
-        
-        # Rimuovi righe vuote eccessive (più di 2 consecutive)
-        body = re.sub(r'\n{3,}', '\n\n', body)
+        return clean_reply(body)
+    
+    @staticmethod
+    def parse_sender(from_header):
+        """Indirizzo e nome del mittente da un header From"""
+        from_email = from_header or ""
+        # Estrai solo l'indirizzo email
+        email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_email)
+        sender_email = email_match.group() if email_match else from_email
         
-        return body
+        # Estrai il nome del mittente
+        sender_name = from_email.replace(f"<{sender_email}>", "").strip()
+        if not sender_name or sender_name == sender_email:
+            sender_name = sender_email.split('@')[0]
+        return sender_email, sender_name
     
     @staticmethod
     def parse_email_for_ticket(email_msg):
@@ -619,16 +522,8 @@ Il Team di Supporto"""
                 else:
                     subject = subject_decoded[0]
             
-            # Estrai l'email del mittente
-            from_email = email_msg.get("From", "")
-            # Estrai solo l'indirizzo email
-            email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_email)
-            sender_email = email_match.group() if email_match else from_email
-            
-            # Estrai il nome del mittente
-            sender_name = from_email.replace(f"<{sender_email}>", "").strip()
-            if not sender_name or sender_name == sender_email:
-                sender_name = sender_email.split('@')[0]
+            # Estrai email e nome del mittente
+            sender_email, sender_name = EmailService.parse_sender(email_msg.get("From", ""))
             
             # Estrai il corpo del messaggio
             body = ""
@@ -655,6 +550,24 @@ Il Team di Supporto"""
             print(f"Errore nel parsing email: {e}")
             return None
     
+    @staticmethod
+    def connect_imap(config):
+        """Apre una sessione IMAP autenticata sulla cartella configurata"""
+        if config['security'] == 'SSL':
+            mail = imaplib.IMAP4_SSL(config['host'], int(config['port']))
+        else:
+            mail = imaplib.IMAP4(config['host'], int(config['port']))
+            if config['security'] == 'TLS':
+                mail.starttls()
+        
+        mail.login(config['username'], config['password'])
+        mail.select(config.get('folder', 'INBOX'))
+        
+        # Valori della cartella restituiti da SELECT, usati dalla sincronizzazione per UID
+        mail.uidvalidity = _imap_response_int(mail, 'UIDVALIDITY')
+        mail.uidnext = _imap_response_int(mail, 'UIDNEXT')
+        return mail
+    
     @staticmethod
     def check_emails_and_create_tickets():
         """Controlla le email in arrivo e crea ticket automaticamente"""
@@ -670,177 +583,476 @@ Il Team di Supporto"""
             return
         
         try:
-            # Connessione IMAP
-            if config['security'] == 'SSL':
-                mail = imaplib.IMAP4_SSL(config['host'], int(config['port']))
-            else:
-                mail = imaplib.IMAP4(config['host'], int(config['port']))
-                if config['security'] == 'TLS':
-                    mail.starttls()
-            
-            mail.login(config['username'], config['password'])
-            mail.select(config.get('folder', 'INBOX'))
-            
-            # Cerca email non lette
-            status, messages = mail.search(None, 'UNSEEN')
-            email_ids = messages[0].split()
-            
-            print(f"📬 Trovate {len(email_ids)} email non lette")
-            
-            for email_id in email_ids:
-                try:
-                    # Scarica l'email
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                    email_msg = email.message_from_bytes(msg_data[0][1])
-                    
-                    # Verifica se è una risposta a un ticket esistente
-                    subject = ""
-                    if email_msg["Subject"]:
-                        subject_decoded = decode_header(email_msg["Subject"])[0]
-                        if isinstance(subject_decoded[0], bytes):
-                            subject = subject_decoded[0].decode(subject_decoded[1] or 'utf-8')
-                        else:
-                            subject = subject_decoded[0]
-                    
-                    print(f"📧 Email trovata - Subject: '{subject}' - From: '{email_msg.get('From', '')}'")
-                    
-                    # Controlla se è una risposta a un ticket
-                    ticket_match = re.search(r'(?:Re:\s*)?Ticket\s*#(\d+)', subject, re.IGNORECASE)
-                    
-                    print(f"🔍 Ticket match: {ticket_match}")
-                    
-                    if ticket_match:
-                        # È una risposta a un ticket esistente
-                        ticket_id = int(ticket_match.group(1))
-                        
-                        # Verifica che il ticket esista
-                        from task_helper import get_from_supabase
-                        
-                        tickets = get_from_supabase('tickets', {'id': ticket_id})
-                        
-                        if tickets:
-                            ticket = tickets[0]
-                            current_status = ticket.get('status', '')
-                            
-                            # Estrai info mittente
-                            from_email = email_msg.get("From", "")
-                            email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', from_email)
-                            sender_email = email_match.group() if email_match else from_email
-                            sender_name = from_email.replace(f"<{sender_email}>", "").strip()
-                            if not sender_name or sender_name == sender_email:
-                                sender_name = sender_email.split('@')[0]
-                            
-                            # Estrai corpo messaggio
-                            body = ""
-                            if email_msg.is_multipart():
-                                for part in email_msg.walk():
-                                    if part.get_content_type() == "text/plain":
-                                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                        break
-                            else:
-                                body = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-                            
-                            # Pulisci il messaggio estraendo solo la parte nuova
-                            body = EmailService.clean_reply_message(body)
-                            
-                            # 🔄 AUTO-RIAPERTURA: Se ticket è RISOLTO e cliente risponde → RIAPRI
-                            if current_status == 'Resolved':
-                                print(f"🔄 RIAPERTURA AUTOMATICA: Ticket #{ticket_id} era RISOLTO, cliente ha risposto")
-                                
-                                # Aggiorna stato ticket a "In Progress"
-                                from task_helper import update_in_supabase
-                                reopen_result = update_in_supabase('tickets', 
-                                                                 {'id': ticket_id}, 
-                                                                 {'status': 'In Progress'})
-                                
-                                if reopen_result:
-                                    print(f"✅ Ticket #{ticket_id} riaperto automaticamente: Resolved → In Progress")
-                                    
-                                    # Aggiungi messaggio di sistema per notificare la riapertura
-                                    system_message = {
-                                        'ticket_id': ticket_id,
-                                        'sender_type': 'system',
-                                        'sender_name': 'Sistema CRM',
-                                        'sender_email': 'system@crm.local',
-                                        'message_text': f"🔄 Ticket riaperto automaticamente - Il cliente {sender_name} ha risposto a un ticket risolto",
-                                        'is_internal': True,
-                                        'email_message_id': ''
-                                    }
-                                    
-                                    from task_helper import save_to_supabase
-                                    save_to_supabase('ticket_messages', system_message)
-                                else:
-                                    print(f"❌ Errore nella riapertura del ticket #{ticket_id}")
-                            
-                            # Crea un messaggio per il ticket esistente
-                            message_data = {
-                                'ticket_id': ticket_id,
-                                'sender_type': 'customer',
-                                'sender_name': sender_name,
-                                'sender_email': sender_email,
-                                'message_text': body.strip(),
-                                'is_internal': False,
-                                'email_message_id': email_msg.get('Message-ID', '')
-                            }
-                            
-                            from task_helper import save_to_supabase
-                            message_result = save_to_supabase('ticket_messages', message_data)
-                            
-                            if message_result:
-                                print(f"📬 Messaggio aggiunto al ticket #{ticket_id} da {sender_email}")
-                                
-                                # NON inviare notifica email agli agenti per risposte clienti
-                                # I messaggi appaiono solo nella chat del CRM
-                            
-                            # Marca l'email come letta
-                            mail.store(email_id, '+FLAGS', '\\Seen')
-                            continue
-                    
-                    # Non è una risposta, crea un nuovo ticket
-                    ticket_data = EmailService.parse_email_for_ticket(email_msg)
-                    
-                    if ticket_data:
-                        # Verifica se il cliente esiste già
-                        customers = CustomerService.get_all()
-                        customer = None
-                        for c in customers:
-                            if c['email'] == ticket_data['customer_email']:
-                                customer = c
-                                break
-                        
-                        # Crea il cliente se non esiste
-                        if not customer:
-                            customer_data = {
-                                'name': ticket_data['customer_name'],
-                                'email': ticket_data['customer_email'],
-                                'status': 'Active'
-                            }
-                            customer = CustomerService.create(customer_data)
-                        
-                        if customer:
-                            ticket_data['customer_id'] = customer['id']
-                        
-                        # Crea il ticket
-                        new_ticket = TicketService.create(ticket_data)
-                        
-                        if new_ticket:
-                            print(f"Ticket creato da email: #{new_ticket['id']} - {ticket_data['title']}")
-                            
-                            # Invia conferma al cliente
-                            EmailService.send_new_ticket_notification(new_ticket)
-                        
-                        # Marca l'email come letta
-                        mail.store(email_id, '+FLAGS', '\\Seen')
-                
-                except Exception as e:
-                    print(f"Errore nel processare email {email_id}: {e}")
-                    continue
-            
+            mail = EmailService.connect_imap(config)
+            EmailService.process_mailbox(mail, config)
             mail.logout()
             
         except Exception as e:
             print(f"Errore nel controllo email: {e}")
     
+    @staticmethod
+    def mailbox_key(config):
+        """Identificativo della casella per lo stato di sincronizzazione"""
+        return f"{config.get('username', '')}@{config['host']}/{config.get('folder', 'INBOX')}"
+    
+    @staticmethod
+    def get_sync_state(mailbox):
+        """Stato di sincronizzazione salvato per la casella (None se assente)"""
+        from task_helper import get_from_supabase
+        rows = get_from_supabase('email_sync_state', {'mailbox': mailbox}, use_cache=False)
+        return rows[0] if rows else None
+    
+    @staticmethod
+    def save_sync_state(state):
+        from task_helper import save_to_supabase
+        state['updated_at'] = datetime.now().isoformat()
+        return save_to_supabase('email_sync_state', state, on_conflict='mailbox')
+    
+    @staticmethod
+    def process_mailbox(mail, config):
+        """
+        Elabora le nuove email su una sessione IMAP già aperta (usata sia dal
+        controllo periodico sia dalla modalità IDLE).
+        
+        La sincronizzazione è incrementale per UID: per ogni casella si salva
+        UIDVALIDITY e l'ultimo UID elaborato, e a ogni ciclo si scaricano solo
+        gli UID successivi. Il flag \\Seen non guida più l'elaborazione: viene
+        impostato con un solo STORE per blocco sulle email elaborate.
+        
+        La prima sincronizzazione elabora le email non lette e salva
+        UIDVALIDITY solo quando è completa: se si interrompe, il ciclo
+        successivo la ripete sulle non lette rimaste (quelle già elaborate sono
+        marcate \\Seen) invece di ripartire da un last_uid parziale.
+        
+        Le email sono scaricate a blocchi con imap_fetch: prima header e
+        struttura di tutto il blocco, poi solo le parti di testo. Ogni blocco
+        è elaborato da process_batch e il punto di ripresa è salvato dopo
+        ogni blocco. Se un'email dà errore il punto di ripresa si ferma prima
+        di lei, ma le email successive dello stesso blocco già salvate sono
+        registrate in committed_uids e non vengono elaborate una seconda volta.
+        """
+        mailbox = EmailService.mailbox_key(config)
+        uidvalidity = getattr(mail, 'uidvalidity', None)
+        state = EmailService.get_sync_state(mailbox)
+        
+        first_sync = state is None or state.get('uidvalidity') != uidvalidity
+        if first_sync:
+            # Prima sincronizzazione (o cartella ricreata): si elaborano le non lette
+            # e il punto di partenza diventa l'ultimo UID esistente
+            resuming = state is not None and state.get('uidvalidity') is None
+            if state is not None and not resuming:
+                print(f"📬 UIDVALIDITY cambiato per {mailbox}: risincronizzazione")
+            uids = _imap_uid_search(mail, 'UNSEEN')
+            uidnext = getattr(mail, 'uidnext', None)
+            baseline = uidnext - 1 if uidnext else max(_imap_uid_search(mail, 'ALL'), default=0)
+            # UIDVALIDITY resta vuoto finché la prima sincronizzazione non è completa:
+            # un last_uid parziale non deve diventare il punto di ripresa
+            state = {
+                'mailbox': mailbox,
+                'uidvalidity': None,
+                'last_uid': 0,
+                'failed_uid': state.get('failed_uid') if resuming else None,
+                'failed_attempts': (state.get('failed_attempts') or 0) if resuming else 0,
+                'committed_uids': ''
+            }
+            saved = None
+        else:
+            last_uid = int(state.get('last_uid') or 0)
+            # "n:*" include sempre l'ultimo messaggio, anche se ha UID minore di n
+            uids = [uid for uid in _imap_uid_search(mail, 'UID', f'{last_uid + 1}:*') if uid > last_uid]
+            baseline = last_uid
+            saved = dict(state)
+        
+        # UID oltre il punto di ripresa già salvati in un ciclo precedente
+        committed = _parse_uid_set(state.get('committed_uids'))
+        
+        print(f"📬 Trovate {len(uids)} nuove email in {mailbox}")
+        
+        processed = 0
+        failed = False
+        for start in range(0, len(uids), EMAIL_FETCH_BATCH):
+            batch = uids[start:start + EMAIL_FETCH_BATCH]
+            # Header e struttura dell'intero blocco, poi solo le parti di testo
+            fetched = {item.uid: item for item in fetch_messages(mail, [uid for uid in batch
+                                                                        if uid not in committed])}
+            # Risposte dai Message-ID noti e riconsegne, con una sola ricerca nell'indice
+            resolve_threads(fetched.values())
+            tickets = EmailService.prefetch_reply_tickets(fetched.values())
+            customers = EmailService.resolve_new_ticket_senders(fetched.values(), tickets)
+            # Email preparate in parallelo (in ordine per ticket/mittente) e salvate in blocco
+            results = EmailService.process_batch([fetched[uid] for uid in batch if uid in fetched],
+                                                 tickets, customers)
+            
+            done = []
+            for uid in batch:
+                item = fetched.get(uid)
+                result = results.get(uid)
+                if failed:
+                    # Dopo un errore il punto di ripresa resta fermo: le email già
+                    # salvate del blocco vengono ricordate per non salvarle due volte
+                    if result is True:
+                        committed.add(uid)
+                        done.append(uid)
+                    continue
+                
+                # Gli UID assenti sono stati rimossi nel frattempo: si va oltre
+                if uid in committed:
+                    pass
+                elif item is not None and item.duplicate:
+                    print(f"📬 Email UID {uid} già elaborata ({item.message_id}): ignorata")
+                    done.append(uid)
+                elif isinstance(result, Exception):
+                    attempts = (int(state.get('failed_attempts') or 0) + 1
+                                if state.get('failed_uid') == uid else 1)
+                    if attempts < EMAIL_SYNC_MAX_ATTEMPTS:
+                        print(f"Errore nel processare email UID {uid} (tentativo {attempts}): {result}")
+                        state['failed_uid'] = uid
+                        state['failed_attempts'] = attempts
+                        failed = True
+                        continue
+                    print(f"Email UID {uid} saltata dopo {attempts} tentativi: {result}")
+                elif result:
+                    done.append(uid)
+                
+                state['last_uid'] = uid
+                state['failed_uid'] = None
+                state['failed_attempts'] = 0
+            
+            state['committed_uids'] = _imap_uid_set(uid for uid in committed if uid > state['last_uid'])
+            if done:
+                # Un solo STORE per le email elaborate del blocco
+                mail.uid('STORE', _imap_uid_set(done), '+FLAGS.SILENT', '(\\Seen)')
+                processed += len(done)
+            if failed:
+                break
+            # Punto di ripresa salvato dopo ogni blocco
+            if EmailService.save_sync_state(state):
+                saved = dict(state)
+        
+        if not failed:
+            state['last_uid'] = max(int(state.get('last_uid') or 0), baseline)
+            if first_sync:
+                state['uidvalidity'] = uidvalidity
+        
+        if state != saved:
+            EmailService.save_sync_state(state)
+        
+        return processed
+    
+    @staticmethod
+    def resolve_new_ticket_senders(items, tickets):
+        """
+        Clienti dei mittenti delle email che apriranno un nuovo ticket, creando
+        con un solo inserimento quelli sconosciuti: {email normalizzata: cliente}.
+        """
+        senders = {}
+        for item in items:
+            if item.duplicate or (item.ticket_id and (tickets is None or tickets.get(item.ticket_id))):
+                continue  # Email già elaborata o risposta a un ticket esistente
+            sender_email, sender_name = EmailService.parse_sender(item.message.get("From", ""))
+            senders.setdefault(sender_email, sender_name)
+        if not senders:
+            return {}
+        return CustomerService.get_or_create_by_emails(senders) or {}
+    
+    @staticmethod
+    def prefetch_reply_tickets(items):
+        """
+        Carica con una sola query i ticket a cui rispondono le email scaricate
+        (classificate dagli header): {ticket_id: ticket o None se inesistente}.
+        None se la query fallisce: i ticket vengono allora cercati email per email.
+        """
+        from task_helper import get_many_by_ids_from_supabase
+        
+        ticket_ids = list({item.ticket_id for item in items if item.ticket_id})
+        if not ticket_ids:
+            return {}
+        rows = get_many_by_ids_from_supabase('tickets', ticket_ids)
+        if rows is None:
+            return None
+        found = {row['id']: row for row in rows}
+        return {ticket_id: found.get(ticket_id) for ticket_id in ticket_ids}
+    
+    @staticmethod
+    def process_batch(items, tickets=None, customers=None):
+        """
+        Elabora un blocco di email scaricate (imap_fetch.FetchedMessage).
+        
+        Le email sono divise in gruppi: le risposte per ticket, le nuove
+        richieste per mittente. Ogni gruppo viene preparato in ordine su un
+        worker del pool di task_helper e i gruppi procedono in parallelo;
+        le scritture di tutto il blocco sono poi eseguite in blocco
+        (commit_incoming), a blocchi di non più di un chunk di save_many:
+        ogni scrittura è una sola richiesta, quindi riesce o fallisce per
+        intero, e le email il cui salvataggio in blocco fallisce vengono
+        ritentate una alla volta senza duplicare righe. Un gruppo che non viene preparato
+        entro EMAIL_PROCESS_TIMEOUT dà errore solo per le sue email.
+        Restituisce {uid: True, False (email non utilizzabile) o l'eccezione}.
+        """
+        from task_helper import gather, WRITE_BATCH_SIZE
+        
+        groups = {}
+        for item in items:
+            if not item.duplicate:
+                groups.setdefault(EmailService._group_key(item, tickets), []).append(item)
+        if not groups:
+            return {}
+        
+        plans = {}
+        outcomes = gather(*[(EmailService._plan_group, group, tickets, customers)
+                            for group in groups.values()],
+                          timeout=EMAIL_PROCESS_TIMEOUT, return_exceptions=True)
+        for group, group_plans in zip(groups.values(), outcomes):
+            if isinstance(group_plans, Exception):
+                # Gruppo non preparato in tempo (o fallito): errore per ciascuna email
+                print(f"Preparazione di {len(group)} email non riuscita: {group_plans}")
+                group_plans = {item.uid: group_plans for item in group}
+            plans.update(group_plans)
+        
+        # Le scritture seguono l'ordine di arrivo (UID) delle email
+        results = {}
+        ready = []
+        for item in items:
+            plan = plans.get(item.uid, False)
+            if isinstance(plan, Exception):
+                results[item.uid] = plan
+            elif item.uid in plans:
+                ready.append(item.uid)
+        
+        # Fino a due messaggi per email (risposta e avviso di riapertura)
+        step = max(1, WRITE_BATCH_SIZE // 2)
+        for start in range(0, len(ready), step):
+            chunk = ready[start:start + step]
+            outcome = EmailService.commit_incoming([plans[uid] for uid in chunk])
+            for uid, result in zip(chunk, outcome):
+                if isinstance(result, Exception):
+                    print(f"Salvataggio in blocco non riuscito per l'email UID {uid}: nuovo tentativo singolo")
+                    result = EmailService.commit_incoming([plans[uid]])[0]
+                results[uid] = result
+        return results
+    
+    @staticmethod
+    def _group_key(item, tickets):
+        """Gruppo di elaborazione: il ticket per le risposte, il mittente per le nuove richieste"""
+        if item.ticket_id and (tickets is None or tickets.get(item.ticket_id)):
+            return ('ticket', item.ticket_id)
+        sender_email, _ = EmailService.parse_sender(item.message.get("From", ""))
+        return ('sender', normalize_email(sender_email))
+    
+    @staticmethod
+    def _plan_group(group, tickets, customers):
+        """Prepara in ordine le email di un gruppo: {uid: piano, None o eccezione}"""
+        statuses = {}
+        plans = {}
+        for item in group:
+            try:
+                plans[item.uid] = EmailService.plan_incoming_email(
+                    item.message, tickets, customers, ticket_id=item.ticket_id, statuses=statuses)
+            except Exception as e:
+                plans[item.uid] = e
+        return plans
+    
+    @staticmethod
+    def process_incoming_email(email_msg, tickets=None, customers=None, ticket_id=None):
+        """
+        Aggiunge l'email come messaggio al ticket a cui risponde oppure crea
+        un nuovo ticket. Restituisce True se l'email è stata elaborata.
+        tickets: ticket già caricati per id (vedi prefetch_reply_tickets).
+        customers: clienti già risolti per email normalizzata (vedi resolve_new_ticket_senders).
+        ticket_id: ticket già individuato dagli header (In-Reply-To/References o oggetto).
+        """
+        plan = EmailService.plan_incoming_email(email_msg, tickets, customers, ticket_id=ticket_id)
+        result = EmailService.commit_incoming([plan])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    @staticmethod
+    def plan_incoming_email(email_msg, tickets=None, customers=None, ticket_id=None, statuses=None):
+        """
+        Prepara le scritture per un'email senza eseguirle: un piano con
+        kind 'reply' (messaggio per un ticket esistente, eventualmente da
+        riaprire) o 'new' (nuovo ticket). None se l'email non è utilizzabile.
+        statuses: stati dei ticket cambiati dalle email precedenti dello stesso
+        gruppo (una sola riapertura per più risposte a un ticket risolto).
+        """
+        # Verifica se è una risposta a un ticket esistente
+        subject = ""
+        if email_msg["Subject"]:
+            subject_decoded = decode_header(email_msg["Subject"])[0]
+            if isinstance(subject_decoded[0], bytes):
+                subject = subject_decoded[0].decode(subject_decoded[1] or 'utf-8')
+            else:
+                subject = subject_decoded[0]
+        
+        print(f"📧 Email trovata - Subject: '{subject}' - From: '{email_msg.get('From', '')}'")
+        
+        # Controlla se è una risposta a un ticket
+        ticket_match = re.search(r'(?:Re:\s*)?Ticket\s*#(\d+)', subject, re.IGNORECASE)
+        
+        if ticket_id is None and ticket_match:
+            ticket_id = int(ticket_match.group(1))
+        
+        if ticket_id:
+            # È una risposta a un ticket esistente
+            # Verifica che il ticket esista
+            if tickets is not None and ticket_id in tickets:
+                ticket = tickets[ticket_id]
+            else:
+                ticket = TicketService.get_by_id(ticket_id)
+            
+            if ticket:
+                if statuses is None:
+                    statuses = {}
+                current_status = statuses.get(ticket_id, ticket.get('status', ''))
+                
+                # Estrai info mittente
+                sender_email, sender_name = EmailService.parse_sender(email_msg.get("From", ""))
+                
+                # Estrai corpo messaggio
+                body = ""
+                if email_msg.is_multipart():
+                    for part in email_msg.walk():
+                        if part.get_content_type() == "text/plain":
+                            body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                            break
+                else:
+                    body = email_msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+                
+                # Pulisci il messaggio estraendo solo la parte nuova
+                body = EmailService.clean_reply_message(body)
+                
+                # 🔄 AUTO-RIAPERTURA: Se ticket è RISOLTO e cliente risponde → RIAPRI
+                reopen = current_status == 'Resolved'
+                if reopen:
+                    print(f"🔄 RIAPERTURA AUTOMATICA: Ticket #{ticket_id} era RISOLTO, cliente ha risposto")
+                    statuses[ticket_id] = 'In Progress'
+                
+                return {
+                    'kind': 'reply',
+                    'ticket_id': ticket_id,
+                    'ticket': ticket,
+                    'reopen': reopen,
+                    'email_msg': email_msg,
+                    'message': {
+                        'ticket_id': ticket_id,
+                        'sender_type': 'customer',
+                        'sender_name': sender_name,
+                        'sender_email': sender_email,
+                        'message_text': body.strip(),
+                        'is_internal': False,
+                        'email_message_id': email_msg.get('Message-ID', '')
+                    }
+                }
+        
+        # Non è una risposta, crea un nuovo ticket
+        ticket_data = EmailService.parse_email_for_ticket(email_msg)
+        if not ticket_data:
+            return None
+        
+        # Cliente del mittente: già risolto per il blocco di email,
+        # altrimenti cercato per email (e creato se non esiste)
+        sender_key = normalize_email(ticket_data['customer_email'])
+        customer = customers.get(sender_key) if customers else None
+        if not customer:
+            found = CustomerService.get_or_create_by_emails(
+                {ticket_data['customer_email']: ticket_data['customer_name']})
+            customer = found.get(sender_key) if found else None
+        
+        # Sempre presente: l'inserimento in blocco richiede le stesse colonne per ogni riga
+        ticket_data['customer_id'] = customer['id'] if customer else None
+        return {'kind': 'new', 'ticket_data': ticket_data, 'email_msg': email_msg}
+    
+    @staticmethod
+    def commit_incoming(plans):
+        """
+        Esegue in blocco le scritture preparate da plan_incoming_email, con
+        una richiesta per tipo: riaperture (update_many), nuovi ticket e
+        messaggi (save_many, pubblicati sugli stream SSE dei ticket),
+        Message-ID elaborati, conferme ai clienti (coda).
+        Restituisce, nell'ordine dei piani, True se l'email è stata salvata,
+        False se non era utilizzabile, oppure l'eccezione del salvataggio.
+        """
+        from task_helper import save_many, update_many
+        
+        results = [False if plan is None else None for plan in plans]
+        replies = [(index, plan) for index, plan in enumerate(plans) if plan and plan['kind'] == 'reply']
+        new = [(index, plan) for index, plan in enumerate(plans) if plan and plan['kind'] == 'new']
+        
+        # Riapertura dei ticket risolti a cui il cliente ha risposto
+        reopened = set()
+        reopen_ids = list(dict.fromkeys(plan['ticket_id'] for _, plan in replies if plan['reopen']))
+        if reopen_ids:
+            rows = update_many('tickets', [{'id': ticket_id, 'status': 'In Progress'} for ticket_id in reopen_ids])
+            if rows is None:
+                print(f"❌ Errore nella riapertura dei ticket {reopen_ids}")
+            else:
+                reopened = {row['id'] for row in rows}
+                for ticket_id in reopened:
+                    print(f"✅ Ticket #{ticket_id} riaperto automaticamente: Resolved → In Progress")
+        
+        # Nuovi ticket
+        if new:
+            rows = save_many('tickets', [plan['ticket_data'] for _, plan in new])
+            if rows is None or len(rows) != len(new):
+                error = RuntimeError("Creazione dei ticket da email non riuscita")
+                for index, _ in new:
+                    results[index] = error
+            else:
+                for (index, plan), row in zip(new, rows):
+                    plan['ticket'] = row
+                    results[index] = True
+                    print(f"Ticket creato da email: #{row['id']} - {row['title']}")
+        
+        # Messaggi delle risposte, preceduti dal messaggio di sistema per i ticket riaperti
+        message_rows = []
+        for _, plan in replies:
+            if plan['reopen'] and plan['ticket_id'] in reopened:
+                message_rows.append({
+                    'ticket_id': plan['ticket_id'],
+                    'sender_type': 'system',
+                    'sender_name': 'Sistema CRM',
+                    'sender_email': 'system@crm.local',
+                    'message_text': f"🔄 Ticket riaperto automaticamente - Il cliente {plan['message']['sender_name']} ha risposto a un ticket risolto",
+                    'is_internal': True,
+                    'email_message_id': ''
+                })
+            message_rows.append(plan['message'])
+        if message_rows:
+            saved_messages = save_many('ticket_messages', message_rows)
+            if saved_messages is None:
+                error = RuntimeError("Salvataggio dei messaggi da email non riuscito")
+                for index, _ in replies:
+                    results[index] = error
+            else:
+                # Le chat aperte sui ticket ricevono subito le risposte via SSE
+                publish_messages(saved_messages)
+                for index, plan in replies:
+                    results[index] = True
+                    if plan['ticket_id'] in reopened:
+                        plan['ticket']['status'] = 'In Progress'
+                    print(f"📬 Messaggio aggiunto al ticket #{plan['ticket_id']} da {plan['message']['sender_email']}")
+                    # NON inviare notifica email agli agenti per risposte clienti
+                    # I messaggi appaiono solo nella chat del CRM
+        
+        saved = [plan for index, plan in enumerate(plans) if results[index] is True]
+        
+        # Message-ID delle email elaborate, per riconoscere le riconsegne e le risposte
+        try:
+            entries = [(plan['ticket']['id'], (plan['email_msg'].get('Message-ID') or '').strip())
+                       for plan in saved]
+            if not record_many(entries, 'in'):
+                print("Message-ID delle email elaborate non registrati")
+        except Exception as e:
+            print(f"Errore nella registrazione dei Message-ID: {e}")
+        
+        # Invia conferma al cliente per i nuovi ticket
+        for plan in saved:
+            if plan['kind'] == 'new':
+                email_queue.enqueue('new_ticket', plan['ticket'])
+        
+        return results
+    
     @staticmethod
     def send_ticket_message_to_customer(ticket, message):
         """Invia un messaggio del ticket al cliente via email"""
@@ -853,88 +1065,11 @@ Il Team di Supporto"""
             # Prepara il contenuto email
             subject = f"Re: Ticket #{ticket['id']} - {ticket['title']}"
             
-            # Template HTML cyberpunk uniformato
-            html_body = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: 'Segoe UI', Arial, sans-serif; background: #f5f5f5; margin: 0; padding: 20px; }}
-        .container {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 12px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }}
-        .header {{ background: linear-gradient(135deg, #00ffff 0%, #0066cc 100%); color: white; padding: 30px 25px; text-align: center; }}
-        .header h1 {{ margin: 0; font-size: 24px; font-weight: 600; }}
-        .content {{ padding: 30px 25px; line-height: 1.6; color: #333; }}
-        .message-box {{ background: #f8f9fa; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #00ffff; }}
-        .ticket-info {{ background: #f8f9fa; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #00ffff; }}
-        .footer {{ background: #f8f9fa; padding: 20px 25px; text-align: center; color: #666; font-size: 14px; }}
-        .status-badge {{ background: #00ffff; color: white; padding: 6px 12px; border-radius: 15px; font-size: 12px; font-weight: 600; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>💬 NUOVO MESSAGGIO</h1>
-        </div>
-        <div class="content">
-            <p>Gentile <strong>{ticket['customer_name']}</strong>,</p>
-            
-            <p>Hai ricevuto un nuovo messaggio per il tuo ticket:</p>
-            
-            <div class="ticket-info">
-                <strong>Ticket #{ticket['id']}:</strong> {ticket['title']}<br>
-                <strong>Stato:</strong> <span class="status-badge">{ticket['status']}</span><br>
-                <strong>Priorità:</strong> {ticket['priority']}<br>
-                <strong>Agente:</strong> {message['sender_name']}
-            </div>
-            
-            <div class="message-box">
-                <strong>📨 Messaggio dal supporto:</strong><br><br>
-                {message['message_text'].replace(chr(10), '<br>')}
-            </div>
-            
-            <p><strong>🔄 Per rispondere:</strong></p>
-            <ul>
-                <li>Rispondi direttamente a questa email</li>
-                <li>Il tuo messaggio sarà aggiunto automaticamente al ticket</li>
-                <li>Il nostro team riceverà immediatamente la notifica</li>
-            </ul>
-        </div>
-        <div class="footer">
-            <p>🤖 <strong>CRM Pro v2.7 - Cyberpunk Command Center</strong></p>
-            <p>Questo è un messaggio automatico del sistema di supporto</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
-            
-            # Template testo fallback per client che non supportano HTML
-            text_body = f"""Gentile {ticket['customer_name']},
-
-{message['message_text']}
-
----
-Ticket ID: #{ticket['id']}
-Titolo: {ticket['title']}
-Stato: {ticket['status']}
-Priorità: {ticket['priority']}
-Agente: {message['sender_name']}
-
-Per rispondere, basta rispondere a questa email.
-
-Cordiali saluti,
-Il Team di Supporto CRM Pro"""
-            
-            # Configura SMTP
-            smtp = smtplib.SMTP(config['host'], config['port'])
-            smtp.starttls() if config['security'] == 'TLS' else None
-            smtp.login(config['username'], config['password'])
+            html_body = render('ticket_message.html', ticket=ticket, message=message)
+            # Versione testo per i client che non supportano HTML
+            text_body = render('ticket_message.txt', ticket=ticket, message=message)
             
             # Crea messaggio multipart (HTML + testo)
-            from email.mime.multipart import MIMEMultipart
-            from email.mime.text import MIMEText
-            
             msg = MIMEMultipart('alternative')
             msg.attach(MIMEText(text_body, 'plain', 'utf-8'))
             msg.attach(MIMEText(html_body, 'html', 'utf-8'))
@@ -942,10 +1077,11 @@ Il Team di Supporto CRM Pro"""
             msg['From'] = f"{config['from_name']} <{config['from_email']}>"
             msg['To'] = ticket['customer_email']
             msg['Reply-To'] = config['from_email']
+            msg['Message-ID'] = new_message_id(config['from_email'])
             
-            # Invia
-            smtp.send_message(msg)
-            smtp.quit()
+            # Invia su una sessione SMTP del pool
+            smtp_pool.send_message(config, msg)
+            EmailService.record_message(ticket['id'], msg, 'out')
             
             print(f"Messaggio ticket inviato al cliente: {ticket['customer_email']}")
             return True
@@ -955,42 +1091,51 @@ Il Team di Supporto CRM Pro"""
             return False
     
     @staticmethod
-    def send_ticket_message_to_agents(ticket, message):
-        """Invia un messaggio del cliente agli agenti via email"""
+    def agent_notification_emails(ticket):
+        """Indirizzi degli agenti da notificare per un ticket: agente assegnato + admin"""
+        agent_emails = []
+        
+        # Agente assegnato
+        if ticket.get('assigned_to'):
+            try:
+                # Skip agents table - use users instead
+                from task_helper import get_from_supabase
+                users = get_from_supabase('users', {'full_name': ticket['assigned_to']}, select='email')
+                if users:
+                    agent_emails.append(users[0]['email'])
+            except Exception as e:
+                print(f"Errore nel recupero email agente: {e}")
+        
+        # Admin users
+        try:
+            from task_helper import get_from_supabase
+            
+            admin_users = get_from_supabase('users', 
+                                           filters={'role': 'admin', 'status': 'approved'},
+                                           select='email')
+            admin_emails = [user['email'] for user in (admin_users or [])]
+            agent_emails.extend(admin_emails)
+        except Exception as e:
+            print(f"Errore nel recupero email admin: {e}")
+        
+        # Rimuovi duplicati
+        return list(set(agent_emails))
+    
+    @staticmethod
+    def send_ticket_message_to_agents(ticket, message, recipients=None):
+        """
+        Invia un messaggio del cliente agli agenti via email. recipients limita
+        l'invio a quegli indirizzi (nuovo tentativo): se il server rifiuta alcuni
+        agenti restituisce (False, errore, argomenti del nuovo tentativo), così
+        la coda ritenta solo chi non ha ricevuto il messaggio.
+        """
         try:
             config = EmailService.get_smtp_config()
             if not config:
                 print("Configurazione SMTP non trovata")
                 return False
             
-            # Trova agenti da notificare (agente assegnato + admin)
-            agent_emails = []
-            
-            # Agente assegnato
-            if ticket.get('assigned_to'):
-                try:
-                    # Skip agents table - use users instead
-                    from task_helper import get_from_supabase
-                    users = get_from_supabase('users', {'full_name': ticket['assigned_to']}, select='email')
-                    if users:
-                        agent_emails.append(users[0]['email'])
-                except Exception as e:
-                    print(f"Errore nel recupero email agente: {e}")
-            
-            # Admin users
-            try:
-                from task_helper import get_from_supabase
-                
-                admin_users = get_from_supabase('users', 
-                                               filters={'role': 'admin', 'status': 'approved'},
-                                               select='email')
-                admin_emails = [user['email'] for user in (admin_users or [])]
-                agent_emails.extend(admin_emails)
-            except Exception as e:
-                print(f"Errore nel recupero email admin: {e}")
-            
-            # Rimuovi duplicati
-            agent_emails = list(set(agent_emails))
+            agent_emails = list(recipients or EmailService.agent_notification_emails(ticket))
             
             if not agent_emails:
                 print("Nessun agente da notificare")
@@ -999,47 +1144,35 @@ Il Team di Supporto CRM Pro"""
             # Prepara il contenuto email
             subject = f"Nuovo Messaggio Cliente - Ticket #{ticket['id']}"
             
-            body = f"""Nuovo messaggio ricevuto per il ticket #{ticket['id']}.
-
-Da: {message['sender_name']} ({message['sender_email']})
-Data: {message['created_at']}
-
-Messaggio:
-{message['message_text']}
-
----
-Dettagli Ticket:
-ID: #{ticket['id']}
-Titolo: {ticket['title']}
-Cliente: {ticket['customer_name']} ({ticket['customer_email']})
-Stato: {ticket['status']}
-Priorità: {ticket['priority']}
-Assegnato a: {ticket.get('assigned_to', 'Non assegnato')}
-
-Accedi al CRM per rispondere al cliente.
-
-Il Sistema CRM"""
-            
-            # Configura SMTP
-            smtp = smtplib.SMTP(config['host'], config['port'])
-            smtp.starttls() if config['security'] == 'TLS' else None
-            smtp.login(config['username'], config['password'])
+            body = render('agent_notification.txt', ticket=ticket, message=message)
             
-            # Invia a tutti gli agenti
+            # Un messaggio per agente (nessun agente vede gli indirizzi degli altri),
+            # tutti sulla stessa sessione del pool
+            messages = []
             for agent_email in agent_emails:
+                msg = MIMEText(body)
+                msg['Subject'] = subject
+                msg['From'] = f"{config['from_name']} <{config['from_email']}>"
+                msg['To'] = agent_email
+                msg['Message-ID'] = new_message_id(config['from_email'])
+                messages.append(msg)
+            
+            failed = smtp_pool.send_messages(config, messages)
+            refused = [msg['To'] for msg, _ in failed]
+            delivered = [agent_email for agent_email in agent_emails if agent_email not in refused]
+            if delivered:
+                print(f"Notifica inviata agli agenti: {', '.join(delivered)}")
+                # Le risposte degli agenti alle notifiche consegnate si collegano al ticket
                 try:
-                    msg = MIMEText(body)
-                    msg['Subject'] = subject
-                    msg['From'] = f"{config['from_name']} <{config['from_email']}>"
-                    msg['To'] = agent_email
-                    
-                    smtp.send_message(msg)
-                    print(f"Notifica inviata all'agente: {agent_email}")
-                    
+                    if not record_many([(ticket['id'], msg['Message-ID'].strip())
+                                        for msg in messages if msg['To'] in delivered], 'out'):
+                        print(f"Message-ID non registrati per il ticket #{ticket['id']}")
                 except Exception as e:
-                    print(f"Errore nell'invio a {agent_email}: {e}")
-            
-            smtp.quit()
+                    print(f"Errore nella registrazione dei Message-ID: {e}")
+            if refused:
+                error = '; '.join(f"{msg['To']}: {e}" for msg, e in failed)
+                print(f"❌ Notifica non consegnata a: {error}")
+                return False, f"Destinatari rifiutati: {error}", [ticket, message, refused]
             return True
             
         except Exception as e:
@@ -1058,119 +1191,17 @@ Il Sistema CRM"""
             # Prepara il contenuto dell'email
             subject = "Account CRM Pro Attivato"
             
-            # Template HTML per email di attivazione
-            html_body = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <style>
-                    .email-container {{
-                        max-width: 600px;
-                        margin: 0 auto;
-                        font-family: Arial, sans-serif;
-                        background-color: #f8f9fa;
-                    }}
-                    .email-header {{
-                        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                        color: white;
-                        padding: 30px;
-                        text-align: center;
-                        border-radius: 10px 10px 0 0;
-                    }}
-                    .email-body {{
-                        background: white;
-                        padding: 30px;
-                        border-radius: 0 0 10px 10px;
-                        box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                    }}
-                    .activation-card {{
-                        background: #e8f5e8;
-                        border-left: 4px solid #28a745;
-                        padding: 20px;
-                        margin: 20px 0;
-                        border-radius: 4px;
-                    }}
-                    .user-info {{
-                        background: #f8f9fa;
-                        padding: 15px;
-                        border-radius: 8px;
-                        margin: 15px 0;
-                    }}
-                    .footer {{
-                        text-align: center;
-                        color: #6c757d;
-                        font-size: 12px;
-                        margin-top: 20px;
-                        padding-top: 20px;
-                        border-top: 1px solid #dee2e6;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="email-container">
-                    <div class="email-header">
-                        <h1>🎉 Account Attivato!</h1>
-                        <p>Il tuo account CRM Pro è stato approvato</p>
-                    </div>
-                    
-                    <div class="email-body">
-                        <div class="activation-card">
-                            <h3>✅ Congratulazioni!</h3>
-                            <p>Il tuo account è stato approvato dall'amministratore e ora puoi accedere al sistema CRM Pro.</p>
-                        </div>
-                        
-                        <div class="user-info">
-                            <h4>Dettagli Account:</h4>
-                            <p><strong>Nome:</strong> {user.get('full_name', 'N/A')}</p>
-                            <p><strong>Username:</strong> {user.get('username', 'N/A')}</p>
-                            <p><strong>Email:</strong> {user.get('email', 'N/A')}</p>
-                            <p><strong>Ruolo:</strong> {user.get('role', 'N/A').title()}</p>
-                        </div>
-                        
-                        <h4>Prossimi Passi:</h4>
-                        <ol>
-                            <li>Accedi al sistema CRM Pro con le tue credenziali</li>
-                            <li>Completa il tuo profilo se necessario</li>
-                            <li>Inizia a gestire ticket e clienti</li>
-                        </ol>
-                        
-                        <p>Se hai domande o problemi di accesso, contatta l'amministratore di sistema.</p>
-                        
-                        <div class="footer">
-                            <p>Questa email è stata generata automaticamente dal sistema CRM Pro.</p>
-                            <p>Data di attivazione: {datetime.now().strftime('%d/%m/%Y alle %H:%M')}</p>
-                        </div>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Versione testo semplice
-            text_body = f"""
-            Account CRM Pro Attivato
-            
-            Congratulazioni! Il tuo account è stato approvato dall'amministratore.
-            
-            Dettagli Account:
-            - Nome: {user.get('full_name', 'N/A')}
-            - Username: {user.get('username', 'N/A')}
-            - Email: {user.get('email', 'N/A')}
-            - Ruolo: {user.get('role', 'N/A').title()}
-            
-            Ora puoi accedere al sistema CRM Pro con le tue credenziali.
-            
-            Se hai domande, contatta l'amministratore di sistema.
-            
-            Data di attivazione: {datetime.now().strftime('%d/%m/%Y alle %H:%M')}
-            """
+            activated_at = datetime.now().strftime('%d/%m/%Y alle %H:%M')
+            html_body = render('user_activation.html', user=user, activated_at=activated_at)
+            text_body = render('user_activation.txt', user=user, activated_at=activated_at)
             
             # Crea il messaggio multipart
             msg = MIMEMultipart('alternative')
             msg['From'] = f"{config.get('from_name', 'CRM Pro')} <{config.get('from_email', config['username'])}>"
             msg['To'] = user['email']
             msg['Subject'] = subject
+            # Nessun ticket collegato: il Message-ID non va nell'indice dei thread
+            msg['Message-ID'] = new_message_id(config.get('from_email', config['username']))
             
             # Aggiungi entrambe le versioni
             text_part = MIMEText(text_body, 'plain', 'utf-8')
@@ -1179,17 +1210,8 @@ Il Sistema CRM"""
             msg.attach(text_part)
             msg.attach(html_part)
             
-            # Invia l'email
-            context = ssl.create_default_context()
-            with smtplib.SMTP(config['host'], config['port']) as smtp:
-                if config.get('security') == 'TLS':
-                    smtp.starttls(context=context)
-                elif config.get('security') == 'SSL':
-                    smtp = smtplib.SMTP_SSL(config['host'], config['port'], context=context)
-                
-                smtp.login(config['username'], config['password'])
-                smtp.send_message(msg)
-                smtp.quit()
+            # Invia l'email su una sessione SMTP del pool
+            smtp_pool.send_message(config, msg)
             
             print(f"✅ Email di attivazione inviata a {user['email']}")
             return True
@@ -1198,17 +1220,389 @@ Il Sistema CRM"""
             print(f"❌ Errore nell'invio email di attivazione: {e}")
             return False
 
+# --- Coda delle email in uscita -----------------------------------------------
+#
+# Gli handler HTTP accodano le notifiche e rispondono subito; un pool di worker
+# le invia in background. I job sono salvati in SQLite (sopravvivono a un
+# riavvio) e in caso di errore vengono ritentati con backoff esponenziale.
+
+EMAIL_QUEUE_DB = os.getenv('EMAIL_QUEUE_DB', '/app/data/email_queue.db')
+EMAIL_QUEUE_WORKERS = int(os.getenv('EMAIL_QUEUE_WORKERS', '2'))
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv('EMAIL_QUEUE_MAX_ATTEMPTS', '5'))
+EMAIL_QUEUE_RETRY_BASE = float(os.getenv('EMAIL_QUEUE_RETRY_BASE', '30'))
+EMAIL_QUEUE_RETRY_MAX = float(os.getenv('EMAIL_QUEUE_RETRY_MAX', '3600'))
+EMAIL_QUEUE_RETENTION_DAYS = int(os.getenv('EMAIL_QUEUE_RETENTION_DAYS', '7'))
+# Secondi dopo i quali un job 'running' è considerato abbandonato (processo terminato)
+# e torna disponibile: deve superare di molto la durata di un invio
+EMAIL_QUEUE_LEASE = float(os.getenv('EMAIL_QUEUE_LEASE', '600'))
+
+def _send_ticket_message(ticket_id, message):
+    """Notifica un messaggio del ticket al cliente o agli agenti in base al mittente"""
+    ticket = TicketService.get_by_id(ticket_id)
+    if not ticket:
+        print(f"Ticket #{ticket_id} non trovato per la notifica del messaggio")
+        return True  # niente da ritentare
+    if message.get('sender_type') == 'agent':
+        return EmailService.send_ticket_message_to_customer(ticket, message)
+    return EmailService.send_ticket_message_to_agents(ticket, message)
+
+# Tipo di job -> funzione di invio (riceve gli argomenti salvati nel job)
+EMAIL_JOB_HANDLERS = {
+    'new_ticket': lambda ticket: EmailService.send_new_ticket_notification(ticket),
+    'ticket_resolved': lambda ticket: EmailService.send_ticket_resolved_notification(ticket),
+    'message_to_customer': lambda ticket, message: EmailService.send_ticket_message_to_customer(ticket, message),
+    'message_to_agents': lambda ticket, message, recipients=None: EmailService.send_ticket_message_to_agents(ticket, message, recipients),
+    'ticket_message': _send_ticket_message,
+    'user_activation': lambda user: EmailService.send_user_activation_email(user),
+}
+
+class EmailQueue:
+    """Coda persistente delle notifiche email con pool di worker"""
+    
+    def __init__(self, db_path=EMAIL_QUEUE_DB, workers=EMAIL_QUEUE_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self.running = False
+        self.threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._local = threading.local()
+        self._initialized = False
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        if not self._initialized:
+            self._init_schema(conn)
+        return conn
+    
+    def _init_schema(self, conn):
+        with self._lock:
+            if self._initialized:
+                return
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS email_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_email_jobs_due ON email_jobs (status, next_attempt_at)")
+            self._initialized = True
+    
+    def start(self):
+        """
+        Avvia i worker. I job rimasti 'running' da un processo terminato
+        tornano disponibili solo allo scadere del lease (vedi _claim_next):
+        più processi possono condividere la stessa coda (es. il reloader di
+        Flask in debug) senza rimettere in coda gli invii ancora in corso.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+        try:
+            # I template vengono compilati prima del primo invio
+            warm_up_templates()
+        except Exception as e:
+            print(f"Errore nella compilazione dei template email: {e}")
+        
+        self.threads = []
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"email-queue-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"Coda email avviata con {self.workers} worker")
+    
+    def stop(self):
+        """Ferma i worker (i job in corso vengono completati)"""
+        self.running = False
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        print("Coda email fermata")
+    
+    def enqueue(self, kind, *args, max_attempts=EMAIL_QUEUE_MAX_ATTEMPTS):
+        """Accoda un invio e restituisce l'id del job"""
+        if kind not in EMAIL_JOB_HANDLERS:
+            raise ValueError(f"Tipo di job email non supportato: {kind}")
+        now = time.time()
+        cursor = self._connection().execute(
+            '''INSERT INTO email_jobs (kind, payload, status, attempts, max_attempts, next_attempt_at, created_at, updated_at)
+               VALUES (?, ?, 'pending', 0, ?, ?, ?, ?)''',
+            (kind, json.dumps(list(args), default=str), max_attempts, now, now, now))
+        job_id = cursor.lastrowid
+        
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+    
+    def _claim_next(self):
+        """
+        Prende in carico il prossimo job scaduto (atomico anche tra processi).
+        updated_at di un job 'running' è l'istante della presa in carico: oltre
+        EMAIL_QUEUE_LEASE secondi il job è considerato abbandonato e ripreso.
+        """
+        now = time.time()
+        rows = self._connection().execute(
+            '''UPDATE email_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+               WHERE id = (SELECT id FROM email_jobs
+                           WHERE (status = 'pending' AND next_attempt_at <= ?)
+                              OR (status = 'running' AND updated_at < ?)
+                           ORDER BY next_attempt_at, id LIMIT 1)
+               RETURNING *''',
+            (now, now, now - EMAIL_QUEUE_LEASE)).fetchall()
+        return dict(rows[0]) if rows else None
+    
+    def _next_due_in(self):
+        row = self._connection().execute(
+            "SELECT MIN(next_attempt_at) FROM email_jobs WHERE status = 'pending'").fetchone()
+        if not row or row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+    
+    def _run_job(self, job):
+        try:
+            result = EMAIL_JOB_HANDLERS[job['kind']](*json.loads(job['payload']))
+            # I metodi di invio restituiscono bool oppure (bool, messaggio), con in più
+            # gli argomenti del nuovo tentativo se una parte dell'invio è riuscita
+            retry_args = None
+            if isinstance(result, tuple):
+                success, detail = result[0], result[1] if len(result) > 1 else None
+                retry_args = result[2] if len(result) > 2 else None
+            else:
+                success, detail = bool(result), None
+            return success, None if success else (detail or 'Invio non riuscito'), retry_args
+        except Exception as e:
+            return False, str(e), None
+    
+    def _finish_job(self, job, success, error, retry_args=None):
+        now = time.time()
+        conn = self._connection()
+        # Il nuovo tentativo riguarda solo la parte non inviata
+        payload = job['payload'] if retry_args is None else json.dumps(list(retry_args), default=str)
+        if success:
+            conn.execute("UPDATE email_jobs SET status = 'sent', last_error = NULL, updated_at = ? WHERE id = ?",
+                         (now, job['id']))
+        elif job['attempts'] >= job['max_attempts']:
+            conn.execute("UPDATE email_jobs SET status = 'failed', last_error = ?, payload = ?, updated_at = ? WHERE id = ?",
+                         (error, payload, now, job['id']))
+            print(f"❌ Job email #{job['id']} ({job['kind']}) fallito definitivamente: {error}")
+        else:
+            delay = min(EMAIL_QUEUE_RETRY_BASE * (2 ** (job['attempts'] - 1)), EMAIL_QUEUE_RETRY_MAX)
+            conn.execute(
+                "UPDATE email_jobs SET status = 'pending', last_error = ?, payload = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                (error, payload, now + delay, now, job['id']))
+            print(f"⚠️ Job email #{job['id']} ({job['kind']}) ritentato tra {int(delay)}s: {error}")
+    
+    def _worker_loop(self):
+        last_cleanup = 0
+        while self.running:
+            try:
+                job = self._claim_next()
+                if job:
+                    success, error, retry_args = self._run_job(job)
+                    self._finish_job(job, success, error, retry_args)
+                    continue
+                
+                if time.time() - last_cleanup > 3600:
+                    self.purge()
+                    last_cleanup = time.time()
+                
+                # Attende un nuovo job o la prossima scadenza (max 1s per l'arresto)
+                due_in = self._next_due_in()
+                with self._wakeup:
+                    self._wakeup.wait(1.0 if due_in is None else min(due_in, 1.0))
+            except Exception as e:
+                print(f"Errore nel worker della coda email: {e}")
+                time.sleep(1)
+    
+    def purge(self, days=EMAIL_QUEUE_RETENTION_DAYS):
+        """Elimina i job inviati più vecchi di `days` giorni"""
+        cutoff = time.time() - days * 86400
+        self._connection().execute("DELETE FROM email_jobs WHERE status = 'sent' AND updated_at < ?", (cutoff,))
+    
+    def _job_to_dict(self, row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+    
+    def get_job(self, job_id):
+        """Stato di un job"""
+        row = self._connection().execute("SELECT * FROM email_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_to_dict(row) if row else None
+    
+    def list_jobs(self, status=None, limit=50):
+        """Job più recenti (opzionalmente per stato), senza payload"""
+        query = "SELECT id, kind, status, attempts, max_attempts, next_attempt_at, last_error, created_at, updated_at FROM email_jobs"
+        params = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in self._connection().execute(query, params).fetchall()]
+    
+    def retry_job(self, job_id):
+        """Rimette in coda un job fallito"""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE email_jobs SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'failed'",
+            (now, now, job_id))
+        if cursor.rowcount:
+            self.start()
+            with self._wakeup:
+                self._wakeup.notify()
+        return cursor.rowcount > 0
+    
+    def stats(self):
+        """Numero di job per stato"""
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM email_jobs GROUP BY status").fetchall()
+        counts = {'pending': 0, 'running': 0, 'sent': 0, 'failed': 0}
+        counts.update({row[0]: row[1] for row in rows})
+        return {'workers': self.workers, 'running': self.running, 'jobs': counts}
+
+# Modalità IDLE (RFC 2177): una sessione IMAP resta aperta e il server notifica
+# l'arrivo di nuove email; sui server senza IDLE si torna al controllo periodico
+IMAP_IDLE_ENABLED = os.getenv('IMAP_IDLE_ENABLED', 'true').lower() == 'true'
+# Dopo questo intervallo (secondi) l'IDLE viene rinnovato: i server lo chiudono
+# dopo 30 minuti e i NAT possono scartare prima le connessioni inattive
+IMAP_IDLE_TIMEOUT = float(os.getenv('IMAP_IDLE_TIMEOUT', '300'))
+# Attesa massima delle risposte del server durante l'ingresso/uscita da IDLE
+IMAP_IDLE_RESPONSE_TIMEOUT = 30
+# Granularità dell'attesa: entro questo tempo si reagisce a EXISTS o a stop()
+IMAP_IDLE_TICK = 1.0
+
+_IDLE_NEW_MAIL = re.compile(rb'^\* \d+ (EXISTS|RECENT)\b', re.IGNORECASE)
+
+
+class ImapIdleReader:
+    """
+    Lettura a righe direttamente dal socket della sessione IMAP, con timeout.
+    imaplib non supporta IDLE prima di Python 3.14 e i suoi file bufferizzati
+    diventano inutilizzabili dopo un timeout: durante l'IDLE si legge quindi
+    dal socket con select, senza toccare lo stato di imaplib.
+    """
+    
+    def __init__(self, mail):
+        self.sock = mail.socket()
+        self.buffer = b''
+    
+    def _readable(self, timeout):
+        pending = getattr(self.sock, 'pending', None)
+        if pending and pending() > 0:
+            return True  # Dati TLS già decifrati, invisibili a select
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+    
+    def readline(self, timeout):
+        """Riga successiva, None se non arriva entro timeout"""
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._readable(remaining):
+                return None
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise imaplib.IMAP4.abort('Connessione IMAP chiusa dal server')
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line + b'\n'
+
+
+def imap_supports_idle(mail):
+    return 'IDLE' in getattr(mail, 'capabilities', ())
+
+
+def imap_pending_new_mail(mail):
+    """
+    True se imaplib ha già ricevuto un EXISTS (risposta non richiesta a NOOP,
+    SEARCH, FETCH o STORE): quelle email il server non le notificherà in IDLE.
+    Le risposte vengono consumate, come RECENT che non serve.
+    """
+    mail.untagged_responses.pop('RECENT', None)
+    return bool(mail.untagged_responses.pop('EXISTS', None))
+
+
+def imap_idle(mail, timeout=IMAP_IDLE_TIMEOUT, should_stop=None):
+    """
+    Esegue un ciclo IDLE sulla sessione: attende fino a timeout secondi una
+    notifica di nuove email (EXISTS/RECENT), poi chiude l'IDLE con DONE.
+    Restituisce True se il server ha notificato nuove email.
+    """
+    tag = mail._new_tag()
+    mail.tagged_commands.pop(tag, None)  # Il completamento lo gestiamo qui
+    mail.send(tag + b' IDLE\r\n')
+    
+    reader = ImapIdleReader(mail)
+    new_mail = False
+    line = reader.readline(IMAP_IDLE_RESPONSE_TIMEOUT)
+    while line is not None and line.startswith(b'*'):
+        # Risposte arrivate prima della continuazione: anche qui può esserci un EXISTS
+        if _IDLE_NEW_MAIL.match(line):
+            new_mail = True
+        line = reader.readline(IMAP_IDLE_RESPONSE_TIMEOUT)
+    if line is None or not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE rifiutato dal server: {line!r}")
+    
+    deadline = time.monotonic() + timeout
+    while not new_mail and time.monotonic() < deadline:
+        if should_stop and should_stop():
+            break
+        line = reader.readline(IMAP_IDLE_TICK)
+        if line is None:
+            continue
+        if line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort(line.decode('utf-8', errors='ignore').strip())
+        if _IDLE_NEW_MAIL.match(line):
+            new_mail = True
+    
+    mail.send(b'DONE\r\n')
+    while True:
+        line = reader.readline(IMAP_IDLE_RESPONSE_TIMEOUT)
+        if line is None:
+            raise imaplib.IMAP4.abort('Nessuna risposta alla chiusura di IDLE')
+        if line.startswith(tag + b' '):
+            if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                raise imaplib.IMAP4.error(f"IDLE terminato con errore: {line!r}")
+            return new_mail
+        if _IDLE_NEW_MAIL.match(line):
+            new_mail = True
+
+
 class EmailMonitor:
     """Monitor per il controllo automatico delle email"""
     
     def __init__(self):
         self.running = False
         self.thread = None
+        self.mode = None
+        self._stop_event = threading.Event()
+        self._reconnect = threading.Event()
     
     def start(self):
         """Avvia il monitor"""
         if not self.running:
             self.running = True
+            self._stop_event.clear()
+            self._reconnect.clear()
             self.thread = threading.Thread(target=self._monitor_loop, daemon=True)
             self.thread.start()
             print("Monitor email avviato")
@@ -1216,23 +1610,100 @@ class EmailMonitor:
     def stop(self):
         """Ferma il monitor"""
         self.running = False
+        self._stop_event.set()
         if self.thread:
             self.thread.join()
+        self.mode = None
         print("Monitor email fermato")
     
+    def reconnect(self):
+        """
+        Chiude la sessione IMAP in corso (o interrompe l'attesa): il ciclo
+        successivo rilegge la configurazione e si riconnette
+        """
+        if self.running:
+            print("Monitor email: riconnessione con la nuova configurazione IMAP")
+            self._reconnect.set()
+            self._stop_event.set()
+    
+    def _should_stop(self):
+        return not self.running or self._reconnect.is_set()
+    
     def _monitor_loop(self):
         """Loop di monitoraggio"""
         while self.running:
+            if self._reconnect.is_set():
+                self._reconnect.clear()
+                self._stop_event.clear()
+                if not self.running:
+                    break
+                # Con il nuovo server si riprova l'IDLE
+                self.mode = None
             try:
                 config = EmailService.get_imap_config()
-                if config and config.get('auto_check', 0) > 0:
+                if config and config.get('enabled', False) and config.get('auto_check', 0) > 0:
+                    if IMAP_IDLE_ENABLED and self.mode != 'polling':
+                        if self._idle_session(config):
+                            continue
+                    self.mode = 'polling'
                     EmailService.check_emails_and_create_tickets()
-                    time.sleep(config['auto_check'])
+                    self._stop_event.wait(config['auto_check'])
                 else:
-                    time.sleep(60)  # Controlla ogni 60 secondi se il servizio è attivo (era 15)
+                    self._stop_event.wait(60)  # Controlla ogni 60 secondi se il servizio è attivo (era 15)
             except Exception as e:
                 print(f"Errore nel monitor email: {e}")
-                time.sleep(60)  # Ridotto spam di errori (era 15)
+                self._stop_event.wait(60)  # Ridotto spam di errori (era 15)
+    
+    def _idle_session(self, config):
+        """
+        Mantiene una sessione IMAP in IDLE ed elabora le nuove email appena il
+        server le notifica. Restituisce False se il server non supporta IDLE
+        (il monitor passa al controllo periodico), True quando la sessione
+        termina per stop() o va ricreata dopo un errore di connessione.
+        """
+        mail = EmailService.connect_imap(config)
+        try:
+            if not imap_supports_idle(mail):
+                print("Server IMAP senza IDLE: controllo periodico ogni "
+                      f"{config['auto_check']} secondi")
+                return False
+            
+            self.mode = 'idle'
+            print("📡 Monitor email in modalità IDLE")
+            imap_pending_new_mail(mail)  # EXISTS della SELECT: li copre la prima sincronizzazione
+            EmailService.process_mailbox(mail, config)
+            while not self._should_stop():
+                if imap_pending_new_mail(mail):
+                    # EXISTS ricevuto durante la sincronizzazione o con il NOOP:
+                    # senza rileggere la casella quelle email aspetterebbero il prossimo IDLE
+                    EmailService.process_mailbox(mail, config)
+                    continue
+                new_mail = imap_idle(mail, IMAP_IDLE_TIMEOUT, self._should_stop)
+                if self._should_stop():
+                    break
+                if new_mail:
+                    EmailService.process_mailbox(mail, config)
+                else:
+                    # Rinnovo periodico: verifica anche che la sessione sia viva
+                    mail.noop()
+            return True
+        except (imaplib.IMAP4.abort, OSError) as e:
+            print(f"Sessione IMAP IDLE interrotta, riconnessione: {e}")
+            self._stop_event.wait(5)
+            return True
+        finally:
+            try:
+                mail.logout()
+            except Exception:
+                pass
 
 # Istanza globale del monitor
-email_monitor = EmailMonitor()
\ No newline at end of file
+email_monitor = EmailMonitor()
+
+# Solo un cambio effettivo di configurazione chiude le connessioni aperte
+email_config.on_change('smtp', lambda config: smtp_pool.close_all())
+email_config.on_change('imap', lambda config: email_monitor.reconnect())
+register_write_listener(email_config.on_write)
+
+# Istanza globale della coda email
+email_queue = EmailQueue()
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Template delle email, compilati una sola volta e tenuti in memoria.
+
+- I template HTML/testo delle notifiche sono file Jinja2 in templates/email:
+  l'intestazione e il piè di pagina cyberpunk condivisi sono parziali
+  (partials/) inclusi dal layout comune. Ogni file viene compilato al primo
+  uso (o da warm_up) e non viene più riletto dal disco.
+- I template modificabili dagli amministratori (tabella email_templates, con
+  segnaposto {nome}) sono compilati e memorizzati per (tipo, versione), dove
+  la versione è updated_at della riga. La cache viene invalidata da
+  save_email_template e da ogni scrittura sulla tabella fatta tramite
+  task_helper, e in ogni caso riletta dopo EMAIL_TEMPLATE_TTL secondi.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from string import Formatter
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup, escape
+
+from task_helper import get_from_supabase, register_write_listener
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+
+# Secondi dopo i quali un template del database viene riletto
+EMAIL_TEMPLATE_TTL = int(os.getenv('EMAIL_TEMPLATE_TTL', '300'))
+
+PRIORITY_COLORS = {'Urgent': '#f44336', 'High': '#ff9800'}
+
+
+# ---------------------------------------------------------------------------
+# Template su file (Jinja2)
+# ---------------------------------------------------------------------------
+
+def _priority_color(priority):
+    return PRIORITY_COLORS.get(priority, '#4caf50')
+
+def _truncate_text(value, length=200):
+    value = value or ''
+    return value[:length] + '...' if len(value) > length else value
+
+def _nl2br(value):
+    """Testo con i ritorni a capo come <br> (il testo viene prima escapato)"""
+    return Markup('<br>').join(escape(value or '').split('\n'))
+
+def _message_date(value):
+    if not value:
+        return 'Data non disponibile'
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).strftime('%d/%m/%Y alle %H:%M')
+    except ValueError:
+        return value
+
+
+environment = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(['html']),
+    auto_reload=False,
+    cache_size=-1
+)
+environment.filters.update({
+    'priority_color': _priority_color,
+    'truncate_text': _truncate_text,
+    'nl2br': _nl2br,
+    'message_date': _message_date
+})
+
+
+def render(name, **context):
+    """Renderizza un template di templates/email (compilato una sola volta)"""
+    return environment.get_template(name).render(**context)
+
+
+def warm_up():
+    """Compila subito tutti i template su file (es. all'avvio dell'applicazione)"""
+    names = environment.list_templates(filter_func=lambda name: name.endswith(('.html', '.txt')))
+    for name in names:
+        environment.get_template(name)
+    return len(names)
+
+
+# ---------------------------------------------------------------------------
+# Template del database (segnaposto {nome})
+# ---------------------------------------------------------------------------
+
+class FormatTemplate:
+    """
+    Testo con segnaposto in stile str.format, analizzato una sola volta.
+    I segnaposto sconosciuti restano nel testo invece di far fallire l'invio.
+    """
+
+    def __init__(self, text):
+        self.text = text or ''
+        self._parts = []    # testo fisso, oppure (nome, segnaposto, semplice)
+        for literal, field, spec, conversion in Formatter().parse(self.text):
+            if literal:
+                self._parts.append(literal)
+            if field is not None:
+                placeholder = '{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}'
+                name = field.split('.', 1)[0].split('[', 1)[0]
+                self._parts.append((name, placeholder, placeholder == '{' + name + '}'))
+
+    def render(self, values):
+        out = []
+        for part in self._parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            name, placeholder, simple = part
+            if name not in values:
+                out.append(placeholder)
+            elif simple:
+                out.append(str(values[name]))
+            else:
+                out.append(placeholder.format_map(values))
+        return ''.join(out)
+
+
+class StoredTemplate:
+    """Riga di email_templates con oggetto e corpo compilati"""
+
+    def __init__(self, row):
+        self.row = row
+        self.type = row.get('type')
+        self.version = row.get('updated_at') or row.get('id')
+        self.subject = FormatTemplate(row.get('subject'))
+        self.body = FormatTemplate(row.get('body'))
+
+    def render(self, values):
+        return self.subject.render(values), self.body.render(values)
+
+
+class TemplateCache:
+    """Template del database per tipo, compilati per (tipo, versione)"""
+
+    def __init__(self, ttl=EMAIL_TEMPLATE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._current = {}      # tipo -> (StoredTemplate o None, caricato_alle)
+        self._compiled = {}     # (tipo, versione) -> StoredTemplate
+        self._generation = 0    # incrementata a ogni invalidazione
+        self._stats = {'hits': 0, 'loads': 0, 'compiled': 0, 'invalidations': 0}
+
+    def _count(self, name):
+        self._stats[name] += 1
+
+    def get(self, template_type):
+        """Template compilato del tipo indicato, None se non è nel database"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._current.get(template_type)
+            if entry and now - entry[1] < self.ttl:
+                self._count('hits')
+                return entry[0]
+            generation = self._generation
+
+        rows = get_from_supabase('email_templates', {'type': template_type}, use_cache=False)
+        if rows is None:
+            # Database non raggiungibile: si usa l'ultima versione nota senza memorizzare
+            return entry[0] if entry else None
+
+        with self._lock:
+            self._count('loads')
+            template = None
+            if rows:
+                row = rows[0]
+                key = (template_type, row.get('updated_at') or row.get('id'))
+                template = self._compiled.get(key)
+                if template is None or template.row != row:
+                    template = StoredTemplate(row)
+                    # Le versioni precedenti dello stesso tipo non servono più
+                    self._compiled = {k: v for k, v in self._compiled.items() if k[0] != template_type}
+                    self._compiled[key] = template
+                    self._count('compiled')
+            # Una lettura iniziata prima di un'invalidazione non viene memorizzata
+            if generation == self._generation:
+                self._current[template_type] = (template, now)
+        return template
+
+    def invalidate(self, template_type=None):
+        """Dimentica un tipo (o tutti): la prossima richiesta lo rilegge dal database"""
+        with self._lock:
+            self._count('invalidations')
+            self._generation += 1
+            if template_type is None:
+                self._current.clear()
+            else:
+                self._current.pop(template_type, None)
+
+    def on_write(self, operation, table, rows, filters=None):
+        """Invalida i tipi modificati (listener di task_helper)"""
+        if table != 'email_templates':
+            return
+        types = {row.get('type') for row in rows or []}
+        if not types or None in types:
+            self.invalidate()
+        else:
+            for template_type in types:
+                self.invalidate(template_type)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_types'] = len(self._current)
+            stats['compiled_versions'] = len(self._compiled)
+        return stats
+
+
+# Istanza globale della cache
+template_cache = TemplateCache()
+register_write_listener(template_cache.on_write)
+
+_defaults = {}
+
+
+def render_stored(template_type, default_subject, default_body, **values):
+    """
+    (oggetto, corpo) dal template del database, oppure dal template
+    predefinito se il tipo non è stato personalizzato.
+    """
+    template = template_cache.get(template_type)
+    if template is None:
+        key = (default_subject, default_body)
+        template = _defaults.get(key)
+        if template is None:
+            template = _defaults[key] = StoredTemplate({'type': template_type, 'subject': default_subject,
+                                                        'body': default_body})
+    return template.render(values)
+
+
+def stats():
+    """Stato dei template (per diagnostica)"""
+    return {
+        'compiled_files': len(environment.cache or {}),
+        'stored': template_cache.stats()
+    }
@@ -0,0 +1,108 @@
+"""
+Indice dei Message-ID delle email per collegare le risposte ai ticket.
+
+Ogni notifica inviata a un cliente riceve un Message-ID generato da noi e
+registrato in email_message_index insieme al ticket (direzione 'out'); anche
+le email ricevute e già elaborate sono registrate (direzione 'in'). Le
+risposte si risolvono dai loro In-Reply-To/References con una sola query per
+blocco di email, e le email già elaborate (riconsegne, più cartelle) vengono
+riconosciute dal loro Message-ID.
+"""
+import re
+from email.utils import make_msgid
+
+from task_helper import get_from_supabase, save_many, IDS_CHUNK_SIZE
+
+_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+
+def new_message_id(from_email=None):
+    """Nuovo Message-ID nel dominio del mittente"""
+    domain = from_email.rsplit('@', 1)[-1].strip('> ') if from_email and '@' in from_email else None
+    return make_msgid(domain=domain or None)
+
+
+def extract_message_ids(value):
+    """Message-ID contenuti in un header (Message-ID, In-Reply-To, References)"""
+    return _MESSAGE_ID.findall(str(value or ''))
+
+
+def message_id_of(msg):
+    ids = extract_message_ids(msg.get('Message-ID'))
+    return ids[0] if ids else None
+
+
+def thread_references(msg):
+    """Message-ID a cui l'email risponde, dal più vicino (In-Reply-To) al più lontano"""
+    references = extract_message_ids(msg.get('In-Reply-To'))
+    references += reversed(extract_message_ids(msg.get('References')))
+    return list(dict.fromkeys(references))
+
+
+def record_message_ids(ticket_id, message_ids, direction):
+    """Registra i Message-ID collegati a un ticket (aggiornando quelli già presenti)"""
+    return record_many([(ticket_id, message_id) for message_id in message_ids], direction)
+
+
+def record_many(entries, direction):
+    """Registra con un solo upsert coppie (ticket_id, message_id) di ticket diversi"""
+    rows = {}
+    for ticket_id, message_id in entries:
+        if ticket_id and message_id:
+            rows[message_id] = {'message_id': message_id, 'ticket_id': ticket_id, 'direction': direction}
+    if not rows:
+        return True
+    return save_many('email_message_index', list(rows.values()), on_conflict='message_id') is not None
+
+
+def lookup_message_ids(message_ids):
+    """{message_id: riga dell'indice} per i Message-ID noti; None in caso di errore"""
+    message_ids = list(dict.fromkeys(i for i in message_ids if i))
+    found = {}
+    for start in range(0, len(message_ids), IDS_CHUNK_SIZE):
+        chunk = message_ids[start:start + IDS_CHUNK_SIZE]
+        rows = get_from_supabase('email_message_index', {'message_id': ('in', chunk)},
+                                 select='message_id, ticket_id, direction', use_cache=False)
+        if rows is None:
+            return None
+        for row in rows:
+            found[row['message_id']] = row
+    return found
+
+
+def resolve_threads(items):
+    """
+    Per un blocco di email scaricate (imap_fetch.FetchedMessage) con una sola
+    ricerca nell'indice: imposta ticket_id dalle risposte ai Message-ID noti
+    (prevale sull'oggetto) e segna come duplicate le email già elaborate o
+    ripetute nel blocco. Se l'indice non risponde resta la classificazione
+    per oggetto.
+    """
+    items = list(items)
+    wanted = []
+    for item in items:
+        item.message_id = message_id_of(item.message)
+        item.references = thread_references(item.message)
+        item.duplicate = False
+        wanted.append(item.message_id)
+        wanted.extend(item.references)
+
+    known = lookup_message_ids(wanted) if any(wanted) else {}
+    if known is None:
+        print("Indice Message-ID non disponibile: risposte riconosciute solo dall'oggetto")
+        known = {}
+
+    seen = set()
+    for item in items:
+        if item.message_id:
+            own = known.get(item.message_id)
+            if item.message_id in seen or (own and own.get('direction') == 'in'):
+                item.duplicate = True
+                continue
+            seen.add(item.message_id)
+        for reference in item.references:
+            row = known.get(reference)
+            if row and row.get('ticket_id'):
+                item.ticket_id = row['ticket_id']
+                break
+    return items
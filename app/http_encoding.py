@@ -0,0 +1,270 @@
+"""
+Serializzazione JSON e compressione delle risposte HTTP.
+
+- JSON_PROVIDER=orjson attiva un provider JSON di Flask basato su orjson
+  (opzionale: se il pacchetto manca resta il modulo json standard). L'output
+  è equivalente a quello di jsonify: chiavi ordinate, indentazione in debug,
+  date nel formato HTTP; i caratteri non ASCII sono scritti in UTF-8 invece
+  che come sequenze \\uXXXX.
+- Le risposte testuali (JSON, HTML, testo) più grandi di COMPRESS_MIN_SIZE
+  byte sono compresse con brotli (se installato) o gzip, secondo
+  l'Accept-Encoding del client; oltre COMPRESS_LARGE_SIZE si usa un livello
+  più veloce.
+- json_array_response invia le liste molto lunghe un blocco di elementi alla
+  volta (compresso in streaming), senza costruire l'intero documento in
+  memoria.
+
+Una risposta compressa ha un ETag diverso da quella non compressa (suffisso
+-gzip / -br, come fa Apache): il suffisso viene tolto dagli If-None-Match in
+arrivo, così le GET condizionali continuano a confrontare l'ETag originale.
+"""
+import gzip
+import os
+import zlib
+
+from flask import request, g
+from flask.json.provider import DefaultJSONProvider
+
+# Provider JSON: 'stdlib' (predefinito) oppure 'orjson'
+JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'stdlib').lower()
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'true').lower() == 'true'
+# Byte minimi per comprimere una risposta e soglia oltre la quale si comprime più velocemente
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LARGE_SIZE = int(os.getenv('COMPRESS_LARGE_SIZE', '1048576'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+# Elementi oltre i quali una lista viene inviata in streaming, ed elementi per blocco
+JSON_STREAM_MIN_ITEMS = int(os.getenv('JSON_STREAM_MIN_ITEMS', '1000'))
+JSON_STREAM_CHUNK_ITEMS = 200
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/css',
+                      'application/javascript', 'text/javascript', 'image/svg+xml')
+ETAG_SUFFIXES = ('-br', '-gzip')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# ---------------------------------------------------------------------------
+# Provider JSON
+# ---------------------------------------------------------------------------
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Provider JSON di Flask con orjson; i casi non supportati passano al modulo json"""
+
+    def __init__(self, app):
+        import orjson
+        super().__init__(app)
+        self._orjson = orjson
+
+    def _options(self, indent=None, sort_keys=None):
+        orjson = self._orjson
+        # Le date passano da default() per restare nel formato HTTP di Flask
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps_bytes(self, obj, indent=None, **kwargs):
+        """JSON in bytes UTF-8 (None se orjson non può serializzare l'oggetto)"""
+        if set(kwargs) - {'separators', 'sort_keys', 'default'} or indent not in (None, 2):
+            return None
+        try:
+            return self._orjson.dumps(obj, default=kwargs.get('default', self.default),
+                                      option=self._options(indent, kwargs.get('sort_keys')))
+        except TypeError:
+            # Es. interi oltre 64 bit o tipi sconosciuti: il modulo json decide
+            return None
+
+    def dumps(self, obj, **kwargs):
+        data = self.dumps_bytes(obj, **kwargs)
+        if data is None:
+            return super().dumps(obj, **kwargs)
+        return data.decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return self._orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        data = self.dumps_bytes(obj, indent=indent)
+        if data is None:
+            return super().response(obj)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
+
+
+def configure_json(app):
+    """Attiva il provider orjson se richiesto da JSON_PROVIDER e disponibile"""
+    if JSON_PROVIDER != 'orjson':
+        return False
+    try:
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        print("⚠️ JSON_PROVIDER=orjson ma orjson non è installato: uso il modulo json standard")
+        return False
+    print("✅ Serializzazione JSON con orjson")
+    return True
+
+
+def _serializer(provider):
+    """Funzione valore -> JSON compatto in bytes, con il provider dell'applicazione"""
+    def dumps(obj):
+        if isinstance(provider, OrjsonProvider):
+            data = provider.dumps_bytes(obj)
+            if data is not None:
+                return data
+        return provider.dumps(obj, separators=(',', ':')).encode('utf-8')
+    return dumps
+
+
+# ---------------------------------------------------------------------------
+# Compressione
+# ---------------------------------------------------------------------------
+
+def negotiate_encoding():
+    """'br', 'gzip' o None secondo l'Accept-Encoding della richiesta"""
+    if not RESPONSE_COMPRESSION:
+        return None
+    offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offers)
+
+
+def compress(data, encoding):
+    large = len(data) > COMPRESS_LARGE_SIZE
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(BROTLI_QUALITY, 4) if large else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=min(GZIP_LEVEL, 1) if large else GZIP_LEVEL, mtime=0)
+
+
+class _StreamCompressor:
+    """Compressione incrementale di una risposta in streaming"""
+
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=min(BROTLI_QUALITY, 4))
+            self._compress, self._finish = self._compressor.process, self._compressor.finish
+            self._flush = self._compressor.flush
+        else:
+            self._compressor = zlib.compressobj(min(GZIP_LEVEL, 1), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress, self._finish = self._compressor.compress, self._compressor.flush
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def wrap(self, chunks):
+        for chunk in chunks:
+            data = self._compress(chunk) + self._flush()
+            if data:
+                yield data
+        yield self._finish()
+
+
+def strip_etag_encoding():
+    """before_request: toglie il suffisso di codifica dagli ETag inviati dal client"""
+    value = request.environ.get('HTTP_IF_NONE_MATCH')
+    if not value:
+        return
+    for suffix in ETAG_SUFFIXES:
+        quoted = f'{suffix}"'
+        if quoted in value:
+            request.environ['HTTP_IF_NONE_MATCH'] = value.replace(quoted, '"')
+            g.etag_encoding = suffix
+            return
+
+
+def _add_vary(response):
+    vary = {item.strip().lower() for item in response.headers.get('Vary', '').split(',') if item.strip()}
+    if 'accept-encoding' not in vary:
+        response.headers.add('Vary', 'Accept-Encoding')
+
+
+def _suffix_etag(response, encoding_suffix):
+    etag, weak = response.get_etag()
+    if etag and not weak and not etag.endswith(ETAG_SUFFIXES):
+        response.set_etag(etag + encoding_suffix)
+
+
+def compress_response(response):
+    """after_request: comprime le risposte testuali abbastanza grandi"""
+    if response.status_code == 304:
+        # Stesso ETag della risposta completa che il client ha in cache
+        if g.get('etag_encoding'):
+            _suffix_etag(response, g.etag_encoding)
+        return response
+
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code == 204
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    _add_vary(response)
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding()
+    if not encoding:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    _suffix_etag(response, f'-{encoding}')
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Liste in streaming
+# ---------------------------------------------------------------------------
+
+def _json_array_chunks(rows, dumps):
+    # Eseguito dopo la vista, fuori dal contesto dell'applicazione: riceve già il serializzatore
+    yield b'['
+    for start in range(0, len(rows), JSON_STREAM_CHUNK_ITEMS):
+        chunk = b','.join(dumps(row) for row in rows[start:start + JSON_STREAM_CHUNK_ITEMS])
+        yield (b',' if start else b'') + chunk
+    yield b']\n'
+
+
+def json_array_response(rows):
+    """
+    Lista JSON: con più di JSON_STREAM_MIN_ITEMS elementi (o ?stream=1) viene
+    inviata in streaming un blocco alla volta, compressa se il client lo
+    accetta; altrimenti come jsonify.
+    """
+    from flask import current_app, jsonify
+    rows = rows or []
+    streaming = request.args.get('stream') in ('1', 'true')
+    if len(rows) < JSON_STREAM_MIN_ITEMS and not streaming:
+        return jsonify(rows)
+
+    chunks = _json_array_chunks(rows, _serializer(current_app.json))
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding()
+    if encoding:
+        chunks = _StreamCompressor(encoding).wrap(chunks)
+        headers['Content-Encoding'] = encoding
+    response = current_app.response_class(chunks, mimetype='application/json', headers=headers)
+    if encoding:
+        g.stream_encoding = encoding
+    return response
+
+
+def finish_streamed(response):
+    """after_request: suffisso dell'ETag per le liste in streaming compresse"""
+    encoding = g.get('stream_encoding')
+    if encoding and response.is_streamed:
+        _suffix_etag(response, f'-{encoding}')
+    return response
+
+
+def init_app(app):
+    """Registra provider JSON e compressione sull'applicazione"""
+    configure_json(app)
+    app.before_request(strip_etag_encoding)
+    app.after_request(compress_response)
+    app.after_request(finish_streamed)
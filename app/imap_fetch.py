@@ -0,0 +1,308 @@
+"""
+Scaricamento delle email IMAP in due fasi, per intervalli di UID.
+
+1. Con un solo UID FETCH si leggono, per tutto l'intervallo, gli header utili
+   e la BODYSTRUCTURE: bastano per distinguere risposte e nuovi ticket.
+2. Dalla struttura si individua la parte text/plain di ogni messaggio e si
+   scarica solo quella, al massimo EMAIL_BODY_MAX_BYTES byte, con un comando
+   per ogni sezione distinta (di solito 1 o 1.1).
+
+Gli allegati non vengono mai scaricati. La decodifica dei corpi e la
+costruzione dei messaggi avvengono in parallelo sul pool di task_helper.
+"""
+import base64
+import binascii
+import email
+import os
+import quopri
+import re
+from email.header import decode_header
+from email.parser import BytesHeaderParser
+
+from task_helper import gather
+
+# UID per comando FETCH
+EMAIL_FETCH_BATCH = int(os.getenv('EMAIL_FETCH_BATCH', '100'))
+# Byte massimi scaricati per il corpo testuale di un'email
+EMAIL_BODY_MAX_BYTES = int(os.getenv('EMAIL_BODY_MAX_BYTES', '262144'))
+
+HEADER_FIELDS = ('FROM', 'TO', 'CC', 'REPLY-TO', 'SUBJECT', 'DATE',
+                 'MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES')
+HEADER_SECTION = f"HEADER.FIELDS ({' '.join(HEADER_FIELDS)})"
+
+_LITERAL_MARKER = re.compile(rb'\{(\d+)\}$')
+_TICKET_SUBJECT = re.compile(r'(?:Re:\s*)?Ticket\s*#(\d+)', re.IGNORECASE)
+
+
+class FetchedMessage:
+    """Un'email scaricata: UID, header, parte di testo scelta e messaggio costruito"""
+
+    def __init__(self, uid, headers=b'', structure=None):
+        self.uid = uid
+        self.headers = headers
+        self.structure = structure
+        self.text_part = find_text_part(structure) if structure else None
+        # Classificazione dagli header: risposta a un ticket o nuova richiesta
+        self.ticket_id = ticket_id_from_subject(header_subject(headers))
+        self.body = b''
+        self.message = None
+        # Impostati da email_threading.resolve_threads
+        self.message_id = None
+        self.references = []
+        self.duplicate = False
+
+    @property
+    def truncated(self):
+        return bool(self.text_part and self.text_part['size'] > EMAIL_BODY_MAX_BYTES)
+
+
+# ---------------------------------------------------------------------------
+# Parser delle risposte FETCH
+# ---------------------------------------------------------------------------
+
+def _scan(text):
+    """
+    Token di una porzione di risposta: le parentesi come str '(' e ')',
+    i valori come bytes (None per NIL)
+    """
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i:i + 1]
+        if c in (b' ', b'\r', b'\n'):
+            i += 1
+        elif c in (b'(', b')'):
+            yield c.decode()
+            i += 1
+        elif c == b'"':
+            value = bytearray()
+            i += 1
+            while i < n and text[i:i + 1] != b'"':
+                if text[i:i + 1] == b'\\':
+                    i += 1
+                value += text[i:i + 1]
+                i += 1
+            yield bytes(value)
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < n:
+                c = text[i:i + 1]
+                if c == b'[':
+                    depth += 1
+                elif c == b']':
+                    depth -= 1
+                elif depth == 0 and c in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                i += 1
+            atom = text[start:i]
+            yield None if atom.upper() == b'NIL' else atom
+
+
+def _tokens(data):
+    """Token dell'intera risposta di imaplib (le tuple contengono i literal)"""
+    for item in data or []:
+        if isinstance(item, tuple):
+            text, literal = item
+            yield from _scan(_LITERAL_MARKER.sub(b'', text.rstrip()))
+            yield literal
+        elif isinstance(item, bytes):
+            yield from _scan(item)
+
+
+def _parse_list(tokens):
+    values = []
+    for token in tokens:
+        if token == ')':
+            return values
+        if token == '(':
+            values.append(_parse_list(tokens))
+        else:
+            values.append(token)
+    return values
+
+
+def parse_fetch_response(data):
+    """
+    Risposte FETCH -> {uid: {voce: valore}}; le sezioni BODY[...] sono
+    raccolte in 'BODY' per nome di sezione (es. '1.1', 'HEADER.FIELDS (...)').
+    """
+    tokens = iter(_tokens(data))
+    results = {}
+    for token in tokens:
+        if token != '(':
+            continue  # Numero di sequenza
+        items = _parse_list(tokens)
+        fields = {'BODY': {}}
+        for key, value in zip(items[0::2], items[1::2]):
+            if not isinstance(key, bytes):
+                continue
+            name = key.decode('ascii', errors='ignore').upper()
+            if name.startswith('BODY[') and ']' in name:
+                fields['BODY'][name[5:name.rindex(']')]] = value
+            else:
+                fields[name] = value
+        uid = fields.get('UID')
+        if uid is not None:
+            results[int(uid)] = fields
+    return results
+
+
+# ---------------------------------------------------------------------------
+# BODYSTRUCTURE
+# ---------------------------------------------------------------------------
+
+def _text(value):
+    return value.decode('utf-8', errors='ignore').lower() if isinstance(value, bytes) else ''
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(k): _text(v) for k, v in zip(value[0::2], value[1::2])}
+
+def find_text_part(structure, prefix=''):
+    """
+    Prima parte testuale non allegata (text/plain, oppure l'unico corpo di
+    un'email non multipart): {'section', 'encoding', 'charset', 'size'}.
+    None se l'email non ha testo.
+    """
+    if not isinstance(structure, list) or not structure:
+        return None
+
+    if isinstance(structure[0], list):
+        # Multipart: le sottoparti precedono il sottotipo
+        for index, part in enumerate(p for p in structure if isinstance(p, list)):
+            found = find_text_part(part, f'{prefix}{index + 1}.')
+            if found:
+                return found
+        return None
+
+    main_type, subtype = _text(structure[0]), _text(structure[1])
+    disposition = structure[9] if main_type == 'text' and len(structure) > 9 else None
+    if isinstance(disposition, list) and _text(disposition[0]) == 'attachment':
+        return None
+    if main_type != 'text' or (prefix and subtype != 'plain'):
+        return None
+
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError, IndexError):
+        size = 0
+    return {
+        'section': prefix.rstrip('.') or '1',
+        'encoding': _text(structure[5]) if len(structure) > 5 else '',
+        'charset': _params(structure[2]).get('charset') or 'utf-8',
+        'size': size
+    }
+
+
+# ---------------------------------------------------------------------------
+# Costruzione dei messaggi
+# ---------------------------------------------------------------------------
+
+def decode_body(raw, encoding, charset, truncated=False):
+    """Decodifica il transfer-encoding e il charset di una parte (anche troncata)"""
+    raw = raw or b''
+    try:
+        if encoding == 'base64':
+            data = re.sub(rb'[^A-Za-z0-9+/=]', b'', raw)
+            if truncated:
+                data = data[:len(data) // 4 * 4]
+            raw = base64.b64decode(data)
+        elif encoding == 'quoted-printable':
+            if truncated:
+                raw = raw[:raw.rfind(b'\n') + 1] or raw
+            raw = quopri.decodestring(raw)
+    except (binascii.Error, ValueError):
+        pass
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+def build_message(fetched):
+    """
+    Messaggio email con gli header scaricati e la sola parte di testo come
+    corpo text/plain UTF-8: compatibile con il parsing esistente delle email.
+    """
+    msg = email.message_from_bytes(fetched.headers or b'')
+    part = fetched.text_part
+    text = ''
+    if part:
+        text = decode_body(fetched.body, part['encoding'], part['charset'], fetched.truncated)
+    msg.set_payload(text, 'utf-8')
+    return msg
+
+def header_subject(headers):
+    """Oggetto decodificato da un blocco di header"""
+    value = BytesHeaderParser().parsebytes(headers or b'').get('Subject')
+    if not value:
+        return ''
+    text, charset = decode_header(value)[0]
+    if isinstance(text, bytes):
+        try:
+            return text.decode(charset or 'utf-8', errors='ignore')
+        except LookupError:
+            return text.decode('utf-8', errors='ignore')
+    return text
+
+def ticket_id_from_subject(subject):
+    """ID del ticket se l'oggetto è una risposta (es. 'Re: Ticket #42')"""
+    match = _TICKET_SUBJECT.search(subject or '')
+    return int(match.group(1)) if match else None
+
+
+# ---------------------------------------------------------------------------
+# Pipeline
+# ---------------------------------------------------------------------------
+
+def _uid_fetch(mail, uids, items):
+    status, data = mail.uid('FETCH', ','.join(str(uid) for uid in uids), items)
+    if status != 'OK':
+        raise RuntimeError(f"UID FETCH fallita: {data}")
+    return parse_fetch_response(data)
+
+def fetch_headers(mail, uids):
+    """Header e struttura di tutti gli UID con un solo comando"""
+    fetched = {}
+    for uid, fields in _uid_fetch(mail, uids, f'(UID BODYSTRUCTURE BODY.PEEK[{HEADER_SECTION}])').items():
+        headers = fields['BODY'].get(HEADER_SECTION.upper())
+        if headers is None and fields['BODY']:
+            headers = next(iter(fields['BODY'].values()))
+        fetched[uid] = FetchedMessage(uid, headers or b'', fields.get('BODYSTRUCTURE'))
+    return fetched
+
+def fetch_text_parts(mail, fetched):
+    """Scarica le parti di testo, un comando per ogni sezione distinta"""
+    by_section = {}
+    for item in fetched:
+        if item.text_part:
+            by_section.setdefault(item.text_part['section'], []).append(item)
+
+    for section, items in by_section.items():
+        by_uid = {item.uid: item for item in items}
+        response = _uid_fetch(mail, list(by_uid),
+                              f'(UID BODY.PEEK[{section}]<0.{EMAIL_BODY_MAX_BYTES}>)')
+        for uid, fields in response.items():
+            if uid in by_uid:
+                body = fields['BODY'].get(section)
+                by_uid[uid].body = body if isinstance(body, bytes) else b''
+
+def fetch_messages(mail, uids):
+    """
+    Scarica gli UID indicati (header, poi solo il testo) e costruisce i
+    messaggi in parallelo. Restituisce FetchedMessage in ordine di UID; gli
+    UID non più presenti nella casella sono omessi.
+    """
+    results = []
+    for start in range(0, len(uids), EMAIL_FETCH_BATCH):
+        batch = uids[start:start + EMAIL_FETCH_BATCH]
+        fetched = fetch_headers(mail, batch)
+        items = [fetched[uid] for uid in sorted(fetched)]
+        fetch_text_parts(mail, items)
+
+        messages = gather(*[(build_message, item) for item in items])
+        for item, message in zip(items, messages):
+            item.message = message
+        results.extend(items)
+    return results
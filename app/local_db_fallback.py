@@ -2,21 +2,19 @@
 Fallback database locale usando SQLite per quando Supabase non è disponibile
 """
 import sqlite3
-import json
 import os
 import bcrypt
-from datetime import datetime
-import uuid
 
 DB_PATH = '/app/data/crm_fallback.db'
 
-def init_local_db():
-    """Inizializza il database locale SQLite"""
+def init_local_db(db_path=DB_PATH):
+    """Inizializza il database locale SQLite (schema allineato a Supabase)"""
     try:
         # Crea la directory se non esiste
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         
         # Crea tabella users
@@ -29,6 +27,7 @@ def init_local_db():
                 full_name TEXT NOT NULL,
                 role TEXT DEFAULT 'operator',
                 status TEXT DEFAULT 'approved',
+                is_active BOOLEAN DEFAULT TRUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
@@ -103,6 +102,103 @@ def init_local_db():
             )
         ''')
         
+        # Crea tabella email_templates
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT UNIQUE NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Crea tabelle delle opzioni dei menu a tendina
+        for options_table in ('ticket_software_options', 'ticket_group_options', 'ticket_type_options'):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {options_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    value TEXT UNIQUE NOT NULL,
+                    label TEXT NOT NULL,
+                    is_active BOOLEAN DEFAULT TRUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        
+        # Crea tabella system_settings
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS system_settings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                value TEXT NOT NULL,
+                description TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Crea tabella email_sync_state (sincronizzazione IMAP per UID)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_sync_state (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mailbox TEXT UNIQUE NOT NULL,
+                uidvalidity INTEGER,
+                last_uid INTEGER NOT NULL DEFAULT 0,
+                failed_uid INTEGER,
+                failed_attempts INTEGER NOT NULL DEFAULT 0,
+                committed_uids TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Crea tabella email_message_index (Message-ID delle email dei ticket)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_message_index (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT UNIQUE NOT NULL,
+                ticket_id INTEGER REFERENCES tickets(id) ON DELETE CASCADE,
+                direction TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_message_index_ticket_id ON email_message_index (ticket_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ticket_messages_email_message_id ON ticket_messages (email_message_id)')
+        
+        # Feed delle modifiche: updated_at aggiornato dai trigger (al millisecondo)
+        # e registro delle eliminazioni di ticket e clienti
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS deleted_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                record_id INTEGER NOT NULL,
+                deleted_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_records_table_deleted_at ON deleted_records (table_name, deleted_at, id)')
+        for table in ('tickets', 'customers'):
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_updated_at_id ON {table} (updated_at, id)')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS update_{table}_updated_at
+                AFTER UPDATE ON {table} FOR EACH ROW WHEN NEW.updated_at IS OLD.updated_at
+                BEGIN
+                    UPDATE {table} SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS record_deleted_{table}
+                AFTER DELETE ON {table} FOR EACH ROW
+                BEGIN
+                    INSERT INTO deleted_records (table_name, record_id) VALUES ('{table}', OLD.id);
+                END
+            ''')
+        
+        # Colonne aggiunte dopo la prima versione dello schema locale
+        _ensure_column(cursor, 'users', 'is_active', 'BOOLEAN DEFAULT TRUE')
+        _ensure_column(cursor, 'email_sync_state', 'committed_uids', 'TEXT')
+        _ensure_column(cursor, 'customers', 'email_normalized',
+                       'TEXT GENERATED ALWAYS AS (lower(trim(email))) VIRTUAL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_customers_email_normalized ON customers (email_normalized)')
+        
         conn.commit()
         conn.close()
         
@@ -113,6 +209,13 @@ def init_local_db():
         print(f"❌ Errore nell'inizializzazione database locale: {e}")
         return False
 
+def _ensure_column(cursor, table, column, definition):
+    """Aggiunge una colonna mancante a un database locale già esistente"""
+    # table_xinfo elenca anche le colonne generate
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def create_admin_user():
     """Crea l'utente admin predefinito"""
     try:
@@ -146,6 +249,24 @@ def create_admin_user():
         print(f"❌ Errore nella creazione admin locale: {e}")
         return False
 
+def _build_where_clause(filters):
+    """
+    Traduce il DSL dei filtri di task_helper in una clausola WHERE SQLite.
+    Restituisce (sql, parametri); sql è vuoto se non ci sono filtri.
+    """
+    from storage_backends import build_where_clause
+    return build_where_clause(filters)
+
+_backend = None
+
+def _get_backend():
+    """Backend SQLite sul database locale (lo stesso usato con CRM_DB_BACKEND=sqlite)"""
+    global _backend
+    if _backend is None:
+        from storage_backends import SQLiteBackend
+        _backend = SQLiteBackend(DB_PATH)
+    return _backend
+
 class LocalDBService:
     """Servizio per operazioni database locale"""
     
@@ -153,17 +274,8 @@ class LocalDBService:
     def get_user_by_username(username):
         """Recupera utente per username"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
-            conn.close()
-            
-            if user:
-                return dict(user)
-            return None
+            users = _get_backend().select('users', {'username': username}, limit=1)
+            return users[0] if users else None
             
         except Exception as e:
             print(f"Errore get_user_by_username: {e}")
@@ -173,35 +285,9 @@ class LocalDBService:
     def save_data(table, data, on_conflict=None):
         """Salva dati nel database locale"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            if on_conflict and table == 'email_settings':
-                # Upsert per email_settings
-                cursor.execute("SELECT id FROM email_settings WHERE type = ?", (data.get('type'),))
-                if cursor.fetchone():
-                    # Update
-                    set_clause = ', '.join([f"{k} = ?" for k in data.keys() if k != 'type'])
-                    values = [v for k, v in data.items() if k != 'type']
-                    values.append(data['type'])
-                    
-                    cursor.execute(f"UPDATE email_settings SET {set_clause} WHERE type = ?", values)
-                else:
-                    # Insert
-                    columns = ', '.join(data.keys())
-                    placeholders = ', '.join(['?' for _ in data])
-                    cursor.execute(f"INSERT INTO email_settings ({columns}) VALUES ({placeholders})", list(data.values()))
-            else:
-                # Insert normale
-                columns = ', '.join(data.keys())
-                placeholders = ', '.join(['?' for _ in data])
-                cursor.execute(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", list(data.values()))
-            
-            conn.commit()
-            row_id = cursor.lastrowid
-            conn.close()
-            
-            return [{'id': row_id, **data}]
+            if on_conflict:
+                return _get_backend().upsert(table, data, on_conflict)
+            return _get_backend().insert(table, data)
             
         except Exception as e:
             print(f"Errore save_data: {e}")
@@ -211,36 +297,8 @@ class LocalDBService:
     def get_data(table, filters=None, select="*", order_by=None, limit=None):
         """Recupera dati dal database locale"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            query = f"SELECT {select} FROM {table}"
-            params = []
-            
-            if filters:
-                where_clause = ' AND '.join([f"{k} = ?" for k in filters.keys()])
-                query += f" WHERE {where_clause}"
-                params.extend(filters.values())
-            
-            if order_by:
-                if isinstance(order_by, dict):
-                    order_parts = []
-                    for col, direction in order_by.items():
-                        order_parts.append(f"{col} {direction.upper()}")
-                    query += f" ORDER BY {', '.join(order_parts)}"
-                else:
-                    query += f" ORDER BY {order_by}"
-            
-            if limit:
-                query += f" LIMIT {limit}"
-            
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            conn.close()
-            
-            return [dict(row) for row in rows]
+            return _get_backend().select(table, filters, select, order_by, limit)
             
         except Exception as e:
             print(f"Errore get_data: {e}")
-            return None
\ No newline at end of file
+            return None
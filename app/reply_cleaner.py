@@ -0,0 +1,179 @@
+"""
+Estrazione della parte nuova di una risposta email (senza citazioni e firme).
+
+Il testo viene letto una riga alla volta, senza dividerlo tutto in memoria,
+e la lettura si ferma al primo separatore riconosciuto:
+
+- "-----Messaggio originale-----" / "-----Original Message-----"
+- intestazioni di citazione: "On ... wrote:", "Il ... ha scritto:" (anche
+  spezzate su più righe, come fa Gmail)
+- blocchi di header citati: From:/Da: seguiti da To:/A: e Subject:/Oggetto:
+- il piè di pagina delle notifiche del CRM ("---" + "Ticket ID: #n" ...)
+- la firma standard "-- " e le firme dei client mobili
+- le righe citate con ">" in fondo al messaggio
+
+Ogni riga è confrontata solo nei primi REPLY_SCAN_LINE_CHARS caratteri con
+espressioni precompilate e ancorate, e i separatori su più righe guardano
+avanti al massimo HEADER_BLOCK_LINES righe: il tempo è lineare nella
+lunghezza del testo anche per thread inoltrati di centinaia di KB.
+"""
+import re
+
+# Caratteri di ogni riga esaminati per riconoscere un separatore
+REPLY_SCAN_LINE_CHARS = 1000
+# Righe massime di un blocco di header citati o di un'intestazione spezzata
+HEADER_BLOCK_LINES = 6
+ATTRIBUTION_LINES = 3
+
+# Separatore della firma (RFC 3676): due trattini e uno spazio, da soli sulla riga
+SIGNATURE_DELIMITER = '-- '
+
+_ORIGINAL_MESSAGE = re.compile(
+    r'-{2,}\s*(?:messaggio originale|original message)\s*-{2,}$', re.IGNORECASE)
+_ATTRIBUTION_START = re.compile(r'(?:on|il)\s', re.IGNORECASE)
+_ATTRIBUTION = re.compile(
+    r'(?:on|il)\s[^\n]{0,600}?(?:wrote|ha scritto|scrisse)\s*:$', re.IGNORECASE)
+# Le intestazioni vere contengono una data o un indirizzo ("Il problema ... ha scritto:" no)
+_ATTRIBUTION_DETAIL = re.compile(r'[\d@]')
+# ...oppure sono brevi e iniziano come un'intestazione: "On Monday, John wrote:",
+# "Il giorno lunedì Mario ha scritto:"
+_ATTRIBUTION_SHORT = re.compile(
+    r'(?:On [A-Z][^\n]{0,80}?\swrote|[Ii]l giorno\s[^\n]{0,80}?\s(?:ha scritto|scrisse))\s*:$')
+_HEADER = re.compile(
+    r'\*?(from|da|to|a|cc|sent|inviato|date|data|subject|oggetto)\s*:\*?(?:\s|$)', re.IGNORECASE)
+_TICKET_ID = re.compile(r'ticket\s*id\s*:?\s*#\d+', re.IGNORECASE)
+_CRM_FOOTER_NEXT = re.compile(
+    r'(?:questo è un messaggio automatico del sistema crm|ticket id:\s*#\d+)', re.IGNORECASE)
+_MOBILE_SIGNATURE = re.compile(
+    r'(?:sent from my\s|inviato dal? mio\s|inviato da iphone|get outlook for\s|scarica outlook per\s)', re.IGNORECASE)
+
+_RECIPIENT_HEADERS = {'to', 'a', 'cc'}
+_SUBJECT_HEADERS = {'subject', 'oggetto'}
+_SENDER_HEADERS = {'from', 'da'}
+
+
+def iter_lines(text):
+    """(offset, riga) per ogni riga del testo, senza copiare il resto del testo"""
+    start, length = 0, len(text)
+    while start < length:
+        end = text.find('\n', start)
+        if end == -1:
+            end = length
+        yield start, text[start:end].rstrip('\r')
+        start = end + 1
+
+
+class ReplyScanner:
+    """
+    Riconosce il punto in cui inizia il testo citato. feed() riceve le righe
+    in ordine e restituisce l'offset del taglio appena è certo; finish()
+    chiude la lettura (citazioni con ">" in fondo al messaggio).
+    """
+
+    def __init__(self):
+        self._header_start = None   # Possibile blocco di header citati
+        self._header_keys = set()
+        self._header_lines = 0
+        self._footer_start = None   # Possibile piè di pagina del CRM ("---")
+        self._footer_lines = 0
+        self._attribution = None    # (offset, righe raccolte) di un'intestazione spezzata
+        self._quote_start = None    # Inizio delle righe citate con ">"
+
+    def _check_header(self, offset, line):
+        match = _HEADER.match(line)
+        key = match.group(1).lower() if match else None
+        if key in _SENDER_HEADERS:
+            self._header_start, self._header_keys, self._header_lines = offset, {key}, 1
+            return None
+        if self._header_start is None:
+            return None
+        self._header_lines += 1
+        if key is None or self._header_lines > HEADER_BLOCK_LINES:
+            self._header_start = None
+            return None
+        self._header_keys.add(key)
+        if self._header_keys & _RECIPIENT_HEADERS and self._header_keys & _SUBJECT_HEADERS:
+            return self._header_start
+        return None
+
+    def _check_footer(self, offset, line):
+        if line.startswith('---'):
+            if 'crm' in line.lower() and _TICKET_ID.search(line):
+                return offset
+            self._footer_start, self._footer_lines = offset, 0
+            return None
+        if self._footer_start is None or not line:
+            return None
+        self._footer_lines += 1
+        if _CRM_FOOTER_NEXT.match(line):
+            return self._footer_start
+        if self._footer_lines >= 2:
+            self._footer_start = None
+        return None
+
+    def _check_attribution(self, offset, line):
+        if _ATTRIBUTION_START.match(line):
+            # Una nuova intestazione sostituisce quella in attesa
+            start, lines = offset, [line]
+        elif self._attribution is not None:
+            start, lines = self._attribution
+            lines.append(line)
+        else:
+            return None
+
+        text = ' '.join(lines)
+        if (_ATTRIBUTION.match(text) and _ATTRIBUTION_DETAIL.search(text)) or _ATTRIBUTION_SHORT.match(text):
+            self._attribution = None
+            return start
+        self._attribution = (start, lines) if len(lines) < ATTRIBUTION_LINES else None
+        return None
+
+    def feed(self, offset, line):
+        """Esamina una riga; restituisce l'offset del taglio se il testo citato inizia qui"""
+        # Solo il separatore RFC 3676 "-- " (con lo spazio) indica la firma:
+        # una riga "--" da sola fa parte del testo
+        if line == SIGNATURE_DELIMITER:
+            return offset
+        line = line[:REPLY_SCAN_LINE_CHARS].strip()
+
+        if _ORIGINAL_MESSAGE.match(line) or _MOBILE_SIGNATURE.match(line):
+            return offset
+
+        cuts = [cut for cut in (self._check_attribution(offset, line),
+                                self._check_header(offset, line),
+                                self._check_footer(offset, line)) if cut is not None]
+        if cuts:
+            return min(cuts)
+
+        if line.startswith('>'):
+            if self._quote_start is None:
+                self._quote_start = offset
+        elif line:
+            # Risposta intercalata alle citazioni: le citazioni restano
+            self._quote_start = None
+        return None
+
+    def finish(self):
+        """Offset del taglio per le citazioni in fondo al messaggio (None se non ce ne sono)"""
+        return self._quote_start
+
+
+def find_quote_start(text):
+    """Offset in cui inizia il testo citato, None se il messaggio è tutto nuovo"""
+    scanner = ReplyScanner()
+    for offset, line in iter_lines(text):
+        cut = scanner.feed(offset, line)
+        if cut is not None:
+            return cut
+    return scanner.finish()
+
+
+def clean_reply(body):
+    """Parte nuova della risposta, senza spazi finali e con al più una riga vuota di fila"""
+    if not body:
+        return ""
+    cut = find_quote_start(body)
+    if cut is not None:
+        body = body[:cut]
+    body = body.strip()
+    return re.sub(r'\n{3,}', '\n\n', body)
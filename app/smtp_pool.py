@@ -0,0 +1,188 @@
+"""
+Pool di sessioni SMTP autenticate, condivise tra gli invii.
+
+Le sessioni sono raggruppate per configurazione (host, porta, sicurezza,
+credenziali): un invio riusa una sessione già aperta, ne verifica lo stato
+con NOOP se è rimasta inattiva e, se il server l'ha chiusa, si riconnette
+in modo trasparente.
+"""
+import hashlib
+import os
+import smtplib
+import ssl
+import threading
+import time
+from collections import deque
+
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '4'))
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '120'))
+SMTP_NOOP_AFTER = float(os.getenv('SMTP_NOOP_AFTER', '10'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+
+# Errori che indicano una sessione non più utilizzabile
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, OSError)
+# Errori di un solo messaggio (destinatari rifiutati): la sessione resta valida
+RECIPIENT_ERRORS = (smtplib.SMTPRecipientsRefused,)
+
+
+class SMTPPool:
+    """Sessioni SMTP inattive per configurazione, con limite per configurazione"""
+
+    def __init__(self, max_idle=SMTP_POOL_SIZE, idle_timeout=SMTP_IDLE_TIMEOUT,
+                 noop_after=SMTP_NOOP_AFTER, timeout=SMTP_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.timeout = timeout
+        self._idle = {}     # chiave -> deque di (smtp, ultimo_uso)
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'noop_failures': 0,
+                       'reconnects': 0, 'discarded': 0, 'messages': 0, 'refused': 0}
+
+    @staticmethod
+    def config_key(config):
+        secret = hashlib.sha256(str(config.get('password', '')).encode('utf-8')).hexdigest()
+        return (config['host'], int(config['port']), config.get('security'), config.get('username'), secret)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _connect(self, config):
+        """Apre e autentica una nuova sessione"""
+        context = ssl.create_default_context()
+        if config.get('security') == 'SSL':
+            smtp = smtplib.SMTP_SSL(config['host'], int(config['port']), timeout=self.timeout, context=context)
+        else:
+            smtp = smtplib.SMTP(config['host'], int(config['port']), timeout=self.timeout)
+            if config.get('security') == 'TLS':
+                smtp.starttls(context=context)
+        try:
+            if config.get('username'):
+                smtp.login(config['username'], config['password'])
+        except Exception:
+            self._close(smtp)
+            raise
+        self._count('created')
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, smtp):
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self, config):
+        """Sessione per la configurazione: (smtp, riusata)"""
+        key = self.config_key(config)
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                sessions = self._idle.get(key)
+                entry = sessions.pop() if sessions else None
+            if entry is None:
+                return self._connect(config), False
+
+            smtp, last_used = entry
+            idle_for = now - last_used
+            if idle_for > self.idle_timeout:
+                self._close(smtp)
+                self._count('discarded')
+                continue
+            if idle_for > self.noop_after and not self._is_alive(smtp):
+                self._close(smtp)
+                self._count('noop_failures')
+                continue
+            self._count('reused')
+            return smtp, True
+
+    def release(self, config, smtp):
+        """Restituisce una sessione sana al pool (o la chiude se il pool è pieno)"""
+        key = self.config_key(config)
+        with self._lock:
+            sessions = self._idle.setdefault(key, deque())
+            if len(sessions) < self.max_idle:
+                sessions.append((smtp, time.monotonic()))
+                return
+        self._close(smtp)
+
+    def discard(self, smtp):
+        self._close(smtp)
+        self._count('discarded')
+
+    def _reset(self, smtp, config):
+        try:
+            smtp.rset()
+            self.release(config, smtp)
+        except Exception:
+            self.discard(smtp)
+
+    def send_messages(self, config, messages):
+        """
+        Invia più messaggi sulla stessa sessione autenticata. Ogni messaggio è
+        spedito a tutti i destinatari dei suoi header (To/Cc/Bcc) in un'unica
+        transazione SMTP. Se una sessione riusata risulta chiusa dal server,
+        si riconnette e riprende dal messaggio non inviato.
+        Un messaggio con i destinatari rifiutati non ferma gli altri:
+        restituisce la lista (messaggio, errore) dei messaggi non inviati.
+        """
+        pending = list(messages)
+        failed = []
+        retried = False
+        while pending:
+            smtp, reused = self.acquire(config)
+            try:
+                while pending:
+                    try:
+                        smtp.send_message(pending[0])
+                        self._count('messages')
+                    except RECIPIENT_ERRORS as e:
+                        failed.append((pending[0], e))
+                        self._count('refused')
+                    pending.pop(0)
+            except CONNECTION_ERRORS:
+                self.discard(smtp)
+                if reused and not retried:
+                    retried = True
+                    self._count('reconnects')
+                    continue
+                raise
+            except Exception:
+                self._reset(smtp, config)
+                raise
+            self.release(config, smtp)
+        return failed
+
+    def send_message(self, config, msg):
+        """Invia un messaggio riusando una sessione del pool"""
+        failed = self.send_messages(config, [msg])
+        if failed:
+            raise failed[0][1]
+
+    def close_all(self):
+        """Chiude tutte le sessioni inattive (es. dopo un cambio di configurazione)"""
+        with self._lock:
+            entries = [entry for sessions in self._idle.values() for entry in sessions]
+            self._idle = {}
+        for smtp, _ in entries:
+            self._close(smtp)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle_sessions'] = sum(len(sessions) for sessions in self._idle.values())
+        return stats
+
+
+# Istanza globale del pool SMTP
+smtp_pool = SMTPPool()
@@ -12,6 +12,7 @@ let currentAgent = null;
 // Auto-refresh variables
 let autoRefreshInterval = null;
 let currentTicketId = null;
+let messageEventSource = null;
 
 // ===== SECURITY FUNCTIONS =====
 function escapeHtml(text) {
@@ -351,6 +352,9 @@ function performSecureLogout() {
     if (autoRefreshInterval) {
         clearInterval(autoRefreshInterval);
     }
+    if (messageEventSource) {
+        messageEventSource.close();
+    }
     
     // Show success message briefly
     showNotification('Logout completato con successo', 'success');
@@ -2857,62 +2861,68 @@ styleSheet.textContent = notificationStyles;
 document.head.appendChild(styleSheet);
 
 // Ticket Messages Functions
-async function loadTicketMessages(ticketId) {
-    try {
+// Messaggi già ricevuti del ticket aperto: gli aggiornamenti chiedono solo i nuovi
+let ticketMessagesState = { ticketId: null, messages: [], etag: null, version: null };
+
+async function fetchTicketMessages(ticketId, incremental) {
+    const state = ticketMessagesState;
+    if (!incremental || state.ticketId !== ticketId || !state.etag) {
         const response = await fetchWithAuth(`${API_BASE}/tickets/${ticketId}/messages`);
         const messages = await response.json();
-        
-        const messagesContainer = document.getElementById('ticketMessages');
-        if (!messagesContainer) return;
-        
-        if (messages.length === 0) {
-            messagesContainer.innerHTML = `
-                <div class="no-messages">
-                    <i class="fas fa-comments"></i>
-                    <p>Nessun messaggio ancora. Inizia la conversazione!</p>
-                </div>
-            `;
-            return;
-        }
-        
-        // Genera il nuovo HTML con fumetti
-        const newHTML = messages.map(message => {
-            const messageDate = new Date(message.created_at);
-            const isAgent = message.sender_type === 'agent';
-            const isInternal = message.is_internal;
-            
-            // Determina il tipo di bubble
-            let bubbleClass = isInternal ? 'internal' : (isAgent ? 'agent' : 'customer');
-            
-            return `
-                <div class="message-bubble ${bubbleClass}">
-                    <div class="message-content">
-                        ${escapeHtml(message.message_text).replace(/\n/g, '<br>')}
-                    </div>
-                    <div class="message-meta">
-                        <div class="message-author">
-                            <i class="fas ${isAgent ? 'fa-user-tie' : 'fa-user'}"></i>
-                            ${escapeHtml(message.sender_name)}
-                        </div>
-                        <div class="message-time">${formatMessageDate(messageDate)}</div>
-                    </div>
-                </div>
-            `;
-        }).join('');
-        
-        // Aggiorna solo se il contenuto è diverso (evita lampeggio)
-        const currentHTML = messagesContainer.innerHTML.trim();
-        const newHTMLTrimmed = newHTML.trim();
-        
-        if (currentHTML !== newHTMLTrimmed) {
-            console.log('🔄 Aggiornamento messaggi ticket:', ticketId, 'cambio rilevato');
-            messagesContainer.innerHTML = newHTML;
-            // Scroll to bottom solo se c'è stato un cambiamento
-            messagesContainer.scrollTop = messagesContainer.scrollHeight;
-        } else {
-            console.log('⏭️ Nessun cambio messaggi ticket:', ticketId);
-        }
-        
+        ticketMessagesState = {
+            ticketId, messages, etag: response.headers.get('ETag'),
+            version: response.headers.get('X-Messages-Version')
+        };
+        return messages;
+    }
+    
+    // La lista è ordinata per created_at: il cursore è l'id più alto, non l'ultimo della lista
+    const lastId = state.messages.reduce((max, message) => Math.max(max, message.id), 0);
+    const response = await fetchWithAuth(`${API_BASE}/tickets/${ticketId}/messages?since_id=${lastId}`, {
+        headers: { 'If-None-Match': state.etag }
+    });
+    if (response.status === 304) {
+        return null;  // Nessun messaggio nuovo
+    }
+    if (state.ticketId !== ticketId) return null;
+    const version = response.headers.get('X-Messages-Version');
+    if (version && state.version && version !== state.version) {
+        // Un messaggio è stato modificato o eliminato: i soli nuovi non bastano
+        return fetchTicketMessages(ticketId, false);
+    }
+    const known = new Set(state.messages.map(message => message.id));
+    const newMessages = (await response.json()).filter(message => !known.has(message.id));
+    state.messages = state.messages.concat(newMessages);
+    state.etag = response.headers.get('ETag') || state.etag;
+    return newMessages.length ? state.messages : null;
+}
+
+// Modifica o eliminazione di un messaggio ricevuta via SSE, applicata ai messaggi già caricati
+function applyTicketMessageChange(ticketId, event) {
+    const state = ticketMessagesState;
+    if (state.ticketId !== ticketId || !isTicketChatOpen(ticketId)) return;
+    
+    let change;
+    try {
+        change = JSON.parse(event.data);
+    } catch (error) {
+        return;
+    }
+    if (event.type === 'message_deleted') {
+        state.messages = state.messages.filter(message => message.id !== change.id);
+    } else {
+        state.messages = state.messages.map(message => message.id === change.id ? { ...message, ...change } : message);
+    }
+    if (!document.getElementById('editableTicketDetailsForm')) {
+        renderTicketMessages(ticketId, state.messages);
+    }
+}
+
+async function loadTicketMessages(ticketId, incremental = false) {
+    try {
+        const messages = await fetchTicketMessages(ticketId, incremental);
+        if (messages === null) return;
+        renderTicketMessages(ticketId, messages);
     } catch (error) {
         console.error('Errore nel caricamento messaggi:', error);
         const messagesContainer = document.getElementById('ticketMessages');
@@ -2927,6 +2937,59 @@ async function loadTicketMessages(ticketId) {
     }
 }
 
+function renderTicketMessages(ticketId, messages) {
+    const messagesContainer = document.getElementById('ticketMessages');
+    if (!messagesContainer) return;
+    
+    if (messages.length === 0) {
+        messagesContainer.innerHTML = `
+            <div class="no-messages">
+                <i class="fas fa-comments"></i>
+                <p>Nessun messaggio ancora. Inizia la conversazione!</p>
+            </div>
+        `;
+        return;
+    }
+    
+    // Genera il nuovo HTML con fumetti
+    const newHTML = messages.map(message => {
+        const messageDate = new Date(message.created_at);
+        const isAgent = message.sender_type === 'agent';
+        const isInternal = message.is_internal;
+        
+        // Determina il tipo di bubble
+        let bubbleClass = isInternal ? 'internal' : (isAgent ? 'agent' : 'customer');
+        
+        return `
+            <div class="message-bubble ${bubbleClass}">
+                <div class="message-content">
+                    ${escapeHtml(message.message_text).replace(/\n/g, '<br>')}
+                </div>
+                <div class="message-meta">
+                    <div class="message-author">
+                        <i class="fas ${isAgent ? 'fa-user-tie' : 'fa-user'}"></i>
+                        ${escapeHtml(message.sender_name)}
+                    </div>
+                    <div class="message-time">${formatMessageDate(messageDate)}</div>
+                </div>
+            </div>
+        `;
+    }).join('');
+    
+    // Aggiorna solo se il contenuto è diverso (evita lampeggio)
+    const currentHTML = messagesContainer.innerHTML.trim();
+    const newHTMLTrimmed = newHTML.trim();
+    
+    if (currentHTML !== newHTMLTrimmed) {
+        console.log('🔄 Aggiornamento messaggi ticket:', ticketId, 'cambio rilevato');
+        messagesContainer.innerHTML = newHTML;
+        // Scroll to bottom solo se c'è stato un cambiamento
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    } else {
+        console.log('⏭️ Nessun cambio messaggi ticket:', ticketId);
+    }
+}
+
 // Flag per prevenire invii duplicati
 let isMessageSending = false;
 
@@ -3037,35 +3100,74 @@ function formatMessageDate(date) {
 }
 
 // Auto-refresh functions for ticket messages
+function isTicketChatOpen(ticketId) {
+    return currentTicketId === ticketId && document.getElementById('ticketDetailsModal').style.display === 'block';
+}
+
+function refreshTicketChat(ticketId) {
+    // Only refresh if modal is still open and not being edited
+    if (!isTicketChatOpen(ticketId)) {
+        stopMessageAutoRefresh();
+        return;
+    }
+    if (!document.getElementById('editableTicketDetailsForm')) {
+        loadTicketMessages(ticketId, true);
+    }
+}
+
 function startMessageAutoRefresh(ticketId) {
-    // Stop any existing interval
+    // Stop any existing stream or interval
     stopMessageAutoRefresh();
     
     // Set current ticket ID
     currentTicketId = ticketId;
     
-    // Start new interval - check every 3 seconds for real-time chat
-    autoRefreshInterval = setInterval(() => {
-        if (currentTicketId === ticketId && document.getElementById('ticketDetailsModal').style.display === 'block') {
-            // Only refresh if modal is still open and not being edited
-            const isEditing = document.getElementById('editableTicketDetailsForm');
-            if (!isEditing) {
-                console.log(`💬 Auto-refresh messaggi ticket ${ticketId}`);
-                loadTicketMessages(ticketId);
+    // Server-Sent Events: i messaggi arrivano appena salvati, senza polling
+    const token = localStorage.getItem('user_token');
+    if (window.EventSource && token) {
+        const source = new EventSource(`${API_BASE}/tickets/${ticketId}/events?token=${encodeURIComponent(token)}`);
+        messageEventSource = source;
+        
+        source.addEventListener('message', () => refreshTicketChat(ticketId));
+        // Messaggi modificati o eliminati da altri agenti
+        source.addEventListener('message_updated', event => applyTicketMessageChange(ticketId, event));
+        source.addEventListener('message_deleted', event => applyTicketMessageChange(ticketId, event));
+        // Eventi persi durante una disconnessione: ricarica una volta
+        source.addEventListener('resync', () => refreshTicketChat(ticketId));
+        source.onerror = () => {
+            // Il browser si riconnette da solo; se lo stream è chiuso (es. 401/503) si torna al polling
+            if (messageEventSource === source && source.readyState === EventSource.CLOSED) {
+                console.log(`💬 Stream messaggi non disponibile per ticket ${ticketId}, uso il polling`);
+                messageEventSource = null;
+                startMessagePolling(ticketId);
             }
-        } else {
-            stopMessageAutoRefresh();
-        }
-    }, 3000);
+        };
+        
+        console.log(`💬 Aggiornamento in tempo reale avviato per ticket ${ticketId}`);
+        return;
+    }
+    
+    startMessagePolling(ticketId);
+}
+
+function startMessagePolling(ticketId) {
+    // Start new interval - check every 3 seconds for real-time chat
+    autoRefreshInterval = setInterval(() => refreshTicketChat(ticketId), 3000);
     
     console.log(`💬 Auto-refresh avviato per ticket ${ticketId} (ogni 3 secondi)`);
 }
 
 function stopMessageAutoRefresh() {
+    if (messageEventSource) {
+        messageEventSource.close();
+        messageEventSource = null;
+    }
     if (autoRefreshInterval) {
         clearInterval(autoRefreshInterval);
         autoRefreshInterval = null;
+    }
+    if (currentTicketId !== null) {
         currentTicketId = null;
         console.log('⏹️ Auto-refresh fermato');
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,507 @@
+"""
+Backend di storage usati da task_helper.
+
+Tutti i servizi passano da task_helper, che delega al backend configurato con
+CRM_DB_BACKEND:
+    supabase  (default) PostgREST con pool di connessioni (supabase_pool)
+    sqlite    database locale (CRM_SQLITE_PATH), utile anche per test e benchmark
+    postgres  SQL diretto verso un Postgres on-prem (CRM_DATABASE_URL)
+
+Ogni backend implementa select, insert, upsert, update, delete e count con la
+stessa semantica; in caso di errore solleva un'eccezione.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from dotenv import load_dotenv
+
+from task_helper import iter_filter_predicates, and_filters, OR_KEY, IDS_CHUNK_SIZE, _apply_supabase_filters
+
+load_dotenv()
+
+STORAGE_BACKEND = os.getenv('CRM_DB_BACKEND', 'supabase').lower()
+SQLITE_PATH = os.getenv('CRM_SQLITE_PATH', '/app/data/crm_fallback.db')
+DATABASE_URL = os.getenv('CRM_DATABASE_URL')
+DB_POOL_SIZE = int(os.getenv('CRM_DB_POOL_SIZE', '10'))
+
+# Upsert su colonne senza vincolo UNIQUE negli schemi Supabase/Postgres
+# (supabase_email_migration.sql crea solo un indice): aggiornamento o inserimento
+UPSERT_WITHOUT_CONSTRAINT = {('email_settings', 'type')}
+
+# replace_all delle opzioni attive dei menu (save_config_options): su Supabase
+# la funzione replace_config_options di migration_bulk_config_writes.sql
+# esegue upsert ed eliminazione in un'unica transazione
+REPLACE_ALL_RPC_TABLES = {'ticket_software_options', 'ticket_group_options', 'ticket_type_options'}
+
+
+class StorageBackend:
+    """Interfaccia comune dei backend di storage"""
+
+    name = None
+
+    def select(self, table, filters=None, select='*', order_by=None, limit=None):
+        """Righe che soddisfano i filtri (lista di dizionari)"""
+        raise NotImplementedError
+
+    def insert(self, table, data):
+        """Inserisce una riga (o una lista di righe) e restituisce le righe create"""
+        raise NotImplementedError
+
+    def upsert(self, table, data, on_conflict=None):
+        """Inserisce o aggiorna sulla colonna univoca on_conflict (default id)"""
+        raise NotImplementedError
+
+    def update(self, table, data, filters):
+        """Aggiorna le righe filtrate e le restituisce"""
+        raise NotImplementedError
+
+    def delete(self, table, filters):
+        """Elimina le righe filtrate e le restituisce"""
+        raise NotImplementedError
+
+    def count(self, table, filters=None):
+        """Numero di righe che soddisfano i filtri"""
+        raise NotImplementedError
+
+    def replace_all(self, table, rows, key, filters=None):
+        """
+        Sostituisce le righe nel perimetro `filters` con `rows`: upsert su `key`,
+        poi eliminazione delle righe il cui `key` non è più presente.
+        Non lascia mai la tabella vuota; restituisce (righe_salvate, righe_eliminate).
+        """
+        upserted = self.upsert(table, rows, on_conflict=key) if rows else []
+        keep = {row[key] for row in rows}
+        stale = [row[key] for row in self.select(table, filters, select=key) if row[key] not in keep]
+        deleted = []
+        for start in range(0, len(stale), IDS_CHUNK_SIZE):
+            chunk_filters = and_filters(filters, {key: ('in', stale[start:start + IDS_CHUNK_SIZE])})
+            deleted.extend(self.delete(table, chunk_filters) or [])
+        return upserted, deleted
+
+
+class SupabaseBackend(StorageBackend):
+    """Backend PostgREST (client con pool HTTP di supabase_pool)"""
+
+    name = 'supabase'
+
+    def __init__(self, client_factory=None):
+        self._client_factory = client_factory
+
+    def _client(self):
+        if self._client_factory:
+            return self._client_factory()
+        # Client PostgREST con pool di connessioni, uno per processo
+        from supabase_pool import get_postgrest_client
+        return get_postgrest_client()
+
+    def select(self, table, filters=None, select='*', order_by=None, limit=None):
+        query = self._client().table(table).select(select)
+
+        if filters:
+            query = _apply_supabase_filters(query, filters)
+
+        if order_by:
+            if isinstance(order_by, dict):
+                for col, direction in order_by.items():
+                    desc = direction.lower() == 'desc'
+                    query = query.order(col, desc=desc)
+            else:
+                query = query.order(order_by)
+
+        if limit:
+            query = query.limit(limit)
+
+        return query.execute().data
+
+    def insert(self, table, data):
+        return self._client().table(table).insert(data).execute().data
+
+    def upsert(self, table, data, on_conflict=None):
+        client = self._client()
+        if (table, on_conflict) in UPSERT_WITHOUT_CONSTRAINT and isinstance(data, dict):
+            # Gestione specifica per email_settings (type non è vincolato UNIQUE su Supabase)
+            existing = client.table(table).select('id').eq('type', data.get('type')).execute()
+            if existing.data:
+                return client.table(table).update(data).eq('type', data.get('type')).execute().data
+            return client.table(table).insert(data).execute().data
+
+        if on_conflict:
+            return client.table(table).upsert(data, on_conflict=on_conflict).execute().data
+        return client.table(table).upsert(data).execute().data
+
+    def update(self, table, data, filters):
+        query = self._client().table(table).update(data)
+        query = _apply_supabase_filters(query, filters)
+        return query.execute().data
+
+    def delete(self, table, filters):
+        query = self._client().table(table).delete()
+        query = _apply_supabase_filters(query, filters)
+        # PostgREST restituisce le righe eliminate
+        return query.execute().data
+
+    def replace_all(self, table, rows, key, filters=None):
+        """
+        Per le opzioni dei menu una sola chiamata RPC a replace_config_options,
+        atomica. Le altre tabelle (o un database senza la funzione) usano
+        upsert, select e delete separati: tre richieste HTTP non atomiche.
+        """
+        if table in REPLACE_ALL_RPC_TABLES and key == 'value' and filters == {'is_active': True}:
+            from postgrest.exceptions import APIError
+            try:
+                result = self._client().rpc('replace_config_options', {'p_table': table, 'p_rows': rows}).execute().data
+                return result['upserted'], result['deleted']
+            except APIError as e:
+                if e.code != 'PGRST202':  # PGRST202: funzione non trovata
+                    raise
+                print("Funzione replace_config_options assente (esegui migration_bulk_config_writes.sql): "
+                      f"{table} aggiornata senza transazione")
+        return super().replace_all(table, rows, key, filters)
+
+    def count(self, table, filters=None):
+        query = self._client().table(table).select('id', count='exact')
+        if filters:
+            query = _apply_supabase_filters(query, filters)
+        return query.execute().count
+
+
+def quote_identifier(name):
+    """Quota un identificatore SQL (es. la colonna riservata "group")"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def build_where_clause(filters, placeholder='?', native_ilike=False, native_bool=False):
+    """
+    Traduce il DSL dei filtri di task_helper in una clausola WHERE.
+    Restituisce (sql, parametri); sql è vuoto se non ci sono filtri.
+    """
+    clauses = []
+    params = []
+
+    for column, op, value in iter_filter_predicates(filters):
+        if column == OR_KEY:
+            group_clauses = []
+            for group in value:
+                group_sql, group_params = build_where_clause(group, placeholder, native_ilike, native_bool)
+                if group_sql:
+                    group_clauses.append(f"({group_sql})")
+                    params.extend(group_params)
+            if group_clauses:
+                clauses.append(f"({' OR '.join(group_clauses)})")
+            continue
+
+        col = quote_identifier(column)
+        if op == 'in':
+            values = list(value)
+            if not values:
+                clauses.append("1 = 0")
+                continue
+            clauses.append(f"{col} IN ({', '.join([placeholder] * len(values))})")
+            params.extend(values)
+        elif op in ('is', 'not_is'):
+            negate = op == 'not_is'
+            if value is None or (isinstance(value, str) and value.lower() == 'null'):
+                clauses.append(f"{col} IS {'NOT ' if negate else ''}NULL")
+            else:
+                truth = value in (True, 'true')
+                if native_bool:
+                    clauses.append(f"{col} IS {'NOT ' if negate else ''}{'TRUE' if truth else 'FALSE'}")
+                elif negate:
+                    clauses.append(f"({col} IS NULL OR {col} != {placeholder})")
+                    params.append(1 if truth else 0)
+                else:
+                    clauses.append(f"{col} = {placeholder}")
+                    params.append(1 if truth else 0)
+        elif op == 'ilike':
+            if native_ilike:
+                clauses.append(f"{col} ILIKE {placeholder}")
+            else:
+                clauses.append(f"LOWER({col}) LIKE LOWER({placeholder})")
+            params.append(value)
+        else:
+            sql_op = {'eq': '=', 'neq': '!=', 'gt': '>', 'gte': '>=',
+                      'lt': '<', 'lte': '<=', 'like': 'LIKE'}[op]
+            clauses.append(f"{col} {sql_op} {placeholder}")
+            params.append(value)
+
+    return ' AND '.join(clauses), params
+
+
+class SQLBackend(StorageBackend):
+    """
+    Generazione SQL comune a SQLite e Postgres.
+    Le scritture usano RETURNING per restituire le righe come PostgREST.
+    """
+
+    placeholder = '?'
+    native_ilike = False
+    native_bool = False
+
+    @contextmanager
+    def _cursor(self):
+        """Cursore in una transazione (commit all'uscita, rollback su errore)"""
+        raise NotImplementedError
+
+    def _adapt_value(self, value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    def _row_to_dict(self, row):
+        return dict(row)
+
+    def _execute(self, cursor, statements):
+        rows = []
+        for sql, params in statements:
+            cursor.execute(sql, params)
+            if cursor.description:
+                rows.extend(self._row_to_dict(row) for row in cursor.fetchall())
+        return rows
+
+    def _run(self, statements):
+        """Esegue una o più (sql, parametri) nella stessa transazione"""
+        with self._cursor() as cursor:
+            return self._execute(cursor, statements)
+
+    def _where(self, filters):
+        sql, params = build_where_clause(filters, self.placeholder, self.native_ilike, self.native_bool)
+        return (f" WHERE {sql}" if sql else ""), params
+
+    def _columns(self, select):
+        if not select or select.strip() == '*':
+            return '*'
+        return ', '.join(quote_identifier(col.strip()) for col in select.split(',') if col.strip())
+
+    def _order(self, order_by):
+        if not order_by:
+            return ""
+        if not isinstance(order_by, dict):
+            order_by = {order_by: 'asc'}
+        parts = []
+        for col, direction in order_by.items():
+            # NULL come il valore più grande, come Postgres/PostgREST (anche su SQLite)
+            if str(direction).lower() == 'desc':
+                parts.append(f"{quote_identifier(col)} DESC NULLS FIRST")
+            else:
+                parts.append(f"{quote_identifier(col)} ASC NULLS LAST")
+        return f" ORDER BY {', '.join(parts)}"
+
+    def _insert_statements(self, table, data, conflict_sql=""):
+        rows = data if isinstance(data, list) else [data]
+        # Un'istruzione multi-riga per ogni insieme di colonne
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+
+        statements = []
+        for columns, group in groups.items():
+            if not columns:
+                for _ in group:
+                    statements.append((f"INSERT INTO {quote_identifier(table)} DEFAULT VALUES RETURNING *", []))
+                continue
+            row_sql = f"({', '.join([self.placeholder] * len(columns))})"
+            params = [self._adapt_value(row[col]) for row in group for col in columns]
+            sql = (f"INSERT INTO {quote_identifier(table)} "
+                   f"({', '.join(quote_identifier(col) for col in columns)}) "
+                   f"VALUES {', '.join([row_sql] * len(group))}"
+                   f"{conflict_sql(columns) if conflict_sql else ''} RETURNING *")
+            statements.append((sql, params))
+        return statements
+
+    def select(self, table, filters=None, select='*', order_by=None, limit=None):
+        where, params = self._where(filters)
+        sql = f"SELECT {self._columns(select)} FROM {quote_identifier(table)}{where}{self._order(order_by)}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self._run([(sql, params)])
+
+    def insert(self, table, data):
+        return self._run(self._insert_statements(table, data))
+
+    def _upsert_statements(self, table, data, on_conflict=None):
+        conflict = on_conflict or 'id'
+
+        def conflict_sql(columns):
+            updates = [col for col in columns if col != conflict]
+            if not updates:
+                return f" ON CONFLICT ({quote_identifier(conflict)}) DO NOTHING"
+            assignments = ', '.join(f"{quote_identifier(col)} = excluded.{quote_identifier(col)}" for col in updates)
+            return f" ON CONFLICT ({quote_identifier(conflict)}) DO UPDATE SET {assignments}"
+
+        return self._insert_statements(table, data, conflict_sql)
+
+    def upsert(self, table, data, on_conflict=None):
+        if (table, on_conflict) in UPSERT_WITHOUT_CONSTRAINT:
+            # ON CONFLICT richiede un vincolo UNIQUE: aggiornamento, altrimenti inserimento
+            rows = data if isinstance(data, list) else [data]
+            with self._cursor() as cursor:
+                saved = []
+                for row in rows:
+                    where, params = self._where({on_conflict: row.get(on_conflict)})
+                    assignments = ', '.join(f"{quote_identifier(col)} = {self.placeholder}" for col in row)
+                    updated = self._execute(cursor, [(
+                        f"UPDATE {quote_identifier(table)} SET {assignments}{where} RETURNING *",
+                        [self._adapt_value(v) for v in row.values()] + params)])
+                    saved.extend(updated or self._execute(cursor, self._insert_statements(table, row)))
+                return saved
+        return self._run(self._upsert_statements(table, data, on_conflict))
+
+    def update(self, table, data, filters):
+        if not data:
+            return self.select(table, filters)
+        assignments = ', '.join(f"{quote_identifier(col)} = {self.placeholder}" for col in data)
+        where, params = self._where(filters)
+        sql = f"UPDATE {quote_identifier(table)} SET {assignments}{where} RETURNING *"
+        return self._run([(sql, [self._adapt_value(v) for v in data.values()] + params)])
+
+    def delete(self, table, filters):
+        where, params = self._where(filters)
+        return self._run([(f"DELETE FROM {quote_identifier(table)}{where} RETURNING *", params)])
+
+    def count(self, table, filters=None):
+        where, params = self._where(filters)
+        rows = self._run([(f"SELECT COUNT(*) AS count FROM {quote_identifier(table)}{where}", params)])
+        return rows[0]['count'] if rows else 0
+
+    def replace_all(self, table, rows, key, filters=None):
+        """Come StorageBackend.replace_all, ma in un'unica transazione"""
+        keep = [row[key] for row in rows]
+        delete_filters = and_filters(filters, {key: [('neq', value) for value in keep]}) if keep else filters
+        where, params = self._where(delete_filters)
+        with self._cursor() as cursor:
+            upserted = self._execute(cursor, self._upsert_statements(table, rows, key)) if rows else []
+            deleted = self._execute(cursor, [(f"DELETE FROM {quote_identifier(table)}{where} RETURNING *", params)])
+        return upserted, deleted
+
+
+class SQLiteBackend(SQLBackend):
+    """Backend SQLite locale (una connessione per thread, journal WAL)"""
+
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH, init_schema=True):
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(f"SQLite {sqlite3.sqlite_version} non supporta RETURNING (serve 3.35+)")
+        self.path = path
+        self._local = threading.local()
+        if init_schema:
+            from local_db_fallback import init_local_db
+            init_local_db(path)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _adapt_value(self, value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return super()._adapt_value(value)
+
+    @contextmanager
+    def _cursor(self):
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+class PostgresBackend(SQLBackend):
+    """Backend Postgres diretto con pool di connessioni (psycopg2)"""
+
+    name = 'postgres'
+    placeholder = '%s'
+    native_ilike = True
+    native_bool = True
+
+    def __init__(self, dsn, pool_size=DB_POOL_SIZE):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_pid = None
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        from psycopg2.pool import ThreadedConnectionPool
+        with self._lock:
+            # Dopo un fork (worker gunicorn) ogni processo apre il proprio pool
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadedConnectionPool(1, self.pool_size, self.dsn)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _row_to_dict(self, row):
+        result = {}
+        for key, value in row.items():
+            if isinstance(value, (datetime, date)):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = float(value)
+            result[key] = value
+        return result
+
+    @contextmanager
+    def _cursor(self):
+        from psycopg2.extras import RealDictCursor
+        # Il pool di psycopg2 non attende: il semaforo limita i thread concorrenti
+        with self._slots:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                pool.putconn(conn)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def create_storage_backend(kind=None):
+    """Crea il backend indicato (default CRM_DB_BACKEND)"""
+    kind = (kind or STORAGE_BACKEND).lower()
+    if kind == 'supabase':
+        return SupabaseBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(SQLITE_PATH)
+    if kind in ('postgres', 'postgresql'):
+        if not DATABASE_URL:
+            raise ValueError("CRM_DATABASE_URL richiesto per il backend postgres")
+        return PostgresBackend(DATABASE_URL, DB_POOL_SIZE)
+    raise ValueError(f"Backend di storage non supportato: {kind}")
+
+def get_storage_backend():
+    """Backend in uso (creato alla prima richiesta)"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_storage_backend()
+        return _backend
+
+def set_storage_backend(backend):
+    """Sostituisce il backend in uso (es. SQLiteBackend per test e benchmark)"""
+    global _backend
+    from task_helper import clear_query_cache
+    with _backend_lock:
+        _backend = backend
+    clear_query_cache()
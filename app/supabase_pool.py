@@ -0,0 +1,206 @@
+"""
+Trasporto HTTP con pool di connessioni per il backend Supabase (PostgREST).
+
+Ogni processo (worker gunicorn) usa un proprio client PostgREST con un pool
+httpx condiviso tra i thread: keep-alive, HTTP/2 e timeout sono configurabili
+e le metriche mostrano quante richieste riusano una connessione già aperta.
+"""
+import os
+import threading
+import time
+
+import httpx
+from postgrest import SyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.utils import SyncClient
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
+
+SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', '20'))
+SUPABASE_POOL_KEEPALIVE = int(os.getenv('SUPABASE_POOL_KEEPALIVE', str(SUPABASE_POOL_SIZE)))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv('SUPABASE_KEEPALIVE_EXPIRY', '60'))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv('SUPABASE_CONNECT_TIMEOUT', '5'))
+SUPABASE_READ_TIMEOUT = float(os.getenv('SUPABASE_READ_TIMEOUT', '30'))
+SUPABASE_POOL_TIMEOUT = float(os.getenv('SUPABASE_POOL_TIMEOUT', '10'))
+SUPABASE_HTTP2 = os.getenv('SUPABASE_HTTP2', 'true').lower() == 'true'
+
+
+class PoolMetrics:
+    """Contatori di utilizzo del pool (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.connections_opened = 0
+            self.connections_reused = 0
+            self.errors = 0
+            self.pool_timeouts = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.total_time = 0.0
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self, opened_connection, elapsed, error=None):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.total_time += elapsed
+            if error is not None:
+                self.errors += 1
+                if isinstance(error, httpx.PoolTimeout):
+                    self.pool_timeouts += 1
+            elif opened_connection:
+                self.connections_opened += 1
+            else:
+                self.connections_reused += 1
+
+    def snapshot(self):
+        with self._lock:
+            completed = self.connections_opened + self.connections_reused
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': self.connections_reused,
+                'reuse_ratio': round(self.connections_reused / completed, 3) if completed else None,
+                'errors': self.errors,
+                'pool_timeouts': self.pool_timeouts,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'avg_request_ms': round(self.total_time / self.requests * 1000, 1) if self.requests else None
+            }
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    """
+    Trasporto httpx che misura le richieste: usa l'estensione trace di httpcore
+    per sapere se la richiesta ha aperto una nuova connessione TCP.
+    """
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    def handle_request(self, request):
+        opened = []
+        previous_trace = request.extensions.get('trace')
+
+        def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.complete':
+                opened.append(True)
+            if previous_trace:
+                previous_trace(event_name, info)
+
+        request.extensions['trace'] = trace
+        self.metrics.request_started()
+        start = time.monotonic()
+        try:
+            response = super().handle_request(request)
+        except Exception as e:
+            self.metrics.request_finished(bool(opened), time.monotonic() - start, error=e)
+            raise
+        self.metrics.request_finished(bool(opened), time.monotonic() - start)
+        return response
+
+    def pool_state(self):
+        """Connessioni aperte nel pool (attive e inattive)"""
+        connections = list(getattr(self._pool, 'connections', []))
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {'open': len(connections), 'idle': idle, 'active': len(connections) - idle}
+
+
+class PooledPostgrestClient(SyncPostgrestClient):
+    """Client PostgREST con limiti di pool, keep-alive e timeout configurabili"""
+
+    def __init__(self, base_url, metrics, **kwargs):
+        self.metrics = metrics
+        self.transport = None
+        super().__init__(base_url, **kwargs)
+
+    def create_session(self, base_url, headers, timeout, verify=True):
+        self.transport = MeteredTransport(
+            self.metrics,
+            verify=verify,
+            http2=SUPABASE_HTTP2,
+            limits=httpx.Limits(max_connections=SUPABASE_POOL_SIZE,
+                                max_keepalive_connections=SUPABASE_POOL_KEEPALIVE,
+                                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY),
+        )
+        return SyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(SUPABASE_READ_TIMEOUT,
+                                  connect=SUPABASE_CONNECT_TIMEOUT,
+                                  pool=SUPABASE_POOL_TIMEOUT),
+            follow_redirects=True,
+            transport=self.transport,
+        )
+
+
+_metrics = PoolMetrics()
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_postgrest_client():
+    """
+    Client PostgREST del processo corrente. Dopo un fork (worker gunicorn con
+    preload) viene creato un nuovo client: i socket del padre non si condividono.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            if _client_pid is not None and _client_pid != pid:
+                # Processo figlio: le metriche ereditate sono quelle del padre
+                _metrics.reset()
+            _client = PooledPostgrestClient(
+                f"{SUPABASE_URL}/rest/v1",
+                metrics=_metrics,
+                headers={
+                    **DEFAULT_POSTGREST_CLIENT_HEADERS,
+                    'apiKey': SUPABASE_ANON_KEY,
+                    'Authorization': f'Bearer {SUPABASE_ANON_KEY}',
+                },
+            )
+            _client_pid = pid
+        return _client
+
+def close_postgrest_client():
+    """Chiude le connessioni del client del processo corrente"""
+    global _client
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.aclose()
+        _client = None
+
+def get_pool_stats():
+    """Metriche del pool HTTP verso Supabase"""
+    stats = {
+        'pid': os.getpid(),
+        'config': {
+            'max_connections': SUPABASE_POOL_SIZE,
+            'max_keepalive': SUPABASE_POOL_KEEPALIVE,
+            'keepalive_expiry': SUPABASE_KEEPALIVE_EXPIRY,
+            'http2': SUPABASE_HTTP2,
+        },
+        'metrics': _metrics.snapshot(),
+        'pool': None,
+    }
+    client = _client if _client_pid == os.getpid() else None
+    if client is not None and client.transport is not None:
+        stats['pool'] = client.transport.pool_state()
+    return stats
@@ -0,0 +1,85 @@
+"""
+Versioni in memoria delle tabelle per le GET condizionali (ETag / 304).
+
+Ogni scrittura fatta tramite task_helper (save/update/delete, in blocco o
+singole) incrementa la versione della tabella scritta. L'ETag di una risposta
+si ricava dalle versioni delle tabelle da cui dipende e dall'URL richiesto,
+senza leggere il database: se il browser ripresenta lo stesso ETag la
+risposta non è cambiata e si risponde 304.
+
+Le scritture fatte fuori da questo processo (SQL diretto, altri worker, il
+secondo processo del reloader) non passano dai listener: per questo gli ETag
+scadono comunque. Le tabelle con una TTL nella cache delle query
+(QUERY_CACHE_TTLS) sono già servite dalla cache per quel tempo e usano la
+stessa durata; le altre (ticket, clienti, utenti), lette sempre dal database,
+scadono dopo TABLE_VERSION_MAX_AGE secondi (pochi: un 304 non deve
+nascondere a lungo modifiche fatte altrove). Anche un riavvio del processo
+cambia tutti gli ETag.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from task_helper import register_write_listener, QUERY_CACHE_TTLS
+
+# Secondi dopo i quali un ETag scade anche senza scritture note, per le tabelle
+# senza TTL nella cache delle query (0 = mai)
+TABLE_VERSION_MAX_AGE = int(os.getenv('TABLE_VERSION_MAX_AGE', '5'))
+
+
+class TableVersions:
+    """Contatore di scritture per tabella, aggiornato dal listener di task_helper"""
+
+    def __init__(self, max_age=TABLE_VERSION_MAX_AGE, max_ages=None):
+        self.max_age = max_age
+        self.max_ages = dict(QUERY_CACHE_TTLS if max_ages is None else max_ages)
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def bump(self, table=None):
+        """Nuova versione di una tabella (o di tutte, se table è None)"""
+        with self._lock:
+            if table is None:
+                # Le tabelle mai scritte partono da 0: cambiando l'epoca cambiano anche loro
+                self.epoch = uuid.uuid4().hex[:8]
+                self._versions.clear()
+            else:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def on_write(self, operation, table, rows, filters=None):
+        """Listener di task_helper: ogni scrittura riuscita cambia la versione"""
+        self.bump(table)
+
+    def version(self, table):
+        with self._lock:
+            return self._versions.get(table, 0)
+    
+    def max_age_of(self, tables):
+        """Durata di un ETag che dipende da tables: la più breve tra le tabelle"""
+        return min((self.max_ages.get(table, self.max_age) for table in tables), default=self.max_age)
+
+    def etag(self, tables, resource=''):
+        """
+        ETag forte per una risorsa che dipende da tables: cambia con le loro
+        versioni, con la risorsa (URL e parametri) e allo scadere di max_age_of(tables).
+        """
+        max_age = self.max_age_of(tables)
+        window = int(time.time() // max_age) if max_age > 0 else 0
+        with self._lock:
+            versions = '.'.join(str(self._versions.get(table, 0)) for table in tables)
+            epoch = self.epoch
+        digest = hashlib.blake2b(resource.encode(), digest_size=6).hexdigest()
+        return f'{epoch}-{window}-{versions}-{digest}'
+
+    def stats(self):
+        with self._lock:
+            return {'epoch': self.epoch, 'max_age': self.max_age, 'max_ages': dict(self.max_ages),
+                    'versions': dict(self._versions)}
+
+
+# Istanza globale, aggiornata da tutte le scritture di task_helper
+table_versions = TableVersions()
+register_write_listener(table_versions.on_write)
@@ -4,94 +4,410 @@ Helper completo per usare MCP Supabase server dal Python
 import subprocess
 import json
 import os
+import base64
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# --- Cache delle query -------------------------------------------------------
+#
+# Cache in-process read-through per get_from_supabase e count_in_supabase.
+# Ogni scrittura (save/update/delete) su una tabella invalida le sue voci.
+# Le tabelle senza TTL (o con TTL 0) non vengono mai messe in cache.
+
+QUERY_CACHE_TTLS = {
+    # Tabelle di configurazione: lette quasi a ogni richiesta, cambiano raramente
+    'ticket_software_options': 300,
+    'ticket_group_options': 300,
+    'ticket_type_options': 300,
+    'system_settings': 300,
+    'email_settings': 300,
+    'email_templates': 300,
+}
+QUERY_CACHE_DEFAULT_TTL = int(os.getenv('QUERY_CACHE_DEFAULT_TTL', '0'))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '512'))
+
+class QueryCache:
+    """Cache LRU con TTL per tabella e invalidazione sulle scritture"""
+    
+    def __init__(self, max_entries=512, ttls=None, default_ttl=0):
+        self.max_entries = max_entries
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()   # key -> (expires_at, table, value)
+        self._generations = {}          # table -> contatore scritture
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        self._table_stats = {}
+    
+    def ttl_for(self, table):
+        return self.ttls.get(table, self.default_ttl)
+    
+    @staticmethod
+    def make_key(kind, table, *parts):
+        return (kind, table, json.dumps(parts, sort_keys=True, default=str))
+    
+    def generation(self, table):
+        with self._lock:
+            return self._generations.get(table, 0)
+    
+    def _count(self, table, stat):
+        self._stats[stat] += 1
+        table_stats = self._table_stats.setdefault(table, {'hits': 0, 'misses': 0})
+        table_stats[stat] += 1
+    
+    def get(self, key):
+        """Restituisce (hit, valore); il valore è una copia sicura da modificare"""
+        table = key[1]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._count(table, 'misses')
+                return False, None
+            expires_at, _, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._count(table, 'misses')
+                return False, None
+            self._entries.move_to_end(key)
+            self._count(table, 'hits')
+        return True, copy.deepcopy(value)
+    
+    def set(self, key, value, generation):
+        """Memorizza un risultato se nessuna scrittura è avvenuta durante la lettura"""
+        table = key[1]
+        ttl = self.ttl_for(table)
+        if ttl <= 0 or value is None:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            if self._generations.get(table, 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + ttl, table, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+    
+    def invalidate(self, table=None):
+        """Invalida le voci di una tabella (o tutta la cache se table è None)"""
+        with self._lock:
+            if table is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                for name in self._generations:
+                    self._generations[name] += 1
+            else:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                stale = [key for key, entry in self._entries.items() if entry[1] == table]
+                for key in stale:
+                    del self._entries[key]
+                removed = len(stale)
+            self._stats['invalidations'] += removed
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_ratio': round(self._stats['hits'] / lookups, 4) if lookups else 0.0,
+                'tables': copy.deepcopy(self._table_stats)
+            }
+
+_query_cache = QueryCache(max_entries=QUERY_CACHE_MAX_ENTRIES,
+                          ttls=QUERY_CACHE_TTLS,
+                          default_ttl=QUERY_CACHE_DEFAULT_TTL)
+
+# --- Listener sulle scritture --------------------------------------------------
+#
+# Componenti in-process (contatori dashboard, indici in memoria, ...) possono
+# registrarsi per ricevere le righe scritte: callback(operazione, tabella, righe, filtri)
+# con operazione in 'insert', 'upsert', 'update', 'delete'.
+
+_write_listeners = []
+
+def register_write_listener(callback):
+    """
+    Registra una callback invocata dopo ogni scrittura riuscita.
+    """
+    if callback not in _write_listeners:
+        _write_listeners.append(callback)
+
+def _notify_write(operation, table, rows, filters=None):
+    """
+    Notifica i listener; un errore in un listener non blocca la scrittura.
+    """
+    if isinstance(rows, dict):
+        rows = [rows]
+    elif not isinstance(rows, list):
+        rows = []
+    for callback in list(_write_listeners):
+        try:
+            callback(operation, table, rows, filters)
+        except Exception as e:
+            print(f"Errore listener scrittura {table}: {e}")
+
+# --- Esecuzione parallela delle query ------------------------------------------
+#
+# Ogni round trip verso Supabase costa decine di millisecondi: gli endpoint che
+# eseguono più query indipendenti le lanciano insieme con gather().
+
+QUERY_POOL_SIZE = int(os.getenv('QUERY_POOL_SIZE', '8'))
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', '15'))
+
+_query_pool = None
+_query_pool_lock = threading.Lock()
+_query_pool_local = threading.local()
+
+def _get_query_pool():
+    global _query_pool
+    with _query_pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPoolExecutor(max_workers=QUERY_POOL_SIZE,
+                                             thread_name_prefix='query')
+        return _query_pool
+
+def _run_in_pool(func, args):
+    _query_pool_local.active = True
+    try:
+        return func(*args)
+    finally:
+        _query_pool_local.active = False
+
+def _split_call(call):
+    """Normalizza una chiamata: funzione senza argomenti oppure (funzione, *args)"""
+    if callable(call):
+        return call, ()
+    func, *args = call
+    return func, tuple(args)
+
+def _call_capturing(func, args):
+    """Esegue una chiamata restituendo l'eccezione invece di sollevarla"""
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+
+def gather(*calls, timeout=None, return_exceptions=False):
+    """
+    Esegue in parallelo chiamate indipendenti e restituisce i risultati nell'ordine.
+    
+    Esempio:
+        total, users = gather((count_in_supabase, 'tickets'),
+                              (get_from_supabase, 'users', {'status': 'approved'}))
+    
+    Per argomenti keyword usare functools.partial.
+    Ogni chiamata ha a disposizione `timeout` secondi (default QUERY_TIMEOUT);
+    allo scadere viene sollevato TimeoutError. Un'eccezione in una chiamata viene
+    rilanciata al chiamante; con return_exceptions=True le eccezioni (compreso il
+    TimeoutError) prendono invece il posto del risultato della singola chiamata.
+    Chiamato da un thread del pool esegue in sequenza, per non esaurire i worker
+    con attese annidate.
+    """
+    normalized = [_split_call(call) for call in calls]
+    if len(normalized) <= 1 or getattr(_query_pool_local, 'active', False):
+        if return_exceptions:
+            return [_call_capturing(func, args) for func, args in normalized]
+        return [func(*args) for func, args in normalized]
+    
+    timeout = QUERY_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    pool = _get_query_pool()
+    futures = [pool.submit(_run_in_pool, func, args) for func, args in normalized]
+    try:
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except FutureTimeoutError:
+                error = TimeoutError(f"Query non completata entro {timeout}s")
+                if not return_exceptions:
+                    raise error
+                results.append(error)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+    finally:
+        for future in futures:
+            future.cancel()
+
+def get_query_cache_stats():
+    """
+    Contatori hit/miss della cache delle query (per il tuning dei TTL).
+    """
+    return _query_cache.stats()
+
+def clear_query_cache(table=None):
+    """
+    Svuota la cache delle query (tutta o solo per una tabella).
+    """
+    _query_cache.invalidate(table)
 
 def _call_mcp_supabase(method, params):
     """
-    Chiama il server MCP Supabase
+    Esegue un'operazione sul backend di storage configurato (vedi storage_backends).
+    I nomi dei metodi (supabase_select, ...) restano quelli storici.
     """
     try:
-        # Per ora, usa la libreria diretta finché non configuriamo MCP correttamente
-        # TODO: Implementare chiamata reale MCP server
-        from database import supabase
+        from storage_backends import get_storage_backend
+        backend = get_storage_backend()
+        table = params["table"]
         
         if method == "supabase_select":
-            query = supabase.table(params["table"]).select(params.get("select", "*"))
-            
-            if params.get("filters"):
-                for key, value in params["filters"].items():
-                    query = query.eq(key, value)
-                    
-            if params.get("order_by"):
-                order_by = params["order_by"]
-                if isinstance(order_by, dict):
-                    for col, direction in order_by.items():
-                        desc = direction.lower() == 'desc'
-                        query = query.order(col, desc=desc)
-                else:
-                    query = query.order(order_by)
-                    
-            if params.get("limit"):
-                query = query.limit(params["limit"])
-                
-            result = query.execute()
-            return {"data": result.data, "error": None}
-            
+            data = backend.select(table, params.get("filters"), params.get("select", "*"),
+                                  params.get("order_by"), params.get("limit"))
         elif method == "supabase_insert":
-            result = supabase.table(params["table"]).insert(params["data"]).execute()
-            return {"data": result.data, "error": None}
-            
+            data = backend.insert(table, params["data"])
         elif method == "supabase_upsert":
-            table = params["table"]
-            data = params["data"]
-            on_conflict = params.get("on_conflict")
-            
-            if table == 'email_settings' and on_conflict == 'type':
-                # Gestione specifica per email_settings
-                existing = supabase.table(table).select('*').eq('type', data.get('type')).execute()
-                if existing.data:
-                    result = supabase.table(table).update(data).eq('type', data.get('type')).execute()
-                else:
-                    result = supabase.table(table).insert(data).execute()
-            else:
-                # Upsert generico
-                result = supabase.table(table).upsert(data).execute()
-                
-            return {"data": result.data, "error": None}
-            
+            data = backend.upsert(table, params["data"], params.get("on_conflict"))
         elif method == "supabase_update":
-            query = supabase.table(params["table"]).update(params["data"])
-            
-            for key, value in params["filters"].items():
-                query = query.eq(key, value)
-                
-            result = query.execute()
-            return {"data": result.data, "error": None}
-            
+            data = backend.update(table, params["data"], params["filters"])
         elif method == "supabase_delete":
-            query = supabase.table(params["table"]).delete()
-            
-            for key, value in params["filters"].items():
-                query = query.eq(key, value)
-                
-            result = query.execute()
-            return {"data": True, "error": None}
-            
+            data = backend.delete(table, params["filters"])
         elif method == "supabase_count":
-            query = supabase.table(params["table"]).select('id', count='exact')
-            
-            if params.get("filters"):
-                for key, value in params["filters"].items():
-                    query = query.eq(key, value)
-                    
-            result = query.execute()
-            return {"data": result.count, "error": None}
-            
+            data = backend.count(table, params.get("filters"))
+        elif method == "supabase_replace":
+            upserted, deleted = backend.replace_all(table, params["data"], params["key"], params.get("filters"))
+            data = {"upserted": upserted, "deleted": deleted}
         else:
             return {"data": None, "error": f"Metodo non supportato: {method}"}
+        
+        return {"data": data, "error": None}
             
     except Exception as e:
         return {"data": None, "error": str(e)}
 
+# --- Filtri ---------------------------------------------------------------
+#
+# I filtri sono dizionari colonna -> condizione:
+#   {'status': 'Open'}                              uguaglianza
+#   {'created_at': ('gte', start)}                  operatore singolo
+#   {'created_at': [('gte', start), ('lt', end)]}   più predicati sulla stessa colonna
+#   {'created_at': ('between', (start, end))}       intervallo chiuso (gte + lte)
+#   {'status': ('in', ['Open', 'In Progress'])}     appartenenza a un insieme
+#   {'assigned_to': ('is', None)}                   IS NULL (anche True/False)
+#   {'assigned_to': ('not_is', None)}               IS NOT NULL
+#   {'email': ('ilike', '%@example.com')}           pattern case-insensitive
+#   {'$or': [{'status': 'Open'}, {'priority': 'Urgent'}]}   gruppi in OR (ognuno in AND)
+#   {'$and': [filtri1, filtri2]}                    combinazione esplicita di dizionari
+#
+# Lo stesso DSL è interpretato da tutti i backend di storage (PostgREST, SQLite, Postgres).
+
+FILTER_OPERATORS = ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in', 'is', 'not_is', 'like', 'ilike')
+OR_KEY = '$or'
+AND_KEY = '$and'
+
+def iter_filter_predicates(filters):
+    """
+    Normalizza un dizionario di filtri in tuple (colonna, operatore, valore).
+    Per i gruppi OR restituisce (OR_KEY, 'or', [filtri_gruppo, ...]).
+    Solleva ValueError per operatori non supportati.
+    """
+    for column, condition in (filters or {}).items():
+        if column == OR_KEY:
+            groups = [group for group in condition if group]
+            if groups:
+                yield OR_KEY, 'or', groups
+            continue
+        
+        if column == AND_KEY:
+            for sub_filters in condition:
+                yield from iter_filter_predicates(sub_filters)
+            continue
+        
+        if isinstance(condition, tuple):
+            conditions = [condition]
+        elif isinstance(condition, list) and condition and all(isinstance(c, tuple) for c in condition):
+            conditions = condition
+        else:
+            conditions = [('eq', condition)]
+        
+        for op, value in conditions:
+            op = op.lower()
+            if op == 'between':
+                low, high = value
+                yield column, 'gte', low
+                yield column, 'lte', high
+            elif op in FILTER_OPERATORS:
+                yield column, op, value
+            else:
+                raise ValueError(f"Operatore di filtro non supportato: {op}")
+
+def and_filters(*filters_list):
+    """
+    Combina più dizionari di filtri in AND senza conflitti tra chiavi uguali.
+    """
+    parts = [f for f in filters_list if f]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    return {AND_KEY: parts}
+
+def _postgrest_literal(value):
+    """
+    Converte un valore per l'operatore IS di PostgREST (null/true/false).
+    """
+    if value is None or (isinstance(value, str) and value.lower() == 'null'):
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).lower()
+
+def _postgrest_condition(filters):
+    """
+    Traduce un dizionario di filtri nella sintassi dei filtri logici PostgREST
+    (usata dentro or=(...)). Un gruppo con più predicati diventa and(...).
+    """
+    parts = []
+    for column, op, value in iter_filter_predicates(filters):
+        if column == OR_KEY:
+            parts.append(f"or({','.join(_postgrest_condition(group) for group in value)})")
+        elif op == 'in':
+            parts.append(f"{column}.in.({','.join(_quote_postgrest_value(v) for v in value)})")
+        elif op == 'is':
+            parts.append(f"{column}.is.{_postgrest_literal(value)}")
+        elif op == 'not_is':
+            parts.append(f"{column}.not.is.{_postgrest_literal(value)}")
+        else:
+            parts.append(f"{column}.{op}.{_quote_postgrest_value(value)}")
+    
+    if len(parts) == 1:
+        return parts[0]
+    return f"and({','.join(parts)})"
+
+def _apply_supabase_filters(query, filters):
+    """
+    Applica i filtri del DSL a una query Supabase (select/update/delete/count).
+    """
+    for column, op, value in iter_filter_predicates(filters):
+        if column == OR_KEY:
+            query = query.or_(','.join(_postgrest_condition(group) for group in value))
+        elif op == 'in':
+            query = query.in_(column, list(value))
+        elif op == 'is':
+            query = query.filter(column, 'is', _postgrest_literal(value))
+        elif op == 'not_is':
+            query = query.filter(column, 'not.is', _postgrest_literal(value))
+        else:
+            query = getattr(query, op)(column, value)
+    return query
+
+def _quote_postgrest_value(value):
+    """
+    Quota un valore per i filtri logici PostgREST (or/and), dove virgole,
+    punti, due punti e parentesi sono caratteri riservati.
+    """
+    text = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{text}"'
+
 def save_to_supabase(table, data, on_conflict=None):
     """
     Salva dati in Supabase usando MCP server.
@@ -107,10 +423,13 @@ def save_to_supabase(table, data, on_conflict=None):
             params["on_conflict"] = on_conflict
             
         result = _call_mcp_supabase(method, params)
+        _query_cache.invalidate(table)
         
         if result["error"]:
             print(f"Errore save_to_supabase: {result['error']}")
             return None
+        
+        _notify_write(method.replace("supabase_", ""), table, result["data"])
             
         return result["data"] if result["data"] else True
         
@@ -118,11 +437,21 @@ def save_to_supabase(table, data, on_conflict=None):
         print(f"Errore save_to_supabase: {e}")
         return None
 
-def get_from_supabase(table, filters=None, select="*", order_by=None, limit=None):
+def get_from_supabase(table, filters=None, select="*", order_by=None, limit=None, use_cache=True):
     """
     Recupera dati da Supabase usando MCP server.
+    I filtri seguono il DSL descritto in iter_filter_predicates.
+    Le tabelle con TTL configurato sono servite dalla cache delle query.
     """
     try:
+        cache_key = None
+        if use_cache and _query_cache.ttl_for(table) > 0:
+            cache_key = QueryCache.make_key('select', table, filters, select, order_by, limit)
+            hit, cached = _query_cache.get(cache_key)
+            if hit:
+                return cached
+            generation = _query_cache.generation(table)
+        
         params = {
             "table": table,
             "select": select
@@ -140,6 +469,9 @@ def get_from_supabase(table, filters=None, select="*", order_by=None, limit=None
         if result["error"]:
             print(f"Errore get_from_supabase: {result['error']}")
             return None
+        
+        if cache_key is not None:
+            _query_cache.set(cache_key, result["data"], generation)
             
         return result["data"]
         
@@ -147,9 +479,121 @@ def get_from_supabase(table, filters=None, select="*", order_by=None, limit=None
         print(f"Errore get_from_supabase: {e}")
         return None
 
+def get_by_id_from_supabase(table, record_id, select="*"):
+    """
+    Recupera un singolo record per chiave primaria (lookup indicizzato su id).
+    Restituisce il record o None se non esiste.
+    """
+    rows = get_from_supabase(table, filters={'id': record_id}, select=select, limit=1)
+    return rows[0] if rows else None
+
+# Numero massimo di id per singola query IN (limita la lunghezza dell'URL PostgREST)
+IDS_CHUNK_SIZE = 200
+
+def get_many_by_ids_from_supabase(table, ids, select="*"):
+    """
+    Recupera più record per chiave primaria con query id IN (...).
+    I record sono restituiti nell'ordine degli id richiesti; gli id inesistenti vengono saltati.
+    """
+    unique_ids = list(dict.fromkeys(i for i in (ids or []) if i is not None))
+    if not unique_ids:
+        return []
+    
+    # L'id serve per riordinare i risultati: includilo sempre nella proiezione
+    if select != "*" and 'id' not in [col.strip() for col in select.split(',')]:
+        select = f"id, {select}"
+    
+    by_id = {}
+    for start in range(0, len(unique_ids), IDS_CHUNK_SIZE):
+        chunk = unique_ids[start:start + IDS_CHUNK_SIZE]
+        rows = get_from_supabase(table, filters={'id': ('in', chunk)}, select=select)
+        if rows is None:
+            return None
+        for row in rows:
+            by_id[row.get('id')] = row
+    
+    return [by_id[i] for i in unique_ids if i in by_id]
+
+def encode_cursor(sort, direction, value, record_id):
+    """
+    Codifica un cursore opaco (base64 url-safe) per la paginazione keyset.
+    """
+    raw = json.dumps([sort, direction, value, record_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort, direction):
+    """
+    Decodifica un cursore keyset. Solleva ValueError se il cursore non è valido
+    o è stato generato con un ordinamento diverso da quello richiesto.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_direction, value, record_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        record_id = int(record_id)
+    except Exception:
+        raise ValueError("Cursore non valido")
+    
+    if cursor_sort != sort or cursor_direction != direction:
+        raise ValueError("Cursore non compatibile con l'ordinamento richiesto")
+    
+    return value, record_id
+
+def get_page_from_supabase(table, filters=None, select="*", sort="created_at", direction="desc", limit=50, cursor=None):
+    """
+    Recupera una pagina di risultati con paginazione keyset su (sort, id).
+    Restituisce (righe, next_cursor); next_cursor è None sull'ultima pagina.
+    Solleva ValueError se il cursore non è valido.
+    I valori NULL della colonna di ordinamento contano come i più grandi
+    (come in Postgres: ultimi in ordine crescente, primi in decrescente).
+    """
+    direction = 'asc' if str(direction).lower() == 'asc' else 'desc'
+    
+    keyset = None
+    if cursor:
+        # (sort, id) strettamente dopo il cursore nell'ordine richiesto
+        value, record_id = decode_cursor(cursor, sort, direction)
+        op = 'lt' if direction == 'desc' else 'gt'
+        if value is None:
+            # Cursore tra le righe con sort NULL: prima le altre NULL per id, poi
+            # (in ordine decrescente) tutte le righe con un valore
+            groups = [{sort: ('is', None), 'id': (op, record_id)}]
+            if direction == 'desc':
+                groups.append({sort: ('not_is', None)})
+        else:
+            groups = [{sort: (op, value)}, {sort: value, 'id': (op, record_id)}]
+            if direction == 'asc':
+                groups.append({sort: ('is', None)})
+        keyset = {OR_KEY: groups}
+    
+    # Colonna di ordinamento e id servono per costruire il cursore successivo
+    if select != "*":
+        columns = [col.strip() for col in select.split(',')]
+        missing = [col for col in ('id', sort) if col not in columns]
+        if missing:
+            select = ', '.join(missing + [select])
+    
+    # Richiedi una riga in più per sapere se esiste una pagina successiva
+    rows = get_from_supabase(table,
+                             filters=and_filters(filters, keyset),
+                             select=select,
+                             order_by={sort: direction, 'id': direction},
+                             limit=limit + 1)
+    if rows is None:
+        return None, None
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, direction, last.get(sort), last.get('id'))
+    
+    return rows, next_cursor
+
 def update_in_supabase(table, data, filters):
     """
     Aggiorna dati in Supabase usando MCP server.
+    Restituisce la lista delle righe aggiornate (rappresentazione PostgREST),
+    così i chiamanti non devono rileggere il record dopo l'update.
     """
     try:
         params = {
@@ -159,10 +603,13 @@ def update_in_supabase(table, data, filters):
         }
         
         result = _call_mcp_supabase("supabase_update", params)
+        _query_cache.invalidate(table)
         
         if result["error"]:
             print(f"Errore update_in_supabase: {result['error']}")
             return None
+        
+        _notify_write("update", table, result["data"], filters)
             
         return result["data"] if result["data"] else True
         
@@ -181,10 +628,13 @@ def delete_from_supabase(table, filters):
         }
         
         result = _call_mcp_supabase("supabase_delete", params)
+        _query_cache.invalidate(table)
         
         if result["error"]:
             print(f"Errore delete_from_supabase: {result['error']}")
             return False
+        
+        _notify_write("delete", table, result["data"], filters)
             
         return True
         
@@ -192,11 +642,166 @@ def delete_from_supabase(table, filters):
         print(f"Errore delete_from_supabase: {e}")
         return False
 
-def count_in_supabase(table, filters=None):
+# --- Scritture in blocco -------------------------------------------------------
+#
+# Una richiesta per blocco di righe invece di una per riga. I blocchi sono
+# indipendenti: se uno fallisce quelli precedenti restano salvati.
+
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '500'))
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def save_many(table, rows, on_conflict=None, chunk_size=None):
+    """
+    Inserisce una lista di righe (upsert se on_conflict è indicato),
+    con una richiesta ogni chunk_size righe (default WRITE_BATCH_SIZE).
+    Restituisce le righe salvate, None in caso di errore.
+    """
+    try:
+        rows = list(rows or [])
+        method = "supabase_upsert" if on_conflict else "supabase_insert"
+        saved = []
+        
+        for chunk in _chunks(rows, chunk_size or WRITE_BATCH_SIZE):
+            params = {
+                "table": table,
+                "data": chunk
+            }
+            if on_conflict:
+                params["on_conflict"] = on_conflict
+            
+            result = _call_mcp_supabase(method, params)
+            _query_cache.invalidate(table)
+            
+            if result["error"]:
+                print(f"Errore save_many: {result['error']}")
+                return None
+            
+            _notify_write(method.replace("supabase_", ""), table, result["data"])
+            saved.extend(result["data"] or [])
+            
+        return saved
+        
+    except Exception as e:
+        print(f"Errore save_many: {e}")
+        return None
+
+def update_many(table, changes, key="id"):
+    """
+    Aggiorna più righe identificate da `key`: ogni elemento di changes contiene
+    la chiave e i campi da modificare. Le modifiche identiche sono raggruppate
+    in un solo update con filtro ('in', chiavi).
+    Restituisce le righe aggiornate, None in caso di errore.
+    """
+    try:
+        groups = OrderedDict()
+        for change in changes or []:
+            data = {col: value for col, value in change.items() if col != key}
+            group_key = json.dumps(data, sort_keys=True, default=str)
+            groups.setdefault(group_key, (data, []))[1].append(change[key])
+        
+        updated = []
+        for data, keys in groups.values():
+            if not data:
+                continue
+            for chunk in _chunks(keys, IDS_CHUNK_SIZE):
+                filters = {key: ('in', chunk)}
+                result = _call_mcp_supabase("supabase_update", {
+                    "table": table,
+                    "data": data,
+                    "filters": filters
+                })
+                _query_cache.invalidate(table)
+                
+                if result["error"]:
+                    print(f"Errore update_many: {result['error']}")
+                    return None
+                
+                _notify_write("update", table, result["data"], filters)
+                updated.extend(result["data"] or [])
+            
+        return updated
+        
+    except Exception as e:
+        print(f"Errore update_many: {e}")
+        return None
+
+def delete_many(table, values, key="id"):
+    """
+    Elimina le righe il cui `key` è in values, a blocchi di IDS_CHUNK_SIZE.
+    """
+    try:
+        values = list(dict.fromkeys(values or []))
+        for chunk in _chunks(values, IDS_CHUNK_SIZE):
+            filters = {key: ('in', chunk)}
+            result = _call_mcp_supabase("supabase_delete", {
+                "table": table,
+                "filters": filters
+            })
+            _query_cache.invalidate(table)
+            
+            if result["error"]:
+                print(f"Errore delete_many: {result['error']}")
+                return False
+            
+            _notify_write("delete", table, result["data"], filters)
+            
+        return True
+        
+    except Exception as e:
+        print(f"Errore delete_many: {e}")
+        return False
+
+def replace_all(table, rows, key, filters=None):
+    """
+    Sostituisce l'insieme di righe nel perimetro `filters` con `rows`
+    (upsert su `key` ed eliminazione delle righe non più presenti).
+    A differenza di "cancella tutto e reinserisci" la tabella non resta mai vuota;
+    con i backend SQL l'operazione è un'unica transazione, su Supabase solo per
+    le opzioni dei menu (funzione replace_config_options).
+    Restituisce le righe salvate, None in caso di errore.
+    """
+    try:
+        # In caso di chiavi duplicate vale l'ultima riga
+        rows = list({row[key]: row for row in rows or []}.values())
+        
+        result = _call_mcp_supabase("supabase_replace", {
+            "table": table,
+            "data": rows,
+            "key": key,
+            "filters": filters
+        })
+        _query_cache.invalidate(table)
+        
+        if result["error"]:
+            print(f"Errore replace_all: {result['error']}")
+            return None
+        
+        _notify_write("upsert", table, result["data"]["upserted"])
+        _notify_write("delete", table, result["data"]["deleted"], filters)
+        
+        return result["data"]["upserted"]
+        
+    except Exception as e:
+        print(f"Errore replace_all: {e}")
+        return None
+
+def count_in_supabase(table, filters=None, use_cache=True):
     """
     Conta record in Supabase usando MCP server.
+    I filtri seguono il DSL descritto in iter_filter_predicates.
     """
     try:
+        cache_key = None
+        if use_cache and _query_cache.ttl_for(table) > 0:
+            cache_key = QueryCache.make_key('count', table, filters)
+            hit, cached = _query_cache.get(cache_key)
+            if hit:
+                return cached
+            generation = _query_cache.generation(table)
+        
         params = {
             "table": table
         }
@@ -209,8 +814,12 @@ def count_in_supabase(table, filters=None):
         if result["error"]:
             print(f"Errore count_in_supabase: {result['error']}")
             return 0
+        
+        count = result["data"] if result["data"] is not None else 0
+        if cache_key is not None:
+            _query_cache.set(cache_key, count, generation)
             
-        return result["data"] if result["data"] is not None else 0
+        return count
         
     except Exception as e:
         print(f"Errore count_in_supabase: {e}")
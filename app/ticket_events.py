@@ -0,0 +1,268 @@
+"""
+Eventi in tempo reale dei ticket (Server-Sent Events) con un pub/sub in memoria.
+
+Chi salva un messaggio (chat agenti, portale clienti, email in arrivo) lo
+pubblica sul topic del ticket ('message'), come le modifiche e le
+eliminazioni dei messaggi ('message_updated', 'message_deleted'); ogni
+scheda aperta sul ticket tiene una connessione SSE che riceve solo gli
+eventi di quel ticket.
+
+Un iscritto inattivo costa poco: non ha una coda propria ma solo la posizione
+dell'ultimo evento letto, e resta in attesa sulla Condition del suo ticket,
+che viene svegliata solo dalle pubblicazioni su quel ticket o dal battito
+(heartbeat) ogni TICKET_EVENTS_HEARTBEAT secondi. Ogni topic conserva gli
+ultimi TICKET_EVENTS_BUFFER eventi, così un client che si riconnette con
+Last-Event-ID riceve quelli persi; se non sono più disponibili (buffer
+superato, riavvio del processo) riceve un evento 'resync' e ricarica i
+messaggi una volta.
+
+Ogni connessione aperta occupa però un thread del server per tutta la sua
+durata (fino a TICKET_EVENTS_STREAM_SECONDS): con il server di app.py un
+thread per richiesta, con gunicorn un thread dei worker sincroni/gthread.
+TICKET_EVENTS_MAX_SUBSCRIBERS va quindi tenuto sotto i thread disponibili,
+lasciandone liberi per le altre richieste (con gunicorn: un solo processo,
+perché il pub/sub è in memoria, e --threads maggiore del limite). Oltre il
+limite i client ricevono 503 e tornano al polling.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# Secondi tra due battiti su una connessione senza eventi
+TICKET_EVENTS_HEARTBEAT = int(os.getenv('TICKET_EVENTS_HEARTBEAT', '20'))
+# Durata massima di una connessione: poi il browser si riconnette (e rifà l'autenticazione)
+TICKET_EVENTS_STREAM_SECONDS = int(os.getenv('TICKET_EVENTS_STREAM_SECONDS', '600'))
+# Connessioni aperte contemporaneamente, ognuna su un thread del server; oltre, i client tornano al polling
+TICKET_EVENTS_MAX_SUBSCRIBERS = int(os.getenv('TICKET_EVENTS_MAX_SUBSCRIBERS', '200'))
+# Eventi conservati per ticket per le riconnessioni
+TICKET_EVENTS_BUFFER = int(os.getenv('TICKET_EVENTS_BUFFER', '50'))
+# Secondi per cui un topic senza iscritti resta in memoria (riconnessioni)
+TICKET_EVENTS_GRACE = 60
+# Attesa suggerita al browser prima di riconnettersi (millisecondi)
+RETRY_MILLISECONDS = 3000
+
+RESYNC = 'resync'
+
+
+class _Topic:
+    """Eventi recenti e iscritti di un ticket"""
+    __slots__ = ('condition', 'events', 'floor', 'last', 'subscribers', 'idle_since')
+
+    def __init__(self, lock, sequence):
+        self.condition = threading.Condition(lock)
+        self.events = deque()       # (sequenza, evento, dati)
+        self.floor = sequence       # Eventi con sequenza <= floor non più disponibili
+        self.last = sequence        # Sequenza dell'ultimo evento pubblicato
+        self.subscribers = 0
+        self.idle_since = None
+
+
+class Subscription:
+    """Posizione di un iscritto nel topic di un ticket"""
+
+    def __init__(self, bus, key, topic, cursor, resync):
+        self._bus = bus
+        self.key = key
+        self._topic = topic
+        self.cursor = cursor
+        self._resync = resync
+        self._closed = False
+
+    @property
+    def event_id(self):
+        return self._bus.event_id(self.cursor)
+
+    def event_id_of(self, sequence):
+        return self._bus.event_id(sequence)
+
+    def wait(self, timeout):
+        """
+        Eventi successivi alla posizione corrente [(sequenza, evento, dati)],
+        attendendo al più timeout secondi; [] se non ne arrivano.
+        RESYNC se alcuni eventi sono andati persi.
+        """
+        topic = self._topic
+        with topic.condition:
+            if self._resync:
+                self._resync = False
+                self.cursor = topic.last
+                return RESYNC
+            if topic.last <= self.cursor:
+                topic.condition.wait(timeout)
+            if self.cursor < topic.floor:
+                self.cursor = topic.last
+                return RESYNC
+            events = [event for event in topic.events if event[0] > self.cursor]
+            self.cursor = topic.last
+        return events
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._bus._unsubscribe(self.key, self._topic)
+
+
+class EventBus:
+    """Pub/sub in memoria per topic (un topic per ticket)"""
+
+    def __init__(self, buffer_size=TICKET_EVENTS_BUFFER, max_subscribers=TICKET_EVENTS_MAX_SUBSCRIBERS):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        # Gli id degli eventi di un processo precedente non sono validi in questo
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._sequence = 0
+        self._subscribers = 0
+        self._last_prune = time.monotonic()
+        self._stats = {'published': 0, 'delivered_topics': 0, 'rejected': 0, 'resyncs': 0}
+
+    def event_id(self, sequence):
+        return f'{self.epoch}:{sequence}'
+
+    def _parse_event_id(self, value):
+        """Sequenza di un Last-Event-ID di questo processo, None se non valido"""
+        epoch, _, sequence = (value or '').partition(':')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, key, event, data):
+        """Pubblica un evento sul topic; senza iscritti recenti viene scartato"""
+        with self._lock:
+            self._sequence += 1
+            self._stats['published'] += 1
+            topic = self._topics.get(key)
+            if topic is None:
+                return False
+            topic.events.append((self._sequence, event, data))
+            if len(topic.events) > self.buffer_size:
+                topic.floor = topic.events.popleft()[0]
+            topic.last = self._sequence
+            self._stats['delivered_topics'] += 1
+            topic.condition.notify_all()
+        return True
+
+    def subscribe(self, key, last_event_id=None):
+        """
+        Nuova iscrizione al topic; riparte dopo last_event_id se indicato.
+        None se è stato raggiunto il numero massimo di iscritti.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._subscribers >= self.max_subscribers:
+                self._stats['rejected'] += 1
+                return None
+            if now - self._last_prune > TICKET_EVENTS_GRACE:
+                self._prune(now)
+
+            topic = self._topics.get(key)
+            if topic is None:
+                topic = self._topics[key] = _Topic(self._lock, self._sequence)
+            topic.subscribers += 1
+            topic.idle_since = None
+            self._subscribers += 1
+
+            cursor, resync = topic.last, False
+            if last_event_id:
+                sequence = self._parse_event_id(last_event_id)
+                if sequence is None or sequence < topic.floor:
+                    resync = True
+                    self._stats['resyncs'] += 1
+                else:
+                    cursor = min(sequence, topic.last)
+            return Subscription(self, key, topic, cursor, resync)
+
+    def _unsubscribe(self, key, topic):
+        with self._lock:
+            topic.subscribers -= 1
+            self._subscribers -= 1
+            if topic.subscribers == 0:
+                topic.idle_since = time.monotonic()
+
+    def _prune(self, now):
+        """Rimuove i topic senza iscritti da più di TICKET_EVENTS_GRACE secondi"""
+        self._last_prune = now
+        for key in [key for key, topic in self._topics.items()
+                    if topic.subscribers == 0 and now - topic.idle_since > TICKET_EVENTS_GRACE]:
+            del self._topics[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subscribers'] = self._subscribers
+            stats['topics'] = len(self._topics)
+            stats['max_subscribers'] = self.max_subscribers
+        return stats
+
+
+def format_event(event, data, event_id=None):
+    """Evento nel formato text/event-stream"""
+    lines = []
+    if event_id:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, default=str))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _accepted(accept, event, data):
+    """(evento, dati) da inviare dopo il filtro accept, None se escluso"""
+    verdict = accept(event, data) if accept is not None else True
+    if not verdict:
+        return None
+    return verdict if isinstance(verdict, tuple) else (event, data)
+
+
+def event_stream(subscription, accept=None, heartbeat=TICKET_EVENTS_HEARTBEAT,
+                 lifetime=TICKET_EVENTS_STREAM_SECONDS):
+    """
+    Generatore della risposta SSE di un'iscrizione. accept(evento, dati)
+    permette di escludere alcuni eventi (es. i messaggi interni per i clienti)
+    restituendo False, oppure di sostituirli restituendo una coppia
+    (evento, dati). L'iscrizione viene chiusa quando il client si disconnette.
+    """
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        # La posizione iniziale permette di riprendere da qui alla riconnessione
+        yield format_event('ready', {}, subscription.event_id)
+        deadline = time.monotonic() + lifetime
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            events = subscription.wait(min(heartbeat, remaining))
+            if events == RESYNC:
+                yield format_event('resync', {}, subscription.event_id)
+            elif events:
+                chunk = ''
+                for sequence, event, data in events:
+                    accepted = _accepted(accept, event, data)
+                    if accepted:
+                        chunk += format_event(*accepted, subscription.event_id_of(sequence))
+                # Anche gli eventi esclusi fanno avanzare la posizione del client
+                # (un blocco con il solo id aggiorna Last-Event-ID senza generare eventi)
+                yield chunk or f'id: {subscription.event_id}\n\n'
+            else:
+                yield ': ping\n\n'
+    finally:
+        subscription.close()
+
+
+# Istanza globale: un topic per ticket
+ticket_events = EventBus()
+
+
+def publish_messages(messages, event='message'):
+    """Pubblica i messaggi salvati (o modificati) sui topic dei rispettivi ticket"""
+    for message in messages or []:
+        if message and message.get('ticket_id'):
+            ticket_events.publish(int(message['ticket_id']), event, message)
+
+
+def publish_message_deleted(ticket_id, message_id):
+    """Pubblica l'eliminazione di un messaggio sul topic del ticket"""
+    ticket_events.publish(int(ticket_id), 'message_deleted', {'id': message_id, 'ticket_id': ticket_id})
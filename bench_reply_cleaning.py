@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Benchmark e verifica della pulizia delle risposte email (app/reply_cleaner.py).
+
+Il corpus parte dai messaggi di test_email_cleaning.py e aggiunge le varianti
+dei client più comuni (Gmail, Outlook, Apple Mail, italiano e inglese) e
+thread inoltrati di centinaia di KB. Per ogni caso confronta il risultato con
+quello atteso e misura i tempi della nuova pulizia e di quella precedente
+(dieci espressioni regolari con re.DOTALL).
+
+Uso: python bench_reply_cleaning.py [ripetizioni]
+"""
+import re
+import sys
+import os
+import time
+
+# Add the app directory to Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from reply_cleaner import clean_reply
+
+# Messaggio di test_email_cleaning.py (test 1)
+CRM_REPLY = """Questo è il mio nuovo messaggio!
+
+-----Messaggio originale-----
+Da: CRM PRO <crmpro84@gmail.com>
+Inviato: martedì 10 giugno 2025 12:15
+A: matteo.vinciguerra@vinciinside.it
+Oggetto: Re: Ticket #410 - Test Ticket Email
+
+Gentile Matteo Test,
+
+Ha ricevuto un nuovo messaggio per il ticket #410.
+
+Da: Administrator (winwar84@admin.local)
+Data: 2025-06-10T10:14:47.705444
+
+Messaggio:
+ciao
+
+---
+Questo è un messaggio automatico del sistema CRM.
+Ticket ID: #410
+Titolo: Test Ticket Email
+Stato: Open
+Priorità: Medium
+
+Per rispondere, basta rispondere a questa email.
+
+Cordiali saluti,
+Il Team di Supporto"""
+
+# Messaggio di test_email_cleaning.py (test 2)
+CRM_FOOTER = """Solo questo messaggio
+
+---
+Ticket ID: #410
+Titolo: Test Ticket Email
+Stato: Open
+Priorità: Medium"""
+
+QUOTED_NOTIFICATION = """Gentile Matteo Test,
+
+Ha ricevuto un nuovo messaggio per il ticket #410.
+
+Messaggio:
+ciao
+
+---
+Ticket ID: #410
+Titolo: Test Ticket Email
+Stato: Open
+Priorità: Medium
+
+Per rispondere, basta rispondere a questa email.
+"""
+
+
+def quoted(text):
+    return '\n'.join('> ' + line if line else '>' for line in text.split('\n'))
+
+
+CORPUS = [
+    ('test_email_cleaning 1', CRM_REPLY, "Questo è il mio nuovo messaggio!"),
+    ('test_email_cleaning 2', CRM_FOOTER, "Solo questo messaggio"),
+    ('gmail it', "La stampante funziona di nuovo, grazie.\n\n"
+                 "Il giorno mar 10 giu 2025 alle ore 12:15 CRM PRO <crmpro84@gmail.com> ha\nscritto:\n\n"
+                 + quoted(QUOTED_NOTIFICATION),
+     "La stampante funziona di nuovo, grazie."),
+    ('gmail en', "Still broken after the update.\n\n"
+                 "On Tue, Jun 10, 2025 at 12:15 PM CRM PRO <crmpro84@gmail.com>\nwrote:\n\n"
+                 + quoted(QUOTED_NOTIFICATION),
+     "Still broken after the update."),
+    ('apple mail it', "Allego il log richiesto.\n\nInviato da iPhone\n\n"
+                      "Il giorno 10 giu 2025, alle ore 12:15, CRM PRO <crmpro84@gmail.com> ha scritto:\n\n"
+                      + quoted(QUOTED_NOTIFICATION),
+     "Allego il log richiesto."),
+    ('outlook it', "Buongiorno,\nil problema si ripresenta ogni mattina.\n\n"
+                   "Da: CRM PRO <crmpro84@gmail.com>\nInviato: martedì 10 giugno 2025 12:15\n"
+                   "A: cliente@example.it\nOggetto: Re: Ticket #410 - Test Ticket Email\n\n"
+                   + QUOTED_NOTIFICATION,
+     "Buongiorno,\nil problema si ripresenta ogni mattina."),
+    ('outlook en', "Thanks, closing on our side.\n\n"
+                   "*From:* CRM PRO <crmpro84@gmail.com>\n*Sent:* Tuesday, June 10, 2025 12:15 PM\n"
+                   "*To:* customer@example.com\n*Subject:* Re: Ticket #410 - Test Ticket Email\n\n"
+                   + QUOTED_NOTIFICATION,
+     "Thanks, closing on our side."),
+    ('original message en', "See below.\n\n-----Original Message-----\nFrom: a@b.com\n\nold",
+     "See below."),
+    ('thunderbird it', "Ok.\n\n-------- Messaggio originale --------\nOggetto: x\n\nvecchio",
+     "Ok."),
+    ('intestazione breve en', "Works now.\n\nOn Monday, John wrote:\n> It does not start.",
+     "Works now."),
+    ('intestazione breve it', "Risolto, grazie.\n\nIl giorno lunedì Mario ha scritto:\n> Non parte.",
+     "Risolto, grazie."),
+    ('firma', "Nessun problema da segnalare.\n\n-- \nMario Rossi\nUfficio tecnico", "Nessun problema da segnalare."),
+    ('risposta intercalata', "> Il server si riavvia?\nSì, ogni notte.\n> Da quando?\nDa lunedì.",
+     "> Il server si riavvia?\nSì, ogni notte.\n> Da quando?\nDa lunedì."),
+    ('testo con "il" e "on"', "Il problema è quello che il collega ha scritto:\nil disco è pieno.\n"
+                              "Turned on the printer and it failed.",
+     "Il problema è quello che il collega ha scritto:\nil disco è pieno.\n"
+     "Turned on the printer and it failed."),
+]
+
+
+def _thread(depth):
+    """Thread inoltrato di molti livelli (centinaia di KB)"""
+    body = "Inoltro tutta la conversazione, il problema è nel primo messaggio.\n\n"
+    for level in range(depth):
+        body += (f"Il giorno lun {level % 28 + 1} giu 2025 alle ore 10:{level % 60:02d} Utente {level} "
+                 f"<utente{level}@example.it> ha scritto:\n")
+        body += quoted("Riga di testo con parole on il da a " * 4 + "\n" + "x" * 500 + "\n") + "\n"
+    return body
+
+
+def _html_heavy(size):
+    """Risposta con HTML convertito in testo: molte 'on' e 'il' e nessun separatore"""
+    chunk = "<td style=\"font-family: Arial\">on il From: da To: a Subject: CRM Ticket ID</td> " * 20
+    lines = []
+    while sum(len(line) for line in lines) < size:
+        lines.append(chunk)
+    return "Risposta in HTML:\n" + "\n".join(lines)
+
+
+def _single_line(size):
+    """Un'unica riga enorme, senza a capo"""
+    return "On " + "testo on il ---CRM Ticket ID " * (size // 30)
+
+
+LARGE = [
+    ('thread inoltrato ~300KB', _thread(450),
+     "Inoltro tutta la conversazione, il problema è nel primo messaggio."),
+    ('html senza separatori ~300KB', _html_heavy(300_000), None),
+    ('riga unica ~300KB', _single_line(300_000), None),
+]
+
+# La pulizia precedente cresce più che quadraticamente sulla riga unica
+# (già 3 KB richiedono secondi): viene misurata solo sui primi caratteri
+LEGACY_SAMPLE = {'riga unica ~300KB': 2_000}
+
+
+def legacy_clean(body):
+    """Pulizia precedente (per confronto dei tempi)"""
+    if not body:
+        return ""
+    dividers = [
+        r'-----Messaggio originale-----',
+        r'-----Original Message-----',
+        r'-------- Messaggio originale --------',
+        r'On .* wrote:',
+        r'Il .* ha scritto:',
+        r'From:.*\n.*To:.*\n.*Subject:',
+        r'Da:.*\n.*A:.*\n.*Oggetto:',
+        r'---\nQuesto è un messaggio automatico del sistema CRM\.',
+        r'---.*CRM.*Ticket.*ID.*#\d+',
+        r'---\nTicket ID: #\d+'
+    ]
+    for pattern in dividers:
+        match = re.search(pattern, body, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+        if match:
+            body = body[:match.start()]
+            break
+    body = body.strip()
+    return re.sub(r'\n{3,}', '\n\n', body)
+
+
+def timed(function, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(text)
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    failures = 0
+
+    print(f"{'caso':<32} {'KB':>7} {'nuovo ms':>10} {'vecchio ms':>11}  esito")
+    for name, text, expected in CORPUS + LARGE:
+        runs = repeat if len(text) < 10_000 else max(1, repeat // 50)
+        result, new_ms = timed(clean_reply, text, runs)
+        sample = LEGACY_SAMPLE.get(name)
+        _, old_ms = timed(legacy_clean, text[:sample] if sample else text,
+                          max(1, runs // 10) if len(text) > 10_000 else runs)
+        old = f"{old_ms:.3f}" + (f" ({sample // 1000}KB)" if sample else '')
+        ok = expected is None or result == expected
+        failures += not ok
+        print(f"{name:<32} {len(text) / 1024:>7.1f} {new_ms:>10.3f} {old:>11}  {'✅' if ok else '❌'}")
+        if not ok:
+            print(f"    atteso:  {expected!r}\n    ottenuto: {result[:200]!r}")
+
+    print(f"\n{'✅ Tutti i casi corretti' if not failures else f'❌ {failures} casi errati'}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
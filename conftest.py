@@ -0,0 +1,16 @@
+"""
+Configurazione comune dei test: database SQLite temporaneo (mai Supabase)
+e cartella app nel path, come negli script di test esistenti.
+"""
+import os
+import sys
+import tempfile
+
+_TEST_DATA_DIR = tempfile.mkdtemp(prefix='crm-test-')
+
+# Va impostato prima che i moduli dell'app scelgano il backend di storage
+os.environ['CRM_DB_BACKEND'] = 'sqlite'
+os.environ['CRM_SQLITE_PATH'] = os.path.join(_TEST_DATA_DIR, 'crm_test.db')
+os.environ['EMAIL_QUEUE_DB'] = os.path.join(_TEST_DATA_DIR, 'email_queue.db')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
@@ -0,0 +1,58 @@
+-- Vincoli univoci richiesti dagli upsert in blocco delle configurazioni
+-- (replace_all su value per le opzioni, save_many su key per system_settings)
+-- e funzione replace_config_options per sostituire le opzioni in una transazione.
+-- Esegui questo script nel SQL Editor di Supabase.
+
+-- Rimuove eventuali duplicati lasciati dal vecchio salvataggio "cancella e reinserisci"
+DELETE FROM ticket_software_options a USING ticket_software_options b
+    WHERE a.value = b.value AND a.id < b.id;
+DELETE FROM ticket_group_options a USING ticket_group_options b
+    WHERE a.value = b.value AND a.id < b.id;
+DELETE FROM ticket_type_options a USING ticket_type_options b
+    WHERE a.value = b.value AND a.id < b.id;
+DELETE FROM system_settings a USING system_settings b
+    WHERE a.key = b.key AND a.id < b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_software_options_value ON ticket_software_options (value);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_group_options_value ON ticket_group_options (value);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_type_options_value ON ticket_type_options (value);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_system_settings_key ON system_settings (key);
+
+-- Sostituzione atomica delle opzioni attive di un menu a tendina (replace_all di
+-- storage_backends.SupabaseBackend): upsert su value ed eliminazione delle opzioni
+-- rimosse nella stessa transazione, un'unica chiamata RPC invece di tre richieste HTTP.
+-- Restituisce {"upserted": [...], "deleted": [...]}.
+CREATE OR REPLACE FUNCTION replace_config_options(p_table TEXT, p_rows JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    upserted JSONB;
+    deleted JSONB;
+BEGIN
+    IF p_table NOT IN ('ticket_software_options', 'ticket_group_options', 'ticket_type_options') THEN
+        RAISE EXCEPTION 'replace_config_options: tabella non ammessa %', p_table;
+    END IF;
+
+    EXECUTE format(
+        'WITH saved AS (
+             INSERT INTO %I (value, label, is_active)
+             SELECT r.value, r.label, COALESCE(r.is_active, true)
+             FROM jsonb_to_recordset($1) AS r(value TEXT, label TEXT, is_active BOOLEAN)
+             ON CONFLICT (value) DO UPDATE SET label = EXCLUDED.label, is_active = EXCLUDED.is_active
+             RETURNING *)
+         SELECT COALESCE(jsonb_agg(to_jsonb(saved)), ''[]''::jsonb) FROM saved', p_table)
+    INTO upserted USING p_rows;
+
+    EXECUTE format(
+        'WITH removed AS (
+             DELETE FROM %I
+             WHERE is_active
+               AND value NOT IN (SELECT r->>''value'' FROM jsonb_array_elements($1) AS r)
+             RETURNING *)
+         SELECT COALESCE(jsonb_agg(to_jsonb(removed)), ''[]''::jsonb) FROM removed', p_table)
+    INTO deleted USING p_rows;
+
+    RETURN jsonb_build_object('upserted', upserted, 'deleted', deleted);
+END;
+$$;
@@ -0,0 +1,63 @@
+-- Feed delle modifiche di ticket e clienti (/api/tickets/changes, /api/customers/changes)
+-- Le righe modificate si leggono per (updated_at, id); le eliminazioni restano
+-- nella tabella deleted_records, scritta da un trigger anche per le
+-- cancellazioni a cascata (un cliente con i suoi ticket).
+-- Esegui questo script nel SQL Editor di Supabase.
+
+-- updated_at aggiornato a ogni modifica (già presente se si è usato supabase_schema.sql)
+CREATE OR REPLACE FUNCTION update_updated_at_column()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS update_tickets_updated_at ON tickets;
+CREATE TRIGGER update_tickets_updated_at
+    BEFORE UPDATE ON tickets
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+DROP TRIGGER IF EXISTS update_customers_updated_at ON customers;
+CREATE TRIGGER update_customers_updated_at
+    BEFORE UPDATE ON customers
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- Righe modificate dopo un cursore (updated_at, id)
+CREATE INDEX IF NOT EXISTS idx_tickets_updated_at_id ON tickets(updated_at, id);
+CREATE INDEX IF NOT EXISTS idx_customers_updated_at_id ON customers(updated_at, id);
+
+-- Registro delle eliminazioni (tombstone)
+CREATE TABLE IF NOT EXISTS deleted_records (
+    id BIGSERIAL PRIMARY KEY,
+    table_name VARCHAR(63) NOT NULL,
+    record_id INTEGER NOT NULL,
+    deleted_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_deleted_records_table_deleted_at ON deleted_records(table_name, deleted_at, id);
+
+CREATE OR REPLACE FUNCTION record_deleted_row()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO deleted_records (table_name, record_id) VALUES (TG_TABLE_NAME, OLD.id);
+    RETURN OLD;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS record_deleted_tickets ON tickets;
+CREATE TRIGGER record_deleted_tickets
+    AFTER DELETE ON tickets
+    FOR EACH ROW
+    EXECUTE FUNCTION record_deleted_row();
+
+DROP TRIGGER IF EXISTS record_deleted_customers ON customers;
+CREATE TRIGGER record_deleted_customers
+    AFTER DELETE ON customers
+    FOR EACH ROW
+    EXECUTE FUNCTION record_deleted_row();
+
+-- Pulizia periodica consigliata (i client fermi da più tempo ricaricano la lista completa):
+-- DELETE FROM deleted_records WHERE deleted_at < NOW() - INTERVAL '30 days';
@@ -0,0 +1,9 @@
+-- Ricerca dei clienti per email senza distinzione tra maiuscole e minuscole
+-- (usata dall'importazione delle email in arrivo).
+-- Esegui questo script nel SQL Editor di Supabase.
+
+ALTER TABLE customers
+    ADD COLUMN IF NOT EXISTS email_normalized TEXT
+    GENERATED ALWAYS AS (lower(btrim(email))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_customers_email_normalized ON customers (email_normalized);
@@ -0,0 +1,23 @@
+-- Indice dei Message-ID delle email collegate ai ticket: notifiche inviate
+-- ('out') ed email ricevute già elaborate ('in'). Serve a collegare le
+-- risposte tramite In-Reply-To/References e a ignorare le riconsegne.
+-- Esegui questo script nel SQL Editor di Supabase.
+
+CREATE TABLE IF NOT EXISTS email_message_index (
+    id SERIAL PRIMARY KEY,
+    message_id VARCHAR(998) NOT NULL UNIQUE,
+    ticket_id INTEGER REFERENCES tickets(id) ON DELETE CASCADE,
+    direction VARCHAR(3) NOT NULL CHECK (direction IN ('in', 'out')),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_message_index_ticket_id ON email_message_index(ticket_id);
+CREATE INDEX IF NOT EXISTS idx_ticket_messages_email_message_id ON ticket_messages(email_message_id);
+
+-- Email già importate prima dell'indice
+INSERT INTO email_message_index (message_id, ticket_id, direction)
+SELECT DISTINCT ON (email_message_id) email_message_id, ticket_id, 'in'
+FROM ticket_messages
+WHERE email_message_id IS NOT NULL AND email_message_id <> '' AND sender_type = 'customer'
+ORDER BY email_message_id, id
+ON CONFLICT (message_id) DO NOTHING;
@@ -0,0 +1,17 @@
+-- Stato della sincronizzazione incrementale delle caselle IMAP:
+-- per ogni casella l'UIDVALIDITY e l'ultimo UID elaborato.
+-- Esegui questo script nel SQL Editor di Supabase.
+
+CREATE TABLE IF NOT EXISTS email_sync_state (
+    id SERIAL PRIMARY KEY,
+    mailbox VARCHAR(512) NOT NULL UNIQUE, -- utente@host/cartella
+    uidvalidity BIGINT,
+    last_uid BIGINT NOT NULL DEFAULT 0,
+    failed_uid BIGINT, -- UID che ha dato errore, riprovato al ciclo successivo
+    failed_attempts INTEGER NOT NULL DEFAULT 0,
+    committed_uids TEXT, -- UID oltre last_uid già salvati (es. 12:14,20), da non rielaborare
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Per le tabelle create con una versione precedente di questo script
+ALTER TABLE email_sync_state ADD COLUMN IF NOT EXISTS committed_uids TEXT;
@@ -0,0 +1,10 @@
+-- Indici per la paginazione keyset e l'ordinamento lato database
+-- Esegui questo script nel SQL Editor di Supabase
+
+-- Liste ticket/clienti ordinate per (created_at, id) con cursore
+CREATE INDEX IF NOT EXISTS idx_tickets_created_at_id ON tickets(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_customers_created_at_id ON customers(created_at DESC, id DESC);
+
+-- Filtri frequenti combinati con l'ordinamento della lista ticket
+CREATE INDEX IF NOT EXISTS idx_tickets_status_created_at ON tickets(status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_tickets_priority ON tickets(priority);
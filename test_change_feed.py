@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Test del feed delle modifiche (change_feed): righe modificate, tombstone
+delle eliminazioni, margine di assestamento e token non validi o scaduti
+"""
+import sys
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from change_feed import (get_changes, encode_token, ExpiredToken, _format_timestamp,
+                         CHANGES_RETENTION_DAYS)
+from task_helper import encode_cursor, save_to_supabase, update_in_supabase, delete_from_supabase
+
+
+def token_at(moment):
+    stamp = _format_timestamp(moment)
+    return encode_token(encode_cursor('updated_at', 'asc', stamp, 0),
+                        encode_cursor('deleted_at', 'asc', stamp, 0))
+
+
+def read_feed(token, limit):
+    """Tutte le pagine disponibili: (id modificati, id eliminati, token finale)"""
+    changed, deleted = [], []
+    while True:
+        page = get_changes('customers', token, limit)
+        changed += [row['id'] for row in page['changed']]
+        deleted += page['deleted']
+        token = page['token']
+        if not page['has_more']:
+            return changed, deleted, token
+
+
+@pytest.fixture
+def customers():
+    from app import init_db
+    init_db()
+    batch = uuid.uuid4().hex[:8]
+    rows = []
+    for index in range(4):
+        saved = save_to_supabase('customers', {'name': f'Feed {index}',
+                                               'email': f'feed-{batch}-{index}@example.it'})
+        rows.append(saved[0] if isinstance(saved, list) else saved)
+    return [row['id'] for row in rows]
+
+
+def test_without_token_returns_only_the_initial_token():
+    page = get_changes('customers')
+    assert page['changed'] == [] and page['deleted'] == [] and page['token']
+
+
+def test_changes_and_tombstones(customers):
+    token = token_at(datetime.now(timezone.utc) - timedelta(minutes=1))
+    kept, edited, removed, removed_after_edit = customers
+    update_in_supabase('customers', {'company': 'Nuova'}, {'id': edited})
+    update_in_supabase('customers', {'company': 'Nuova'}, {'id': removed_after_edit})
+    delete_from_supabase('customers', {'id': removed})
+    delete_from_supabase('customers', {'id': removed_after_edit})
+
+    changed, deleted, _ = read_feed(token, limit=1)
+    assert {kept, edited} <= set(changed)
+    # Una riga eliminata compare solo come tombstone, anche se era stata modificata
+    assert {removed, removed_after_edit} <= set(deleted)
+    assert not {removed, removed_after_edit} & set(changed)
+
+
+def test_recent_changes_are_sent_again_until_settled(customers):
+    token = token_at(datetime.now(timezone.utc) - timedelta(minutes=1))
+    changed, _, token = read_feed(token, limit=100)
+    assert set(customers) <= set(changed)
+    # Entro CHANGES_SETTLE_SECONDS il token non supera le righe appena scritte
+    changed, _, _ = read_feed(token, limit=100)
+    assert set(customers) <= set(changed)
+
+
+def test_invalid_and_expired_tokens():
+    with pytest.raises(ValueError):
+        get_changes('customers', 'non-un-token')
+    expired = token_at(datetime.now(timezone.utc) - timedelta(days=CHANGES_RETENTION_DAYS + 1))
+    with pytest.raises(ExpiredToken):
+        get_changes('customers', expired)
+
+
+def test_changes_endpoint_status_codes():
+    from app import app
+    from database import UserService
+    headers = {'Authorization': 'Bearer ' + UserService.generate_token(
+        {'id': 1, 'username': 'admin', 'role': 'admin'})}
+    client = app.test_client()
+    assert client.get('/api/customers/changes', headers=headers).status_code == 200
+    assert client.get('/api/customers/changes?since=garbage', headers=headers).status_code == 400
+    expired = token_at(datetime.now(timezone.utc) - timedelta(days=CHANGES_RETENTION_DAYS + 1))
+    response = client.get(f'/api/tickets/changes?since={expired}', headers=headers)
+    assert response.status_code == 410 and response.json['reset'] is True
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test della coda persistente delle email: ritentativi con backoff,
+tentativi massimi e lease dei job presi in carico
+"""
+import sys
+import os
+import json
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+import email_service
+from email_service import EmailQueue, EMAIL_QUEUE_LEASE, EMAIL_QUEUE_RETRY_BASE
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = EmailQueue(db_path=str(tmp_path / 'queue.db'), workers=1)
+    # Senza worker: i job si prendono in carico a mano con _claim_next
+    queue.running = True
+    return queue
+
+
+def run_next(queue):
+    job = queue._claim_next()
+    assert job is not None
+    queue._finish_job(job, *queue._run_job(job))
+    return job
+
+
+def job_row(queue, job_id):
+    return dict(queue._connection().execute('SELECT * FROM email_jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def make_due(queue, job_id):
+    queue._connection().execute('UPDATE email_jobs SET next_attempt_at = 0 WHERE id = ?', (job_id,))
+
+
+def test_failed_job_is_retried_with_backoff(queue, monkeypatch):
+    results = [(False, 'server non raggiungibile'), True]
+    monkeypatch.setitem(email_service.EMAIL_JOB_HANDLERS, 'user_activation', lambda user: results.pop(0))
+    job_id = queue.enqueue('user_activation', {'id': 1})
+
+    before = time.time()
+    run_next(queue)
+    row = job_row(queue, job_id)
+    assert row['status'] == 'pending' and row['attempts'] == 1
+    assert row['last_error'] == 'server non raggiungibile'
+    assert row['next_attempt_at'] >= before + EMAIL_QUEUE_RETRY_BASE
+    assert queue._claim_next() is None  # Non ancora scaduto
+
+    make_due(queue, job_id)
+    run_next(queue)
+    row = job_row(queue, job_id)
+    assert row['status'] == 'sent' and row['attempts'] == 2 and row['last_error'] is None
+
+
+def test_job_fails_after_max_attempts(queue, monkeypatch):
+    def broken(user):
+        raise RuntimeError('template mancante')
+    monkeypatch.setitem(email_service.EMAIL_JOB_HANDLERS, 'user_activation', broken)
+    job_id = queue.enqueue('user_activation', {'id': 2}, max_attempts=2)
+
+    run_next(queue)
+    make_due(queue, job_id)
+    run_next(queue)
+    row = job_row(queue, job_id)
+    assert row['status'] == 'failed' and row['attempts'] == 2
+    assert row['last_error'] == 'template mancante'
+    assert queue._claim_next() is None
+
+
+def test_retry_covers_only_the_undelivered_part(queue, monkeypatch):
+    calls = []
+
+    def send(ticket, message, recipients=None):
+        calls.append(recipients)
+        if recipients is None:
+            return False, 'Destinatari rifiutati: b@example.it', [ticket, message, ['b@example.it']]
+        return True
+    monkeypatch.setitem(email_service.EMAIL_JOB_HANDLERS, 'message_to_agents', send)
+    job_id = queue.enqueue('message_to_agents', {'id': 3}, {'message_text': 'ciao'})
+
+    run_next(queue)
+    assert json.loads(job_row(queue, job_id)['payload'])[2] == ['b@example.it']
+    make_due(queue, job_id)
+    run_next(queue)
+    assert calls == [None, ['b@example.it']]
+    assert job_row(queue, job_id)['status'] == 'sent'
+
+
+def test_running_job_is_leased(queue):
+    other = EmailQueue(db_path=queue.db_path, workers=1)
+    other.running = True
+    job_id = queue.enqueue('user_activation', {'id': 4})
+
+    assert queue._claim_next()['id'] == job_id
+    # Un altro processo non riprende un job in corso entro il lease...
+    assert other._claim_next() is None
+    # ...ma lo riprende se chi l'aveva preso in carico è sparito
+    queue._connection().execute('UPDATE email_jobs SET updated_at = ? WHERE id = ?',
+                                (time.time() - EMAIL_QUEUE_LEASE - 1, job_id))
+    job = other._claim_next()
+    assert job['id'] == job_id and job['attempts'] == 2
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Test della sincronizzazione IMAP incrementale per UID: punto di ripresa
+(last_uid), UIDVALIDITY, errori ed email già salvate (committed_uids)
+"""
+import sys
+import os
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+import email_service
+from email_service import EmailService, EMAIL_SYNC_MAX_ATTEMPTS, _parse_uid_set, _imap_uid_set
+
+CONFIG = {'host': 'imap.example.it', 'username': 'supporto'}
+
+
+class FakeMailbox:
+    """Sessione IMAP finta: UID -> letta/non letta"""
+
+    def __init__(self, uidvalidity, unseen=(), seen=()):
+        self.uidvalidity = uidvalidity
+        self.flags = {uid: False for uid in unseen}
+        self.flags.update({uid: True for uid in seen})
+
+    @property
+    def uidnext(self):
+        return max(self.flags, default=0) + 1
+
+    def add(self, *uids):
+        for uid in uids:
+            self.flags[uid] = False
+
+    def search(self, *criteria):
+        if criteria == ('UNSEEN',):
+            return sorted(uid for uid, seen in self.flags.items() if not seen)
+        if criteria == ('ALL',):
+            return sorted(self.flags)
+        first = int(criteria[1].split(':')[0])
+        return sorted(uid for uid in self.flags if uid >= first) or [max(self.flags)]
+
+    def uid(self, command, uid_set, *args):
+        assert command == 'STORE'
+        for uid in _parse_uid_set(uid_set):
+            self.flags[uid] = True
+
+
+@pytest.fixture
+def sync(monkeypatch):
+    """Stato salvato, email elaborate e UID che falliscono, senza database né IMAP"""
+    env = SimpleNamespace(states={}, processed=[], failing=set(), mail=None)
+    monkeypatch.setattr(EmailService, 'get_sync_state',
+                        staticmethod(lambda mailbox: dict(env.states[mailbox]) if mailbox in env.states else None))
+    monkeypatch.setattr(EmailService, 'save_sync_state',
+                        staticmethod(lambda state: env.states.__setitem__(state['mailbox'], dict(state)) or True))
+    monkeypatch.setattr(EmailService, 'prefetch_reply_tickets', staticmethod(lambda items: {}))
+    monkeypatch.setattr(EmailService, 'resolve_new_ticket_senders', staticmethod(lambda items, tickets: {}))
+    monkeypatch.setattr(email_service, 'resolve_threads', lambda items: None)
+    monkeypatch.setattr(email_service, 'fetch_messages', lambda mail, uids: [
+        SimpleNamespace(uid=uid, duplicate=False, message_id=None) for uid in uids])
+    monkeypatch.setattr(email_service, '_imap_uid_search', lambda mail, *criteria: mail.search(*criteria))
+
+    def process_batch(items, tickets, customers):
+        results = {}
+        for item in items:
+            if item.uid in env.failing:
+                results[item.uid] = RuntimeError('database non raggiungibile')
+            else:
+                env.processed.append(item.uid)
+                results[item.uid] = True
+        return results
+    monkeypatch.setattr(EmailService, 'process_batch', staticmethod(process_batch))
+
+    def run(mail):
+        return EmailService.process_mailbox(mail, CONFIG)
+    env.run = run
+    return env
+
+
+def state(sync):
+    return sync.states[EmailService.mailbox_key(CONFIG)]
+
+
+def test_uid_set_round_trip():
+    assert _imap_uid_set([9, 3, 4, 5, 12, 11]) == '3:5,9,11:12'
+    assert _parse_uid_set('3:5,9,11:12') == {3, 4, 5, 9, 11, 12}
+    assert _parse_uid_set('') == set()
+
+
+def test_first_sync_processes_unseen_then_only_new_uids(sync):
+    mail = FakeMailbox(uidvalidity=7, unseen=[4, 6], seen=[1, 2, 3, 5])
+    assert sync.run(mail) == 2
+    assert sync.processed == [4, 6]
+    assert state(sync)['uidvalidity'] == 7 and state(sync)['last_uid'] == 6
+
+    mail.add(7, 8)
+    mail.flags[2] = False  # Segnata come non letta dall'utente: non va rielaborata
+    assert sync.run(mail) == 2
+    assert sync.processed == [4, 6, 7, 8]
+    assert state(sync)['last_uid'] == 8
+
+    assert sync.run(mail) == 0
+
+
+def test_uidvalidity_change_resynchronizes(sync):
+    mail = FakeMailbox(uidvalidity=7, unseen=[10])
+    sync.run(mail)
+    # Cartella ricreata: gli UID ripartono e quelli vecchi non valgono più
+    recreated = FakeMailbox(uidvalidity=8, unseen=[2, 3], seen=[1])
+    assert sync.run(recreated) == 2
+    assert sync.processed == [10, 2, 3]
+    assert state(sync)['uidvalidity'] == 8 and state(sync)['last_uid'] == 3
+
+
+def test_failed_uid_holds_the_resume_point(sync, monkeypatch):
+    monkeypatch.setattr(email_service, 'EMAIL_FETCH_BATCH', 10)
+    mail = FakeMailbox(uidvalidity=7, seen=[1])
+    sync.run(mail)
+    mail.add(2, 3, 4)
+    sync.failing = {3}
+
+    sync.run(mail)
+    assert state(sync)['last_uid'] == 2
+    assert state(sync)['failed_uid'] == 3 and state(sync)['failed_attempts'] == 1
+    # UID 4 è già salvato: al nuovo tentativo non viene elaborato di nuovo
+    assert state(sync)['committed_uids'] == '4'
+
+    sync.failing = set()
+    sync.run(mail)
+    assert sync.processed == [2, 4, 3]
+    assert state(sync)['last_uid'] == 4 and state(sync)['committed_uids'] == ''
+
+
+def test_uid_skipped_after_max_attempts(sync):
+    mail = FakeMailbox(uidvalidity=7, seen=[1])
+    sync.run(mail)
+    mail.add(2, 3)
+    sync.failing = {2}
+    for _ in range(EMAIL_SYNC_MAX_ATTEMPTS):
+        sync.run(mail)
+    assert state(sync)['last_uid'] == 3 and state(sync)['failed_uid'] is None
+    assert sync.processed == [3]
+
+
+def test_interrupted_first_sync_is_resumed(sync):
+    mail = FakeMailbox(uidvalidity=7, unseen=[3, 5, 8], seen=[1])
+    sync.failing = {5}
+    sync.run(mail)
+    # UIDVALIDITY non ancora salvato: il prossimo ciclo riparte dalle non lette
+    assert state(sync)['uidvalidity'] is None and state(sync)['failed_uid'] == 5
+
+    sync.failing = set()
+    sync.run(mail)
+    assert sorted(sync.processed) == [3, 5, 8] and len(sync.processed) == 3
+    assert state(sync)['uidvalidity'] == 7 and state(sync)['last_uid'] == 8
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test del DSL dei filtri di task_helper: traduzione SQL (SQLite/Postgres)
+e PostgREST (Supabase), con lo stesso significato su entrambi
+"""
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from task_helper import (iter_filter_predicates, and_filters, _postgrest_condition,
+                         _apply_supabase_filters, save_many, get_from_supabase)
+from storage_backends import build_where_clause
+
+
+class RecordingQuery:
+    """Query PostgREST finta: registra i metodi chiamati"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name, *args))
+            return self
+        return record
+
+
+def test_predicates_are_normalized():
+    predicates = list(iter_filter_predicates({
+        'status': 'Open',
+        'priority': ('in', ['High', 'Urgent']),
+        'created_at': ('between', ('2025-01-01', '2025-02-01')),
+        'id': [('gt', 3), ('lte', 9)],
+    }))
+    assert predicates == [
+        ('status', 'eq', 'Open'),
+        ('priority', 'in', ['High', 'Urgent']),
+        ('created_at', 'gte', '2025-01-01'),
+        ('created_at', 'lte', '2025-02-01'),
+        ('id', 'gt', 3),
+        ('id', 'lte', 9),
+    ]
+    with pytest.raises(ValueError):
+        list(iter_filter_predicates({'id': ('regex', '.*')}))
+
+
+def test_sql_where_clause():
+    sql, params = build_where_clause({
+        'group': 'supporto',
+        'id': ('in', [1, 2]),
+        'assigned_to': ('is', None),
+        'title': ('ilike', '%stampante%'),
+        '$or': [{'status': 'Open'}, {'priority': 'High', 'id': ('gt', 5)}],
+    })
+    assert sql == ('"group" = ? AND "id" IN (?, ?) AND "assigned_to" IS NULL'
+                   ' AND LOWER("title") LIKE LOWER(?)'
+                   ' AND (("status" = ?) OR ("priority" = ? AND "id" > ?))')
+    assert params == ['supporto', 1, 2, '%stampante%', 'Open', 'High', 5]
+
+
+def test_sql_where_clause_postgres_dialect():
+    sql, params = build_where_clause({'title': ('ilike', 'x%'), 'is_internal': ('not_is', True),
+                                      'id': ('in', [])},
+                                     placeholder='%s', native_ilike=True, native_bool=True)
+    assert sql == '"title" ILIKE %s AND "is_internal" IS NOT TRUE AND 1 = 0'
+    assert params == ['x%']
+
+
+def test_postgrest_condition():
+    condition = _postgrest_condition({
+        '$or': [{'company': ('is', None), 'id': ('lt', 4)}, {'company': ('not_is', None)}],
+        'name': 'Rossi, Mario (ufficio)',
+    })
+    assert condition == ('and(or(and(company.is.null,id.lt."4"),company.not.is.null),'
+                         'name.eq."Rossi, Mario (ufficio)")')
+
+
+def test_supabase_query_filters():
+    query = _apply_supabase_filters(RecordingQuery(), and_filters(
+        {'status': 'Open', 'id': ('in', (1, 2))},
+        {'deleted_at': ('is', None), '$or': [{'priority': 'High'}, {'priority': 'Urgent'}]},
+    ))
+    assert query.calls == [
+        ('eq', 'status', 'Open'),
+        ('in_', 'id', [1, 2]),
+        ('filter', 'deleted_at', 'is', 'null'),
+        ('or_', 'priority.eq."High",priority.eq."Urgent"'),
+    ]
+
+
+def test_sqlite_backend_applies_filters():
+    from app import init_db
+    init_db()
+    save_many('customers', [{'name': f'Filtro {i}', 'email': f'filter-{i}@example.it',
+                             'company': None if i % 2 else f'Azienda {i}'} for i in range(6)])
+    base = {'email': ('like', 'filter-%')}
+
+    rows = get_from_supabase('customers', and_filters(base, {
+        '$or': [{'company': ('is', None)}, {'name': ('ilike', 'FILTRO 0')}]
+    }), use_cache=False)
+    assert sorted(row['name'] for row in rows) == ['Filtro 0', 'Filtro 1', 'Filtro 3', 'Filtro 5']
+
+    rows = get_from_supabase('customers', and_filters(base, {'company': ('not_is', None)}), use_cache=False)
+    assert sorted(row['name'] for row in rows) == ['Filtro 0', 'Filtro 2', 'Filtro 4']
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Test del parser delle risposte FETCH e della scelta della parte di testo
+dalla BODYSTRUCTURE (imap_fetch)
+"""
+import sys
+import os
+import base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from imap_fetch import (parse_fetch_response, find_text_part, decode_body, fetch_messages,
+                        HEADER_SECTION)
+
+PLAIN = b'("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+HTML = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 900 12 NIL NIL NIL NIL)'
+ATTACHMENT = (b'("TEXT" "PLAIN" ("NAME" "log.txt") NIL NIL "BASE64" 5000 70 NIL '
+              b'("ATTACHMENT" ("FILENAME" "log.txt")) NIL NIL)')
+PDF = b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 80000 NIL ("ATTACHMENT" NIL) NIL NIL)'
+
+
+def structure(raw):
+    """BODYSTRUCTURE analizzata come nella risposta FETCH"""
+    return parse_fetch_response([b'1 (UID 1 BODYSTRUCTURE ' + raw + b')'])[1]['BODYSTRUCTURE']
+
+
+def multipart(subtype, *parts):
+    return b'(' + b''.join(parts) + b' "' + subtype + b'" ("BOUNDARY" "b1") NIL NIL NIL)'
+
+
+def test_parse_fetch_response_with_literals():
+    headers = b'Subject: Re: Ticket #42\r\nFrom: "Rossi, Mario" <mario@example.it>\r\n\r\n'
+    data = [
+        (b'3 (UID 17 FLAGS (\\Seen) BODY[' + HEADER_SECTION.encode() + b'] {%d}' % len(headers), headers),
+        b' INTERNALDATE "10-Jun-2025 12:15:00 +0200")',
+        (b'4 (UID 18 BODY[1]<0> {5}', b'ciao!'),
+        b' X-NOTE "con \\"virgolette\\"" ENVELOPE NIL)',
+    ]
+    parsed = parse_fetch_response(data)
+    assert set(parsed) == {17, 18}
+    assert parsed[17]['BODY'][HEADER_SECTION.upper()] == headers
+    assert parsed[17]['FLAGS'] == [b'\\Seen']
+    assert parsed[17]['INTERNALDATE'] == b'10-Jun-2025 12:15:00 +0200'
+    assert parsed[18]['BODY']['1'] == b'ciao!'
+    assert parsed[18]['X-NOTE'] == b'con "virgolette"'
+    assert parsed[18]['ENVELOPE'] is None
+
+
+def test_single_part_message():
+    part = find_text_part(structure(PLAIN))
+    assert part == {'section': '1', 'encoding': 'quoted-printable', 'charset': 'iso-8859-1', 'size': 120}
+    # Un'email solo HTML ha comunque un corpo da leggere
+    assert find_text_part(structure(HTML))['section'] == '1'
+
+
+def test_multipart_prefers_plain_text():
+    assert find_text_part(structure(multipart(b'ALTERNATIVE', PLAIN, HTML)))['section'] == '1'
+    assert find_text_part(structure(multipart(b'ALTERNATIVE', HTML, PLAIN)))['section'] == '2'
+
+
+def test_nested_multipart_and_attachments():
+    mixed = multipart(b'MIXED', ATTACHMENT, multipart(b'ALTERNATIVE', PLAIN, HTML), PDF)
+    part = find_text_part(structure(mixed))
+    assert part['section'] == '2.1' and part['charset'] == 'iso-8859-1'
+    # Solo allegati e HTML dentro un multipart: nessuna parte di testo
+    assert find_text_part(structure(multipart(b'MIXED', ATTACHMENT, HTML, PDF))) is None
+
+
+def test_decode_truncated_bodies():
+    text = 'Perché la stampante è ferma?\n' * 20
+    encoded = base64.encodebytes(text.encode('utf-8'))
+    # Troncato a metà di un gruppo base64: si decodifica la parte completa
+    decoded = decode_body(encoded[:101], 'base64', 'utf-8', truncated=True)
+    assert decoded and text.startswith(decoded.rstrip('�'))
+    qp = b'Perch=C3=A9 non va?\nSeconda riga =C3=A8 trunc=C3'
+    assert decode_body(qp, 'quoted-printable', 'utf-8', truncated=True) == 'Perché non va?\n'
+    assert decode_body(b'ok', '7bit', 'charset-inesistente') == 'ok'
+
+
+class FakeMail:
+    """Risponde a UID FETCH come imaplib, registrando i comandi"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.commands = []
+
+    def uid(self, command, uid_set, items):
+        self.commands.append(items)
+        data = []
+        for uid in (int(u) for u in uid_set.split(',')):
+            if uid not in self.messages:
+                continue  # Email rimossa nel frattempo
+            headers, raw_structure, body = self.messages[uid]
+            if 'BODYSTRUCTURE' in items:
+                prefix = b'1 (UID %d BODYSTRUCTURE %s BODY[%s] {%d}' % (
+                    uid, raw_structure, HEADER_SECTION.encode(), len(headers))
+                data += [(prefix, headers), b')']
+            else:
+                section = items[items.index('[') + 1:items.index(']')]
+                data += [(b'1 (UID %d BODY[%s]<0> {%d}' % (uid, section.encode(), len(body)), body), b')']
+        return 'OK', data
+
+
+def test_fetch_messages_downloads_only_the_text_part():
+    mail = FakeMail({
+        5: (b'Subject: Re: Ticket #42\r\nFrom: mario@example.it\r\n\r\n',
+            multipart(b'ALTERNATIVE', PLAIN, HTML), b'Perch=E9 non va?'),
+        7: (b'Subject: Nuova richiesta\r\n\r\n', PLAIN, b'Buongiorno'),
+    })
+    items = fetch_messages(mail, [5, 6, 7])
+    assert [item.uid for item in items] == [5, 7]
+    assert items[0].ticket_id == 42 and items[1].ticket_id is None
+    assert items[0].message.get_payload(decode=True).decode('utf-8') == 'Perché non va?'
+    assert items[0].message['From'] == 'mario@example.it'
+    # Un comando per header e struttura, uno per la sezione di testo "1"
+    assert len(mail.commands) == 2 and 'BODY.PEEK[1]<0.' in mail.commands[1]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Test delle letture condizionali dei messaggi di un ticket: ETag, 304,
+letture incrementali (since_id) e invalidazione dopo modifiche ed eliminazioni
+"""
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app import app, init_db
+from database import UserService
+from task_helper import save_to_supabase
+
+CUSTOMER = {'id': 900, 'name': 'Cliente ETag', 'email': 'etag@example.it'}
+
+
+def first(rows):
+    return rows[0] if isinstance(rows, list) else rows
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture(scope='module')
+def agent_headers():
+    return {'Authorization': 'Bearer ' + UserService.generate_token(
+        {'id': 1, 'username': 'admin', 'role': 'admin'})}
+
+
+@pytest.fixture(scope='module')
+def customer_headers():
+    return {'Authorization': 'Bearer ' + UserService.generate_customer_token(CUSTOMER)}
+
+
+@pytest.fixture
+def ticket():
+    init_db()
+    return first(save_to_supabase('tickets', {
+        'title': 'Stampante ferma', 'description': 'Non stampa', 'status': 'Open', 'priority': 'Low',
+        'customer_id': CUSTOMER['id'], 'customer_email': CUSTOMER['email'], 'customer_name': CUSTOMER['name']
+    }))
+
+
+def add_message(ticket_id, text, is_internal=False):
+    return first(save_to_supabase('ticket_messages', {
+        'ticket_id': ticket_id, 'sender_type': 'agent', 'sender_name': 'Admin',
+        'sender_email': 'admin@example.it', 'message_text': text, 'is_internal': is_internal
+    }))
+
+
+def get(client, url, headers, etag=None):
+    if etag:
+        headers = {**headers, 'If-None-Match': etag}
+    return client.get(url, headers=headers)
+
+
+def test_unchanged_conversation_answers_304(client, agent_headers, ticket):
+    url = f"/api/tickets/{ticket['id']}/messages"
+    add_message(ticket['id'], 'primo')
+    response = get(client, url, agent_headers)
+    assert response.status_code == 200 and response.headers['ETag']
+    assert get(client, url, agent_headers, response.headers['ETag']).status_code == 304
+
+
+def test_since_id_returns_only_new_messages(client, agent_headers, ticket):
+    url = f"/api/tickets/{ticket['id']}/messages"
+    last = add_message(ticket['id'], 'primo')
+    response = get(client, f"{url}?since_id={last['id']}", agent_headers)
+    assert response.json == []
+    etag = response.headers['ETag']
+    assert get(client, f"{url}?since_id={last['id']}", agent_headers, etag).status_code == 304
+
+    new = add_message(ticket['id'], 'secondo')
+    response = get(client, f"{url}?since_id={last['id']}", agent_headers, etag)
+    assert response.status_code == 200
+    assert [message['id'] for message in response.json] == [new['id']]
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('change', ['edit', 'delete'])
+def test_edit_and_delete_change_the_etag(client, agent_headers, ticket, change):
+    url = f"/api/tickets/{ticket['id']}/messages"
+    message = add_message(ticket['id'], 'da cambiare')
+    response = get(client, f"{url}?since_id={message['id']}", agent_headers)
+    etag, version = response.headers['ETag'], response.headers['X-Messages-Version']
+
+    message_url = f"{url}/{message['id']}"
+    if change == 'edit':
+        assert client.put(message_url, json={'message_text': 'cambiato'}, headers=agent_headers).status_code == 200
+    else:
+        assert client.delete(message_url, headers=agent_headers).status_code == 200
+
+    # Nessun messaggio nuovo, ma la conversazione è cambiata: niente 304
+    response = get(client, f"{url}?since_id={message['id']}", agent_headers, etag)
+    assert response.status_code == 200
+    assert response.headers['X-Messages-Version'] != version
+
+
+def test_customer_messages_are_conditional(client, customer_headers, ticket):
+    url = f"/api/customer/tickets/{ticket['id']}/messages"
+    add_message(ticket['id'], 'per il cliente')
+    response = get(client, url, customer_headers)
+    assert response.status_code == 200
+    assert get(client, url, customer_headers, response.headers['ETag']).status_code == 304
+
+    other = {'Authorization': 'Bearer ' + UserService.generate_customer_token(
+        {'id': 901, 'name': 'Altro', 'email': 'altro@example.it'})}
+    assert get(client, url, other).status_code == 404
+
+
+@pytest.mark.parametrize('query', ['since_id=abc', 'since_id=1.5', 'since=ieri'])
+def test_invalid_delta_parameters_are_rejected(client, agent_headers, customer_headers, ticket, query):
+    assert get(client, f"/api/tickets/{ticket['id']}/messages?{query}", agent_headers).status_code == 400
+    assert get(client, f"/api/customer/tickets/{ticket['id']}/messages?{query}",
+               customer_headers).status_code == 400
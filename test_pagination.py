@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Test della paginazione keyset (cursore su sort, id) con valori NULL
+"""
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+from app import app, init_db
+from database import UserService
+from task_helper import save_many, get_page_from_supabase, encode_cursor, decode_cursor
+
+FILTERS = {'email': ('like', 'page-%')}
+
+
+@pytest.fixture(scope='module')
+def customers():
+    init_db()
+    # Un cliente su tre senza azienda: i NULL vanno ordinati come i valori più grandi
+    rows = save_many('customers', [{
+        'name': f'Cliente {i}',
+        'email': f'page-{i}@example.it',
+        'company': None if i % 3 == 0 else f'azienda-{i % 4}'
+    } for i in range(20)])
+    assert rows and len(rows) == 20
+    return rows
+
+
+def read_all_pages(direction, limit=3):
+    seen = []
+    cursor = None
+    while True:
+        rows, cursor = get_page_from_supabase('customers', filters=FILTERS, sort='company',
+                                              direction=direction, limit=limit, cursor=cursor)
+        seen.extend(rows)
+        if not cursor:
+            return seen
+
+
+@pytest.mark.parametrize('direction', ['asc', 'desc'])
+def test_pages_cover_every_row_once(customers, direction):
+    seen = read_all_pages(direction)
+    ids = [row['id'] for row in seen]
+    assert len(ids) == len(set(ids)) == len(customers)
+
+
+def test_null_values_are_greatest(customers):
+    ascending = [row['company'] for row in read_all_pages('asc')]
+    descending = [row['company'] for row in read_all_pages('desc')]
+    nulls = ascending.count(None)
+    assert nulls == 7
+    # Ultimi in ordine crescente, primi in decrescente
+    assert ascending[-nulls:] == [None] * nulls
+    assert descending[:nulls] == [None] * nulls
+    assert ascending[:-nulls] == sorted(ascending[:-nulls])
+    assert descending[nulls:] == sorted(descending[nulls:], reverse=True)
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('company', 'asc', None, 12)
+    assert decode_cursor(cursor, 'company', 'asc') == (None, 12)
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 'company', 'desc')
+    with pytest.raises(ValueError):
+        decode_cursor('non-un-cursore', 'company', 'asc')
+
+
+def test_invalid_limit_is_rejected(customers):
+    headers = {'Authorization': 'Bearer ' + UserService.generate_token(
+        {'id': 1, 'username': 'admin', 'role': 'admin'})}
+    client = app.test_client()
+    assert client.get('/api/customers?limit=abc', headers=headers).status_code == 400
+    assert client.get('/api/customers?limit=5', headers=headers).status_code == 200
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Test della cache delle query di task_helper: TTL per tabella, LRU e
+invalidazione sulle scritture
+"""
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+import task_helper
+from task_helper import (QueryCache, get_from_supabase, save_to_supabase, update_in_supabase,
+                         replace_all, get_query_cache_stats)
+
+
+def key(table, *parts):
+    return QueryCache.make_key('select', table, *parts)
+
+
+def test_tables_without_ttl_are_not_cached():
+    cache = QueryCache(ttls={'options': 60})
+    cache.set(key('tickets'), [1], cache.generation('tickets'))
+    assert cache.get(key('tickets')) == (False, None)
+
+
+def test_cached_values_are_copies():
+    cache = QueryCache(ttls={'options': 60})
+    value = [{'value': 'a'}]
+    cache.set(key('options'), value, cache.generation('options'))
+    value[0]['value'] = 'modificato'
+    hit, cached = cache.get(key('options'))
+    assert hit and cached == [{'value': 'a'}]
+    cached.append({'value': 'b'})
+    assert cache.get(key('options'))[1] == [{'value': 'a'}]
+
+
+def test_invalidate_only_the_written_table():
+    cache = QueryCache(ttls={'options': 60, 'settings': 60})
+    cache.set(key('options'), [1], cache.generation('options'))
+    cache.set(key('settings'), [2], cache.generation('settings'))
+    cache.invalidate('options')
+    assert cache.get(key('options')) == (False, None)
+    assert cache.get(key('settings')) == (True, [2])
+
+
+def test_write_during_read_is_not_cached():
+    cache = QueryCache(ttls={'options': 60})
+    generation = cache.generation('options')
+    cache.invalidate('options')  # Scrittura mentre la lettura era in corso
+    cache.set(key('options'), ['vecchio'], generation)
+    assert cache.get(key('options')) == (False, None)
+
+
+def test_expiry_and_lru_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(task_helper.time, 'monotonic', lambda: now[0])
+    cache = QueryCache(max_entries=2, ttls={'options': 10})
+    for index in range(3):
+        cache.set(key('options', index), [index], cache.generation('options'))
+    assert cache.get(key('options', 0)) == (False, None)
+    assert cache.get(key('options', 2)) == (True, [2])
+    now[0] += 11
+    assert cache.get(key('options', 2)) == (False, None)
+    stats = cache.stats()
+    assert stats['evictions'] == 1 and stats['expirations'] == 1
+
+
+def test_writes_invalidate_cached_reads():
+    from app import init_db
+    init_db()
+    table = 'ticket_type_options'
+    filters = {'value': ('like', 'cache-%')}
+    assert get_from_supabase(table, filters) == []
+
+    saved = save_to_supabase(table, {'value': 'cache-a', 'label': 'A', 'is_active': True})
+    row = saved[0] if isinstance(saved, list) else saved
+    assert [r['label'] for r in get_from_supabase(table, filters)] == ['A']
+    hits = get_query_cache_stats()['hits']
+    assert [r['label'] for r in get_from_supabase(table, filters)] == ['A']
+    assert get_query_cache_stats()['hits'] == hits + 1
+
+    update_in_supabase(table, {'label': 'A2'}, {'id': row['id']})
+    assert [r['label'] for r in get_from_supabase(table, filters)] == ['A2']
+
+    replace_all(table, [{'value': 'cache-b', 'label': 'B', 'is_active': True}], key='value',
+                filters={'is_active': True, 'value': ('like', 'cache-%')})
+    assert [r['label'] for r in get_from_supabase(table, filters)] == ['B']
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Test degli ETag dalle versioni delle tabelle (table_versions) e delle GET
+condizionali delle API (decorator conditional_get)
+"""
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+
+import table_versions as table_versions_module
+from table_versions import TableVersions
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(table_versions_module.time, 'time', lambda: now[0])
+    return now
+
+
+def test_etag_follows_the_table_versions(clock):
+    versions = TableVersions(max_age=0, max_ages={})
+    etag = versions.etag(['tickets', 'customers'], '/api/tickets')
+    assert versions.etag(['tickets', 'customers'], '/api/tickets') == etag
+    assert versions.etag(['tickets', 'customers'], '/api/tickets?status=Open') != etag
+
+    versions.on_write('insert', 'users', [{'id': 1}])
+    assert versions.etag(['tickets', 'customers'], '/api/tickets') == etag
+    versions.on_write('update', 'customers', [{'id': 1}])
+    assert versions.etag(['tickets', 'customers'], '/api/tickets') != etag
+
+
+def test_bump_all_changes_the_epoch(clock):
+    versions = TableVersions(max_age=0, max_ages={})
+    etag = versions.etag(['tickets'])
+    versions.bump('tickets')
+    versions.bump()
+    # Tabelle ripartite da 0, ma con un'epoca nuova l'ETag non torna quello di prima
+    assert versions.version('tickets') == 0
+    assert versions.etag(['tickets']) != etag
+
+
+def test_etag_expires_after_the_shortest_max_age(clock):
+    versions = TableVersions(max_age=5, max_ages={'ticket_type_options': 300})
+    assert versions.max_age_of(['ticket_type_options']) == 300
+    assert versions.max_age_of(['ticket_type_options', 'tickets']) == 5
+
+    # L'orologio è all'inizio di una finestra di 5 secondi, a metà di una di 300
+    options = versions.etag(['ticket_type_options'])
+    tickets = versions.etag(['tickets'])
+    clock[0] += 6
+    assert versions.etag(['ticket_type_options']) == options
+    assert versions.etag(['tickets']) != tickets
+
+
+@pytest.fixture(scope='module')
+def client():
+    from app import app, init_db
+    from database import UserService
+    init_db()
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + UserService.generate_token(
+        {'id': 1, 'username': 'admin', 'role': 'admin'})
+    return client
+
+
+def test_config_get_answers_304_until_a_write(client):
+    response = client.get('/api/config/groups')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert client.get('/api/config/groups', headers={'If-None-Match': etag}).status_code == 304
+
+    saved = client.post('/api/config/groups', json=[{'value': 'etag-test', 'label': 'ETag'}])
+    assert saved.status_code == 200
+    response = client.get('/api/config/groups', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [option['value'] for option in response.json] == ['etag-test']
+
+
+def test_list_etag_changes_after_any_write(client):
+    from task_helper import save_to_supabase
+    response = client.get('/api/customers')
+    etag = response.headers['ETag']
+    save_to_supabase('customers', {'name': 'Nuovo', 'email': 'etag-list@example.it'})
+    assert client.get('/api/customers', headers={'If-None-Match': etag}).status_code == 200